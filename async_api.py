@@ -0,0 +1,483 @@
+"""asyncio serving mode for the similarity api
+
+serves the same routes and json as similarity_api.py, but similarity, top_k and guess requests that arrive within a
+short window are coalesced by a BatchingEngine and answered from a single matrix multiply, so throughput grows with
+load instead of each request paying for its own small np.dot.
+
+Usage: python async_api.py [--port 8000] [--max-batch-size 64] [--max-wait-ms 2]
+"""
+
+import argparse
+import asyncio
+import subprocess
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from aiohttp import web
+
+from snapshot import load_serving_data
+from payloads import vocab_payloads
+from quantization import load_quantized
+from metrics import Metrics, SamplingProfiler, current_route, describe_server_metrics, profiler_refusal, top_k_cache_collector
+from hop_distances import neighborhood
+from utils import TopKCache, top_k_from_similarities, ranks_in
+
+MODEL = "word2vec-google-news-300_50000_lowercase"
+
+# ranks are positions in the target's top RANK_DEPTH list (the target itself is rank 0), -1 beyond it
+RANK_DEPTH = 1001
+
+# most points returned by /neighborhood
+MAX_NEIGHBORHOOD = 10000
+
+
+class BatchingEngine:
+    """collects similarity, top-k and guess requests for up to max_wait seconds or max_batch_size requests,
+    then answers the whole batch from one matrix multiply run off the event loop"""
+
+    def __init__(self, vectors, vocab, graph, top_k_cache, max_batch_size=64, max_wait=0.002, metrics=None):
+        self.vectors = vectors
+        self.vocab = vocab
+        self.graph = graph
+        self.top_k_cache = top_k_cache
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.batches = 0
+        self.requests = 0
+        self._queue = None
+        self._task = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        self._executor.shutdown(wait=False)
+
+    async def similarity(self, rows, cols):
+        """pairwise similarities between the words at rows and at cols, as a len(rows) x len(cols) list of lists"""
+        return await self._submit("similarity", rows, cols)
+
+    async def top_k(self, idx, k):
+        """indices of the k most similar words to idx as an int32 array"""
+        return await self._submit("top_k", idx, k)
+
+    async def guess(self, target, guesses):
+        """similarity, rank and annotated neighbors of each guess, in the same format as similarity_api's /guess"""
+        return await self._submit("guess", target, guesses)
+
+    async def _submit(self, kind, *args):
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((kind, args, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                if not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            self.batches += 1
+            self.requests += len(batch)
+            self.metrics.observe("batch_size", len(batch))
+            try:
+                results = await loop.run_in_executor(self._executor, self._process, [(kind, args) for kind, args, _ in batch])
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, _, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def _check(self, kind, args):
+        """raises ValueError for a request with an out of range word index or a k that isn't a positive int, before it
+        can take part in the batch"""
+        if kind == "similarity":
+            indices = [*args[0], *args[1]]
+        elif kind == "top_k":
+            indices = [args[0]]
+            k = args[1]
+            if not isinstance(k, (int, np.integer)) or isinstance(k, bool) or k < 1:
+                raise ValueError(f"k must be a positive integer, got {k!r}")
+        else:
+            indices = [args[0], *args[1]]
+        if not all(isinstance(idx, (int, np.integer)) and 0 <= idx < len(self.vectors) for idx in indices):
+            raise ValueError("word index out of range")
+
+    def _process(self, requests):
+        """answers a batch of requests; the only similarity computation is one matmul over the batch's words
+
+        returns one result per request, or the exception that request raised, so a bad request only fails itself"""
+        current_route.set("batch")
+        rows, cols = set(), set()
+        tables = {}
+        missing = {}  # target -> largest k requested for a target without a cached rank table
+        errors = {}
+        for i, (kind, args) in enumerate(requests):
+            try:
+                self._check(kind, args)
+            except ValueError as e:
+                errors[i] = e
+                continue
+            if kind == "similarity":
+                rows.update(args[0])
+                cols.update(args[1])
+                continue
+            if kind == "top_k":
+                target, k = args
+            else:
+                target, guesses = args
+                k = RANK_DEPTH
+                rows.add(target)
+                for guess in guesses:
+                    cols.add(guess)
+                    cols.update(self.graph[guess].tolist())
+            if target in missing:
+                missing[target] = max(k, missing[target])
+                continue
+            table = self.top_k_cache.lookup(target, k)
+            if table is None:
+                missing[target] = k
+            elif len(table) > len(tables.get(target, ())):
+                tables[target] = table
+
+        # with a quantized store, rank tables are selected on its codes instead of the batch matmul
+        if missing and self.top_k_cache.store is not None:
+            with self.metrics.phase("rank"):
+                for target, k in missing.items():
+                    tables[target] = self.top_k_cache.compute(target, k)
+            missing = {}
+
+        # rank tables need every similarity to their target, in which case the matmul covers the whole vocabulary
+        rows = np.array(sorted(rows | missing.keys()), dtype=np.int64)
+        with self.metrics.phase("matmul"):
+            if missing:
+                cols = np.arange(len(self.vectors))
+                scores = np.dot(self.vectors, self.vectors[rows].T)
+            else:
+                cols = np.array(sorted(cols), dtype=np.int64)
+                scores = np.dot(self.vectors[cols], self.vectors[rows].T) if len(rows) and len(cols) else np.zeros((len(cols), len(rows)))
+
+        def lookup(row_indices, col_indices):
+            return scores[np.ix_(np.searchsorted(cols, col_indices), np.searchsorted(rows, row_indices))].T
+
+        with self.metrics.phase("rank"):
+            for target, k in missing.items():
+                table = top_k_from_similarities(scores[:, np.searchsorted(rows, target)], self.top_k_cache.table_size(k))
+                self.top_k_cache.put(target, table)
+                tables[target] = table
+
+        results = []
+        for i, (kind, args) in enumerate(requests):
+            if i in errors:
+                results.append(errors[i])
+                continue
+            try:
+                if kind == "similarity":
+                    results.append(lookup(args[0], args[1]).tolist())
+                elif kind == "top_k":
+                    target, k = args
+                    results.append(tables[target][:k])
+                else:
+                    target, guesses = args
+                    results.append(self._guess_results(target, guesses, tables[target], lookup))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def _guess_results(self, target, guesses, rank_table, lookup):
+        ranks = {idx: rank for rank, idx in enumerate(rank_table[:RANK_DEPTH].tolist())}
+        results = []
+        for guess in guesses:
+            neighbors = self.graph[guess].tolist()
+            similarities = lookup([target], [guess] + neighbors)[0].tolist()
+            results.append({
+                "word": self.vocab[guess],
+                "similarity": similarities[0],
+                "rank": ranks.get(guess, -1),
+                "neighbors": self.vocab.words(neighbors),
+                "neighbor_similarities": similarities[1:],
+                "neighbor_ranks": [ranks.get(i, -1) for i in neighbors],
+            })
+        return results
+
+
+@web.middleware
+async def cors_middleware(request, handler):
+    """allows cross-origin requests from anywhere, like the flask app"""
+    if request.method == "OPTIONS":
+        response = web.Response()
+        response.headers["Access-Control-Allow-Methods"] = "GET, POST, OPTIONS"
+        response.headers["Access-Control-Allow-Headers"] = request.headers.get("Access-Control-Request-Headers", "*")
+    else:
+        response = await handler(request)
+    response.headers["Access-Control-Allow-Origin"] = request.headers.get("Origin", "*")
+    response.headers["Access-Control-Allow-Credentials"] = "true"
+    return response
+
+
+def metrics_middleware(metrics):
+    """records latency, status and response size of every request under its route"""
+    @web.middleware
+    async def middleware(request, handler):
+        route = request.match_info.route.resource.canonical if request.match_info.route.resource else "unmatched"
+        current_route.set(route)
+        start = time.perf_counter()
+        try:
+            response = await handler(request)
+        except web.HTTPException as e:
+            metrics.observe_request(route, request.method, e.status, time.perf_counter() - start, None)
+            raise
+        except Exception:
+            metrics.observe_request(route, request.method, 500, time.perf_counter() - start, None)
+            raise
+        body = getattr(response, "body", None)
+        metrics.observe_request(route, request.method, response.status, time.perf_counter() - start, len(body) if isinstance(body, bytes) else None)
+        return response
+    return middleware
+
+
+def create_app(max_batch_size=64, max_wait=0.002, quantized=False):
+    """loads the serving data and returns the aiohttp application
+
+    quantized selects rank table candidates on the compressed vectors, if they were built; it is slower than the exact
+    matmul and saves no memory while the float vectors stay mapped, so it is only for experiments"""
+    start = time.time()
+
+    data_dir = Path("data") / MODEL
+
+    if not data_dir.exists():
+        subprocess.run(["bash", "remote_setup.sh"], check=True)
+
+    vectors, vocab, graph, bfs_distances, reverse_graph = load_serving_data(data_dir)
+    bfs_distances = bfs_distances.tolist()
+    payloads = vocab_payloads(vocab, bfs_distances)
+
+    top_k_cache = TopKCache(vectors, store=load_quantized(data_dir) if quantized else None)
+    metrics = Metrics()
+    describe_server_metrics(metrics)
+    metrics.add_collector(top_k_cache_collector(top_k_cache))
+    profiler = SamplingProfiler()
+
+    engine = BatchingEngine(vectors, vocab, graph, top_k_cache, max_batch_size, max_wait, metrics)
+
+    # edges followed by /neighborhood for each direction
+    directions = {"out": [graph], "in": [reverse_graph], "both": [graph, reverse_graph]}
+
+    print(f"Loaded in {time.time() - start:.2f} seconds")
+
+    def static_response(request, name):
+        """serves a precompressed payload in the requested ?format= (json by default), honoring If-None-Match"""
+        payload = payloads[name].get(request.query.get("format", "json"))
+        if payload is None:
+            return web.json_response({"error": f"format must be one of {list(payloads[name])}"}, status=400)
+        status, headers, body = payload.respond(request.headers)
+        return web.Response(body=body, status=status, headers=headers)
+
+    async def get_vocab(request):
+        """returns the vocabulary list to the client so it can select a target word"""
+        return static_response(request, "vocab")
+
+    async def get_vocab_with_distances(request):
+        """returns the vocabulary list with bfs distances to the start node"""
+        return static_response(request, "vocab_and_distances")
+
+    async def get_similarity(request):
+        """returns the pairwise similarities between two sets of words"""
+        data = await request.json()
+        word1 = data.get("word1", [])
+        word2 = data.get("word2", [])
+
+        with metrics.phase("lookup"):
+            word1_indices = vocab.ids(word1)
+            word2_indices = vocab.ids(word2)
+
+        if (word1_indices < 0).any() or (word2_indices < 0).any():
+            return web.json_response({"error": "at least one word not in vocabulary"}, status=400)
+
+        similarity = await engine.similarity(word1_indices.tolist(), word2_indices.tolist())
+        with metrics.phase("serialization"):
+            return web.json_response({"similarities": similarity})
+
+    async def get_top_k(request):
+        """returns the top k most similar words to a target word"""
+        data = await request.json()
+        word = data.get("word", "").lower()
+        k = data.get("k", 1000)
+        if not isinstance(k, int) or isinstance(k, bool) or k < 1:
+            return web.json_response({"error": "k must be a positive integer"}, status=400)
+
+        with metrics.phase("lookup"):
+            idx = vocab.get(word)
+        if idx is None:
+            return web.json_response({"error": "word not in vocabulary"}, status=400)
+
+        top_k = await engine.top_k(idx, k)
+        with metrics.phase("serialization"):
+            return web.json_response({"top_words": vocab.words(top_k)})
+
+    async def get_neighbors(request):
+        """returns the neighbors of a word"""
+        data = await request.json()
+        word = data.get("word", "").lower()
+
+        idx = vocab.get(word)
+        if idx is None:
+            return web.json_response({"error": "word not in vocabulary"}, status=400)
+
+        neighbors = vocab.words(graph[idx])
+        return web.json_response({"neighbors": neighbors})
+
+    async def get_neighborhood(request):
+        """returns every word within hops of a word along out, in or both edges, with its hop count and, if a target
+        is given, its similarity and rank to the target"""
+        data = await request.json()
+        word = data.get("word", "").lower()
+        target = data.get("target", "").lower()
+        hops = data.get("hops", 2)
+        direction = data.get("direction", "out")
+        max_points = data.get("max_points", MAX_NEIGHBORHOOD)
+        if not isinstance(hops, int) or isinstance(hops, bool) or hops < 0:
+            return web.json_response({"error": "hops must be a non-negative integer"}, status=400)
+        if not isinstance(max_points, int) or isinstance(max_points, bool) or max_points < 1:
+            return web.json_response({"error": "max_points must be a positive integer"}, status=400)
+        max_points = min(max_points, MAX_NEIGHBORHOOD)
+
+        with metrics.phase("lookup"):
+            idx = vocab.get(word)
+            target_idx = vocab.get(target) if target else None
+        if idx is None or (target and target_idx is None):
+            return web.json_response({"error": "word not in vocabulary"}, status=400)
+        if direction not in directions:
+            return web.json_response({"error": f"direction must be one of {list(directions)}"}, status=400)
+
+        points, point_hops = neighborhood(directions[direction], [idx], hops, max_points)
+        result = {"words": vocab.words(points), "hops": point_hops.tolist()}
+        if target_idx is not None:
+            similarities, rank_table = await asyncio.gather(engine.similarity([target_idx], points.tolist()), engine.top_k(target_idx, RANK_DEPTH))
+            result["similarities"] = similarities[0]
+            result["ranks"] = ranks_in(rank_table, points).tolist()
+        with metrics.phase("serialization"):
+            return web.json_response(result)
+
+    async def guess(request):
+        """scores one guess against the target in a single round trip: similarity, rank and annotated neighbors"""
+        data = await request.json()
+        target = data.get("target", "").lower()
+        guess_word = data.get("guess", "").lower()
+
+        with metrics.phase("lookup"):
+            target_idx = vocab.get(target)
+            guess_idx = vocab.get(guess_word)
+        if target_idx is None or guess_idx is None:
+            return web.json_response({"error": "word not in vocabulary"}, status=400)
+
+        results = await engine.guess(target_idx, [guess_idx])
+        with metrics.phase("serialization"):
+            return web.json_response(results[0])
+
+    async def guess_batch(request):
+        """scores many guesses against one target; unknown guesses get an error entry instead of failing the batch"""
+        data = await request.json()
+        target = data.get("target", "").lower()
+        guess_words = [word.lower() for word in data.get("guesses", [])]
+
+        with metrics.phase("lookup"):
+            target_idx = vocab.get(target)
+            guess_indices = vocab.ids(guess_words)
+        if target_idx is None:
+            return web.json_response({"error": "target not in vocabulary"}, status=400)
+
+        results = iter(await engine.guess(target_idx, guess_indices[guess_indices >= 0].tolist()))
+        guesses = [next(results) if idx >= 0 else {"word": word, "error": "word not in vocabulary"} for word, idx in zip(guess_words, guess_indices)]
+        with metrics.phase("serialization"):
+            return web.json_response({"guesses": guesses})
+
+    async def get_metrics(request):
+        """prometheus text exposition of request latency, counts, payload sizes, phase timings and cache stats, for this
+        process only"""
+        return web.Response(body=metrics.render().encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    async def sampling_profiler(request):
+        """GET returns the collapsed stack samples; POST {"enabled", "interval_ms", "reset"} switches the profiler. only
+        served with SEMANTLE_PROFILER set, and to local clients"""
+        refusal = profiler_refusal(request.remote, request.headers)
+        if refusal is not None:
+            return web.json_response({"error": refusal[1]}, status=refusal[0])
+        if request.method == "POST":
+            data = await request.json()
+            if data.get("reset"):
+                profiler.reset()
+            if "enabled" in data:
+                if data["enabled"]:
+                    try:
+                        profiler.start(float(data.get("interval_ms", profiler.interval * 1000)) / 1000)
+                    except (TypeError, ValueError):
+                        return web.json_response({"error": "interval_ms must be a finite number"}, status=400)
+                else:
+                    profiler.stop()
+            return web.json_response({"enabled": profiler.running, "interval_ms": profiler.interval * 1000, "samples": sum(profiler.samples.values())})
+        return web.Response(text=profiler.collapsed())
+
+    async def healthcheck(request):
+        return web.Response(text="healthy")
+
+    async def start_engine(app):
+        await engine.start()
+
+    async def stop_engine(app):
+        await engine.stop()
+        profiler.stop()
+
+    app = web.Application(middlewares=[cors_middleware, metrics_middleware(metrics)])
+    app["engine"] = engine
+    app.on_startup.append(start_engine)
+    app.on_cleanup.append(stop_engine)
+    app.add_routes([
+        web.get("/get_vocab", get_vocab),
+        web.get("/get_vocab_and_distances", get_vocab_with_distances),
+        web.post("/similarity", get_similarity),
+        web.post("/top_k", get_top_k),
+        web.post("/neighbors", get_neighbors),
+        web.post("/neighborhood", get_neighborhood),
+        web.post("/guess", guess),
+        web.post("/guess_batch", guess_batch),
+        web.get("/metrics", get_metrics),
+        web.get("/profiler", sampling_profiler),
+        web.post("/profiler", sampling_profiler),
+        web.get("/healthcheck", healthcheck),
+    ])
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="asyncio similarity api with micro-batched matrix multiplies")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-batch-size", type=int, default=64, help="most requests answered by one matmul")
+    parser.add_argument("--max-wait-ms", type=float, default=2.0, help="longest a request waits for others to batch with")
+    parser.add_argument("--quantized", action="store_true", help="select rank table candidates on the quantized vectors (experimental)")
+    args = parser.parse_args()
+
+    web.run_app(create_app(args.max_batch_size, args.max_wait_ms / 1000, args.quantized), host=args.host, port=args.port)
@@ -1,63 +1,183 @@
 """implementations of natural variants of beam search"""
 
+import heapq
 import numpy as np
-from typing import List, Tuple
+from typing import List, NamedTuple, Optional, Tuple
+from utils import CSRGraph
 
 def dist(a, b):
     """negative inner product, but this could be changed"""
     return -np.dot(a, b)
 
-def beam_search(graph : List[List[int]], vectors: np.ndarray, start : int, query : int, limit : int = 1000) -> Tuple[List[int], List[int]]:
-    """standard beam search with no limit; terminates when the end node is reached
-    
-    In a connected graph, guaranteed to terminate eventually"""
-    # beam elements are dist, index
-    beam = [(dist(vectors[start], vectors[query]))]
-    compared = []
-    visited = []
-    while beam and len(visited) < limit:
-        # get the best element
-        _, best = beam.pop(0)
-        visited.append(best)
-        # if the best element is the query, return the path
-        if best == query:
-            return visited, compared
-        # add the neighbors of the best element to the beam
-        for neighbor in graph[best]:
-            if neighbor not in compared:
-                beam.append((dist(vectors[neighbor], vectors[query]), neighbor))
-                compared.append(neighbor)
-        # sort the beam
-        beam.sort()
-        
-    return visited, compared # this should probably never be reached
-        
-def eager_beam_search(graph : List[List[int]], vectors: np.ndarray, start : int, query : int, limit : int = 1000) -> Tuple[List[int], List[int]]:
-    """beam search which stops going through the neighbors of a point when something better is found"""
-    # beam elements are dist, index
-    beam = [(dist(vectors[start], vectors[query]), start)]
+def neighbor_distances(vectors, neighbors, query_vector):
+    """dist from query_vector to each of vectors[neighbors] in one vectorized kernel
+
+    computed as an elementwise product and row sum so that batched searches, which pair rows with different queries,
+    get bit-identical distances"""
+    return -(vectors[neighbors] * query_vector).sum(axis=1)
+
+def query_distances(vectors, query_vectors, codes=None):
+    """a function (neighbors, rows) giving the dist from query_vectors[rows] to each neighbor
+
+    exact on vectors, or approximate on codes (a quantization store) if given, in which case the points are scored
+    without reading their float vectors. rows is one query index or one per neighbor"""
+    if codes is None:
+        return lambda neighbors, rows: neighbor_distances(vectors, neighbors, query_vectors[rows])
+    prepared = codes.prepare(query_vectors)
+    return lambda neighbors, rows: codes.distances(neighbors, prepared, rows)
+
+class SearchResult(NamedTuple):
+    visited: List[int]
+    compared: List[int]
+    # every node popped from the beam, in order, and how many new comparisons each of those hops made
+    expanded: List[int]
+    comparisons_per_hop: List[int]
+
+    @property
+    def hops(self):
+        return len(self.expanded)
+
+def _expand(beam, is_compared, compared, best, best_dist, candidates, distances, eager):
+    """pushes the uncompared candidates around best onto the beam, returning (new comparisons, whether best was improved on)
+
+    eager expansions stop at the first candidate better than best and push best back so its remaining neighbors can be
+    looked at later"""
+    new_comparisons = 0
+    for neighbor, distance in zip(candidates, distances):
+        # a neighbor can be listed twice
+        if is_compared[neighbor]:
+            continue
+        is_compared[neighbor] = True
+        compared.append(neighbor)
+        new_comparisons += 1
+        heapq.heappush(beam, (distance, neighbor))
+        if eager and distance < best_dist:
+            heapq.heappush(beam, (best_dist, best))
+            return new_comparisons, True
+    return new_comparisons, False
+
+def search(graph : CSRGraph, vectors: np.ndarray, start : int, query : int, limit : int = 1000, beam_width : Optional[int] = None, eager : bool = True, trace=None, codes=None) -> SearchResult:
+    """beam search over a priority queue, with compared state in a bitmap
+
+    eager searches stop going through the neighbors of a point as soon as something better than it is found (see
+    eager_beam_search). beam_width bounds the beam to its best L entries; None keeps every candidate, which is the
+    behavior of beam_search and eager_beam_search. if trace is a search_trace.TraceWriter, every hop is recorded to it.
+    with codes (a quantization store), the search is steered by approximate distances on the codes and only reads the
+    query's float vector; callers re-rank what it compared exactly (see parallel_eval)"""
+    distances_to = query_distances(vectors, vectors[[query]], codes)
+    search_id = trace.begin(query) if trace is not None else None
+    is_compared = np.zeros(len(vectors), dtype=bool)
+    # beam elements are dist, index; the heap pops them in the same order as sorting a list would
+    beam = [(float(distances_to([start], 0)[0]), start)]
     compared = []
     visited = []
+    expanded = []
+    comparisons_per_hop = []
     while beam and len(visited) < limit:
         # get the best element
-        best_dist, best = beam.pop(0)
+        best_dist, best = heapq.heappop(beam)
+        if not eager:
+            visited.append(best)
         # if the best element is the query, return the path
         if best == query:
-            return visited, compared
+            break
+        expanded.append(best)
         # add the neighbors of the best element to the beam
-        for neighbor in graph[best]:
-            if neighbor not in compared:
-                beam.append((dist(vectors[neighbor], vectors[query]), neighbor))
-                compared.append(neighbor)
-                if dist(vectors[neighbor], vectors[query]) < best_dist:
-                    beam.append((best_dist, best))
-                    break
-        else:
+        neighbors = graph[best]
+        candidates = neighbors[~is_compared[neighbors]]
+        distances = distances_to(candidates, 0)
+        new_comparisons, improved = _expand(beam, is_compared, compared, best, best_dist, candidates.tolist(), distances.tolist(), eager)
+        comparisons_per_hop.append(new_comparisons)
+        if eager and not improved:
             visited.append(best)
-        # sort the beam
-        beam.sort()
-        
-    return visited, compared # this should probably never be reached
-        
-        
-    
\ No newline at end of file
+        if beam_width is not None and len(beam) > beam_width:
+            beam = heapq.nsmallest(beam_width, beam)
+        if trace is not None:
+            trace.record(search_id, query, len(expanded) - 1, best, new_comparisons, best_dist, beam[0][0] if beam else np.inf)
+
+    return SearchResult(visited, compared, expanded, comparisons_per_hop)
+
+def beam_search(graph : CSRGraph, vectors: np.ndarray, start : int, query : int, limit : int = 1000, beam_width : Optional[int] = None) -> Tuple[List[int], List[int]]:
+    """standard beam search with no limit; terminates when the end node is reached
+
+    In a connected graph, guaranteed to terminate eventually"""
+    visited, compared, _, _ = search(graph, vectors, start, query, limit, beam_width, eager=False)
+    return visited, compared
+
+def eager_beam_search(graph : CSRGraph, vectors: np.ndarray, start : int, query : int, limit : int = 1000, beam_width : Optional[int] = None) -> Tuple[List[int], List[int]]:
+    """beam search which stops going through the neighbors of a point when something better is found"""
+    visited, compared, _, _ = search(graph, vectors, start, query, limit, beam_width, eager=True)
+    return visited, compared
+
+def batch_search(graph : CSRGraph, vectors: np.ndarray, start : int, queries, limit : int = 1000, beam_width : Optional[int] = None, eager : bool = True, batch_size : int = 256, trace=None, codes=None) -> List[SearchResult]:
+    """runs search for many queries, advancing batch_size of them in lockstep
+
+    every step pops one beam element per live query, gathers the uncompared neighbors of all of them and computes their
+    distances in a single kernel. the results are the same as calling search on each query; the compared bitmap is
+    batch_size x len(vectors), so batch_size trades memory for fewer, larger kernels. codes are used as in search"""
+    queries = list(queries)
+    results = []
+    for chunk_start in range(0, len(queries), batch_size):
+        results.extend(_lockstep_search(graph, vectors, start, queries[chunk_start:chunk_start + batch_size], limit, beam_width, eager, trace, codes))
+    return results
+
+def _lockstep_search(graph, vectors, start, queries, limit, beam_width, eager, trace, codes):
+    distances_to = query_distances(vectors, vectors[queries], codes)
+    search_ids = [trace.begin(query) for query in queries] if trace is not None else None
+    is_compared = np.zeros((len(queries), len(vectors)), dtype=bool)
+    start_distances = distances_to(np.full(len(queries), start), np.arange(len(queries))).tolist()
+    beams = [[(distance, start)] for distance in start_distances]
+    results = [SearchResult([], [], [], []) for _ in queries]
+
+    live = list(range(len(queries)))
+    while live:
+        # pop the best element of every live beam; queries that are done drop out of the batch
+        rows = []
+        bests = []
+        best_dists = []
+        for i in live:
+            visited = results[i].visited
+            if not beams[i] or len(visited) >= limit:
+                continue
+            best_dist, best = heapq.heappop(beams[i])
+            if not eager:
+                visited.append(best)
+            if best == queries[i]:
+                continue
+            results[i].expanded.append(best)
+            rows.append(i)
+            bests.append(best)
+            best_dists.append(best_dist)
+        live = rows
+        if not rows:
+            break
+
+        # gather the neighbors of every popped element, csr style, and keep the ones their query hasn't compared yet
+        best_array = np.array(bests)
+        starts = graph.offsets[best_array]
+        degrees = graph.offsets[best_array + 1] - starts
+        hop = np.repeat(np.arange(len(rows)), degrees)
+        positions = np.arange(len(hop)) + np.repeat(starts - (np.cumsum(degrees) - degrees), degrees)
+        neighbors = graph.neighbors[positions]
+        pair_rows = np.asarray(rows)[hop]
+        keep = ~is_compared[pair_rows, neighbors]
+        hop, neighbors, pair_rows = hop[keep], neighbors[keep], pair_rows[keep]
+
+        distances = distances_to(neighbors, pair_rows).tolist()
+        neighbors = neighbors.tolist()
+        bounds = np.concatenate([[0], np.cumsum(np.bincount(hop, minlength=len(rows)))]).tolist()
+
+        for j, i in enumerate(rows):
+            result = results[i]
+            lo, hi = bounds[j], bounds[j + 1]
+            new_comparisons, improved = _expand(beams[i], is_compared[i], result.compared, bests[j], best_dists[j], neighbors[lo:hi], distances[lo:hi], eager)
+            result.comparisons_per_hop.append(new_comparisons)
+            if eager and not improved:
+                result.visited.append(bests[j])
+            if beam_width is not None and len(beams[i]) > beam_width:
+                beams[i] = heapq.nsmallest(beam_width, beams[i])
+            if trace is not None:
+                beam = beams[i]
+                trace.record(search_ids[i], queries[i], len(result.expanded) - 1, bests[j], new_comparisons, best_dists[j], beam[0][0] if beam else np.inf)
+
+    return results
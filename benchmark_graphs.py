@@ -0,0 +1,158 @@
+"""benchmarks built graphs of every type over a sweep of beam widths and start nodes
+
+each configuration (graph type, start node, beam width) runs beam search to every query and records the average and
+percentiles of comparisons and visited points, recall@1 against the ground truth (the closest point the search
+compared is the true nearest neighbor), convergence within the limit, and the wall time of the searches. every graph
+also gets its memory and degree stats. the report has one pareto curve per graph type and one across all of them: the
+configurations, averaged over start nodes, that no other configuration beats on both average comparisons and recall@1.
+
+Usage: python benchmark_graphs.py <embedding name> [--graph-types pynndescent vamana hcnng] [--beam-widths none 10 ...]
+    [--starts 0] [--random-starts 4] [--queries N] [--limit 1000] [--processes N] [--output report.json]
+"""
+
+import argparse
+import json
+import time
+import numpy as np
+from pathlib import Path
+from utils import CSRGraph, fbin_to_numpy, read_groundtruth, Vocabulary
+from parallel_eval import Evaluator
+
+GRAPH_TYPES = ["pynndescent", "vamana", "hcnng"]
+
+PERCENTILES = (50, 90, 99)
+
+
+def parse_beam_width(value):
+    return None if value.lower() == "none" else int(value)
+
+
+def graph_stats(graph, graph_path):
+    stats = graph.degree_stats()
+    return {
+        "points": stats["points"],
+        "edges": stats["edges"],
+        "average_degree": stats["average_degree"],
+        "max_degree": graph.max_degree,
+        "degree_percentiles": stats["percentiles"],
+        "memory_bytes": graph.nbytes,
+        "file_bytes": Path(graph_path).stat().st_size,
+    }
+
+
+def run_config(evaluator, query_indices, nearest_ids, start, beam_width, limit):
+    """one start node and beam width over every query; the time is of the searches alone, the evaluator's pool and
+    shared memory are already set up"""
+    begin = time.perf_counter()
+    counts = evaluator.evaluate(query_indices, start=start, limit=limit, beam_width=beam_width, nearest=True)
+    seconds = time.perf_counter() - begin
+    return {
+        "start": start,
+        "beam_width": beam_width,
+        "queries": len(query_indices),
+        "average_compared": float(np.mean(counts["compared"])),
+        "average_visited": float(np.mean(counts["visited"])),
+        "compared_percentiles": {p: float(np.percentile(counts["compared"], p)) for p in PERCENTILES},
+        "visited_percentiles": {p: float(np.percentile(counts["visited"], p)) for p in PERCENTILES},
+        "recall_at_1": float(np.mean(counts["nearest"] == nearest_ids)),
+        "converged": float(np.mean(counts["visited"] < limit)),
+        "seconds": seconds,
+        "queries_per_second": len(query_indices) / seconds if seconds > 0 else float("inf"),
+    }
+
+
+def average_over_starts(configs):
+    """one point per beam width, averaging the configs of every start node"""
+    points = []
+    for beam_width in dict.fromkeys(config["beam_width"] for config in configs):
+        group = [config for config in configs if config["beam_width"] == beam_width]
+        points.append({
+            "beam_width": beam_width,
+            "starts": [config["start"] for config in group],
+            **{key: float(np.mean([config[key] for config in group])) for key in ["average_compared", "average_visited", "recall_at_1", "converged", "queries_per_second"]},
+        })
+    return points
+
+
+def pareto_front(points):
+    """the points not beaten on both average_compared (lower) and recall_at_1 (higher), by increasing cost"""
+    front = []
+    for point in sorted(points, key=lambda point: (point["average_compared"], -point["recall_at_1"])):
+        if not front or point["recall_at_1"] > front[-1]["recall_at_1"]:
+            front.append(point)
+    return front
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark beam search over every built graph type")
+    parser.add_argument("embeddings")
+    parser.add_argument("--graph-types", nargs="+", default=GRAPH_TYPES, help="graphs in outputs/ to benchmark")
+    parser.add_argument("--beam-widths", nargs="+", type=parse_beam_width, default=[None, 10, 20, 50, 100, 200], help="beam widths, none for unbounded")
+    parser.add_argument("--starts", nargs="+", type=int, default=[0], help="start nodes")
+    parser.add_argument("--random-starts", type=int, default=4, help="random start nodes to add to --starts")
+    parser.add_argument("--queries", type=int, help="number of queries to sample (default: all)")
+    parser.add_argument("--limit", type=int, default=1000)
+    parser.add_argument("--processes", type=int, help="default: the number of cores")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="report file (default: outputs/benchmark.json)")
+    args = parser.parse_args()
+
+    data_dir = Path("data") / args.embeddings
+
+    vocab = Vocabulary.from_file(data_dir / "vocab.txt")
+    query_indices = vocab.require_ids(Vocabulary.from_file(data_dir / "query.txt"))
+    gt_ids, _ = read_groundtruth(data_dir / "GT")
+    nearest_ids = gt_ids[:, 0].astype(np.int64)
+
+    vectors = fbin_to_numpy(data_dir / "base.fbin")
+
+    rng = np.random.default_rng(args.seed)
+    if args.queries is not None and args.queries < len(query_indices):
+        sample = np.sort(rng.choice(len(query_indices), args.queries, replace=False))
+        query_indices, nearest_ids = query_indices[sample], nearest_ids[sample]
+    starts = list(dict.fromkeys(args.starts + rng.choice(len(vectors), args.random_starts, replace=False).tolist()))
+
+    report = {
+        "embeddings": args.embeddings,
+        "queries": len(query_indices),
+        "limit": args.limit,
+        "seed": args.seed,
+        "starts": starts,
+        "beam_widths": args.beam_widths,
+        "graphs": {},
+    }
+
+    for graph_type in args.graph_types:
+        graph_path = data_dir / "outputs" / graph_type
+        if not graph_path.exists():
+            print(f"skipping {graph_type}: no graph in outputs/, run build_graph.py first")
+            continue
+        graph = CSRGraph.from_file(graph_path)
+        print(f"{graph_type}:")
+
+        configs = []
+        with Evaluator(graph, vectors, args.processes) as evaluator:
+            for start in starts:
+                for beam_width in args.beam_widths:
+                    config = run_config(evaluator, query_indices, nearest_ids, start, beam_width, args.limit)
+                    configs.append(config)
+                    print(f"  start {start:>7} beam {str(beam_width):>5}: compared {config['average_compared']:>8.1f}  visited {config['average_visited']:>7.1f}  recall@1 {config['recall_at_1']:.4f}  {config['queries_per_second']:>8.0f} queries/s")
+
+        curve = average_over_starts(configs)
+        report["graphs"][graph_type] = {
+            "stats": graph_stats(graph, graph_path),
+            "configs": configs,
+            "curve": curve,
+            "pareto": pareto_front(curve),
+        }
+
+    report["pareto"] = pareto_front([{"graph_type": graph_type, **point} for graph_type, entry in report["graphs"].items() for point in entry["curve"]])
+
+    print("pareto front across graph types:")
+    for point in report["pareto"]:
+        print(f"  {point['graph_type']:<12} beam {str(point['beam_width']):>5}: compared {point['average_compared']:>8.1f}  recall@1 {point['recall_at_1']:.4f}")
+
+    output = Path(args.output) if args.output else data_dir / "outputs" / "benchmark.json"
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"report written to {output}")
@@ -1,12 +1,16 @@
 from ParlayANN.python import wrapper as wp
 
 import sys
+import shutil
 from pathlib import Path
 import numpy as np
 
-from utils import graph_file_to_list_of_lists, read_vocab, fbin_to_numpy
-from beam_search import eager_beam_search, beam_search
-from tqdm import tqdm
+from utils import CSRGraph, fbin_to_numpy, Vocabulary
+from parallel_eval import evaluate
+from search_trace import TraceWriter
+from hop_distances import bfs, connectivity, write_hop_distances
+from graph_cache import GraphCache, file_digest
+from snapshot import build_snapshot
 
 GRAPH_TYPES = ["pynndescent", "vamana", "hcnng"]
 
@@ -17,8 +21,29 @@ VAMANA_PARAMS = {
     "two_pass": True
 }
 
+# passed positionally, in this order
+PYNNDESCENT_PARAMS = {
+    "max_degree": 40,
+    "num_clusters": 10,
+    "cluster_size": 100,
+    "alpha": 1.2,
+    "delta": .05
+}
+
+HCNNG_PARAMS = {
+    "max_degree": 40,
+    "num_clusters": 20,
+    "cluster_size": 1000
+}
+
+GRAPH_PARAMS = {
+    "pynndescent": {"metric": "Euclidian", **PYNNDESCENT_PARAMS},
+    "vamana": {"metric": "mips", **VAMANA_PARAMS},
+    "hcnng": {"metric": "Euclidian", **HCNNG_PARAMS},
+}
+
 if len(sys.argv) < 2:
-    print("Usage: python build_graph.py <embedding name> <graph type>")
+    print("Usage: python build_graph.py <embedding name> <graph type> [--dont-build] [--trace]")
     sys.exit(1)
     
 embeddings = sys.argv[1]
@@ -38,13 +63,22 @@ if not (data_dir / "outputs").exists():
     (data_dir / "outputs").mkdir()
     
 
-if '--dont-build' not in sys.argv:
+def build(graph_path):
     if graph_type == "pynndescent":
-        wp.build_pynndescent_index("Euclidian", "float", data_dir / "base.fbin", data_dir / "outputs" / "pynndescent", 40, 10, 100, 1.2, .05)
+        wp.build_pynndescent_index("Euclidian", "float", data_dir / "base.fbin", graph_path, *PYNNDESCENT_PARAMS.values())
     elif graph_type == "vamana":
-        wp.build_vamana_index("mips", "float", data_dir / "base.fbin", data_dir / "outputs" / "vamana", **VAMANA_PARAMS)
+        wp.build_vamana_index("mips", "float", data_dir / "base.fbin", graph_path, **VAMANA_PARAMS)
     elif graph_type == "hcnng":
-        wp.build_hcnng_index("Euclidian", "float", data_dir / "base.fbin", data_dir / "outputs" / "hcnng", 40, 20, 1000)
+        wp.build_hcnng_index("Euclidian", "float", data_dir / "base.fbin", graph_path, *HCNNG_PARAMS.values())
+
+# builds are cached by embedding contents, graph type and parameters, so rerunning with the same settings is instant
+cache = GraphCache()
+cache_key = None
+
+if '--dont-build' not in sys.argv:
+    cache_key = cache.key(data_dir / "base.fbin", graph_type, GRAPH_PARAMS[graph_type])
+    cached_graph = cache.get_or_build(cache_key, build, {"graph_type": graph_type, "params": GRAPH_PARAMS[graph_type]})
+    shutil.copyfile(cached_graph, data_dir / "outputs" / graph_type)
     
 print("Graph built. Testing recall...")
 
@@ -54,45 +88,41 @@ neighbors, distances = Index.batch_search_from_string(str(data_dir / "query.fbin
 
 Index.check_recall(str(data_dir / "query.fbin"), str(data_dir / "GT"), neighbors, 10)
 
-graph = graph_file_to_list_of_lists(data_dir / "outputs" / graph_type)
+graph = CSRGraph.from_file(data_dir / "outputs" / graph_type)
+stats = graph.degree_stats()
 
-
-print(f"{len(graph)} points")
-print(f"{sum(len(neighbors) for neighbors in graph)} edges")
-print(f"{sum(len(neighbors) for neighbors in graph) / len(graph)} average degree")
+print(f"{stats['points']} points")
+print(f"{stats['edges']} edges")
+print(f"{stats['average_degree']} average degree")
 
 print("neighbor count distribution:")
-percentiles = [0, 25, 50, 75, 90, 95, 99, 100]
-for p in percentiles:
-    print(f"{p}%: {np.percentile([len(neighbors) for neighbors in graph], p)}")
+for p, degree in stats["percentiles"].items():
+    print(f"{p}%: {degree}")
     
-_, vocab = read_vocab(data_dir / "vocab.txt")
-_, query_vocab = read_vocab(data_dir / "query.txt")
+vocab = Vocabulary.from_file(data_dir / "vocab.txt")
+query_vocab = Vocabulary.from_file(data_dir / "query.txt")
 
-query_indices = [vocab.index(word) for word in query_vocab]
+query_indices = vocab.require_ids(query_vocab).tolist()
 
 vectors = fbin_to_numpy(data_dir / "base.fbin")
 
-visited_counts = []
-compared_counts = []
-
-# print("eager beam search:")
-# for idx in tqdm(query_indices):
-#     visited, compared = eager_beam_search(graph, vectors, 0, idx)
-#     visited_counts.append(len(visited))
-#     compared_counts.append(len(compared))
-
-# print(f"average visited: {np.mean(visited_counts)}")
-# print(f"average compared: {np.mean(compared_counts)}")
-
-# visited_counts = []
-# compared_counts = []
-
 print("beam search:")
-for idx in tqdm(query_indices[:4000]):
-    visited, compared = eager_beam_search(graph, vectors, 0, idx)
-    visited_counts.append(len(visited))
-    compared_counts.append(len(compared))
+results_name = f"beam_search_{file_digest(data_dir / 'query.txt')[:16]}"
+cached_counts = cache.load_results(cache_key, results_name) if cache_key is not None else None
+if '--trace' in sys.argv:
+    trace_file = data_dir / "outputs" / f"{graph_type}_trace.bin"
+    with TraceWriter(trace_file) as trace:
+        counts = evaluate(graph, vectors, query_indices, trace=trace)
+    print(f"search trace written to {trace_file}")
+elif cached_counts is not None:
+    print("(cached)")
+    counts = {name: np.array(values) for name, values in cached_counts.items()}
+else:
+    counts = evaluate(graph, vectors, query_indices)
+if cache_key is not None:
+    cache.save_results(cache_key, results_name, {name: values.tolist() for name, values in counts.items()})
+visited_counts = counts["visited"]
+compared_counts = counts["compared"]
 
 print(f"average visited: {np.mean(visited_counts)}")
 print(f"average compared: {np.mean(compared_counts)}")
@@ -102,27 +132,24 @@ print(f"recall: {np.mean(converged)}")
 
 log_file = data_dir / "outputs" / f"{graph_type}_log.csv"
 
+# the build parameters of this graph type; the metric is fixed per type, so it isn't logged
+log_params = {name: value for name, value in GRAPH_PARAMS[graph_type].items() if name != "metric"}
+
 if not log_file.exists():
     with open(log_file, "w") as f:
-        f.write(f"visited,compared,{",".join(VAMANA_PARAMS.keys())}\n")
+        f.write(f"visited,compared,{",".join(log_params.keys())}\n")
         
 with open(log_file, "a") as f:
-    f.write(f"{np.mean(visited_counts)},{np.mean(compared_counts)},{','.join(str(value) for value in VAMANA_PARAMS.values())}\n")
+    f.write(f"{np.mean(visited_counts)},{np.mean(compared_counts)},{','.join(str(value) for value in log_params.values())}\n")
     
 # writing bfs distance of every node from the start node
-distances = [np.inf] * len(graph)
-distances[0] = 0
-
-queue = [0]
-while queue:
-    node = queue.pop(0)
-    for neighbor in graph[node]:
-        if distances[neighbor] == np.inf:
-            distances[neighbor] = distances[node] + 1
-            queue.append(neighbor)
-            
-distances = [str(distance) if distance != np.inf else "-1" for distance in distances]
-
-with open(data_dir / "outputs" / f"{graph_type}_distances.txt", "w") as f:
-    for line in distances:
-        f.write(f"{line}\n")
+distances = bfs(graph, [0])
+
+report = connectivity(distances)
+print(f"{report['reachable']} points reachable from 0 within {report['max_hops']} hops, {report['unreachable']} unreachable")
+
+write_hop_distances(data_dir / "outputs" / f"{graph_type}_distances.bin", [0], distances)
+
+# the servers load the snapshot, so it has to be rebuilt along with the graph and distances it contains
+snapshot_path = build_snapshot(data_dir, graph_type)
+print(f"snapshot written to {snapshot_path}")
@@ -1,29 +1,48 @@
-"""Construct an fbin for gensim embeddings, along with queries, vocab, and ground truth."""
-import gensim.downloader as api
+"""Construct an fbin for gensim embeddings or a local embeddings file, along with queries, vocab, and ground truth."""
 import numpy as np
 import sys
 from pathlib import Path
-import subprocess
-import re
 
-from utils import numpy_to_fbin
+from utils import numpy_to_fbin, mmap_fbin, write_groundtruth
+from groundtruth import compute_groundtruth
+from ingest import FORMATS, keyed_vectors_chunks, read_embeddings, write_embeddings
 
 def words_to_file(words, file_path):
     with open(file_path, "w") as file:
         for word in words:
             file.write(word + "\n")
             
-def is_lowercase_word(word: str) -> bool:
-    """returns true if a word consists only of lowercase letters and underscores"""
-    return re.match("^[a-z_]+$", word) is not None
+def option_value(name, default=None):
+    """value following a --name option in sys.argv"""
+    if name in sys.argv[:-1]:
+        return sys.argv[sys.argv.index(name) + 1]
+    return default
     
     
 if __name__ == "__main__":
     if len(sys.argv) < 2:
-        print("Usage: python embeddings_to_fbin.py <gensim embedding name> [crop length] [--lowercase_only]")
+        print("Usage: python embeddings_to_fbin.py <gensim embedding name | embeddings file> [crop length] [--lowercase_only] "
+              f"[--format {'|'.join(FORMATS)}] [--chunk-size rows] [--dim d]")
         sys.exit(1)
         
     embeddings = sys.argv[1]
+    embeddings_file = Path(embeddings) if Path(embeddings).is_file() else None
+    if embeddings_file is not None:
+        # strip only the known suffixes, e.g. GoogleNews-vectors-negative300.bin.gz -> GoogleNews-vectors-negative300 and
+        # glove.6B.300d.txt -> glove.6B.300d
+        name = Path(embeddings_file.name)
+        while name.suffix in (".gz", ".bin", ".txt"):
+            name = name.with_suffix("")
+        embeddings = name.name
+        
+    embeddings_format = option_value("--format")
+    if embeddings_format is not None and embeddings_format not in FORMATS:
+        print(f"Format must be one of {FORMATS}")
+        sys.exit(1)
+        
+    chunk_size = int(option_value("--chunk-size", 100_000))
+    # text files without a header get their dimension inferred otherwise
+    dim = int(option_value("--dim")) if option_value("--dim") is not None else None
     
     if len(sys.argv) > 2 and sys.argv[2].isdigit():
         crop_length = int(sys.argv[2])
@@ -47,46 +66,33 @@ if __name__ == "__main__":
     
     download_dir.mkdir(parents=True, exist_ok=True)
     
-    print(f"Downloading {embeddings}...")
-    model = api.load(embeddings)
-    vectors = model.vectors
-    vocab = model.index_to_key
-    
-    # crop then lowercase; not necessarily the best order
-    if crop_length is not None:
-        print(f"Cropping to {crop_length} words...")
-        vectors = vectors[:crop_length]
-        vocab = vocab[:crop_length]
-    
-    if lowercase:
-        print("Filtering to lowercase words...")
-        lowercase_indices = [i for i, word in enumerate(vocab) if is_lowercase_word(word)]
-        vectors = vectors[lowercase_indices]
-        vocab = [vocab[i] for i in lowercase_indices]
+    if embeddings_file is not None:
+        print(f"Reading {embeddings_file}...")
+        chunks = read_embeddings(embeddings_file, embeddings_format, chunk_size, dim)
+    else:
+        import gensim.downloader as api
+        print(f"Downloading {embeddings}...")
+        chunks = keyed_vectors_chunks(api.load(embeddings), chunk_size)
         
-    # move the exclusion list words to the end of the list
+    # the exclusion list words are moved to the end of the list
     with open("exclusion_list.txt") as f:
         exclusion_list = set(f.read().split())
-        
-    exclusion_indices = [i for i, word in enumerate(vocab) if word in exclusion_list]
-    permuted_indices = np.concatenate([np.delete(np.arange(len(vocab)), exclusion_indices), exclusion_indices])
-    
-    vectors = vectors[permuted_indices]
-    vocab = [vocab[i] for i in permuted_indices]
-        
-    # normalize vectors
-    vectors /= np.linalg.norm(vectors, axis=1)[:, None]
     
+    # crops, filters, normalizes and writes a chunk at a time
     print("Saving embeddings...")
-    numpy_to_fbin(vectors, download_dir / "base.fbin")
-    words_to_file(vocab, download_dir / "vocab.txt")
+    n = write_embeddings(chunks, download_dir, crop_length, lowercase, exclusion_list)
+    print(f"Saved {n} words")
+    
+    vectors = mmap_fbin(download_dir / "base.fbin")
     
-    nq = 5000
+    nq = min(5000, n)
     print(f"Saving {nq} queries...")
-    query_indices = np.random.choice(len(vocab), nq, replace=False)
+    query_indices = np.random.choice(n, nq, replace=False)
     query_indices.sort()
     
-    query_words = [vocab[i] for i in query_indices]
+    selected = set(query_indices.tolist())
+    with open(download_dir / "vocab.txt") as f:
+        query_words = [line.rstrip("\n") for i, line in enumerate(f) if i in selected]
     query_vectors = vectors[query_indices]
     
     numpy_to_fbin(query_vectors, download_dir / "query.fbin")
@@ -94,15 +100,5 @@ if __name__ == "__main__":
     
     print("Computing (and saving) ground truth...")
     
-    if not Path("ParlayANN/data_tools/compute_groundtruth").exists():
-        print("Please compile ParlayANN/data_tools/compute_groundtruth (run make in ParlayANN/data_tools/)")
-        sys.exit()
-    
-    subprocess.run(["ParlayANN/data_tools/compute_groundtruth",
-                    "-base_path", download_dir / "base.fbin",
-                    "-query_path", download_dir / "query.fbin",
-                    "-gt_path", download_dir / "GT",
-                    "-k", "100",
-                    "-dist_func", "mips",
-                    "-data_type", "float"])
-    
\ No newline at end of file
+    ids, distances = compute_groundtruth(vectors, query_vectors, k=100)
+    write_groundtruth(ids, distances, download_dir / "GT")
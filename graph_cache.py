@@ -0,0 +1,130 @@
+"""content-addressed cache of built graphs and their evaluation results
+
+an entry is keyed by a hash of the embedding file's contents, the graph type and the build parameters, and lives in
+its own directory under the cache root: the graph file, meta.json describing the build, and any number of named
+evaluation results as json. builds happen in a private temporary directory that is renamed into place when done, so
+concurrent builds never see each other's partial files. entries are evicted least recently used first once the cache
+grows past max_bytes.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+DEFAULT_CACHE_DIR = Path("data") / "graph_cache"
+
+# file digests keyed by (path, size, mtime), so a process hashes each embedding file once
+_digests = {}
+
+
+def file_digest(path):
+    """sha256 of a file's contents"""
+    stat = os.stat(path)
+    memo_key = (str(path), stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _digests:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(2**20), b""):
+                digest.update(block)
+        _digests[memo_key] = digest.hexdigest()
+    return _digests[memo_key]
+
+
+class GraphCache:
+    """directory of graph builds addressed by what they were built from"""
+
+    GRAPH_FILE = "graph"
+    META_FILE = "meta.json"
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=4 * 2**30):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def key(self, base_path, graph_type, params):
+        """hash of the embedding file contents, graph type and build parameters"""
+        description = json.dumps({"base": file_digest(base_path), "graph_type": graph_type, "params": params}, sort_keys=True)
+        return hashlib.sha256(description.encode()).hexdigest()[:32]
+
+    def entry_dir(self, key):
+        return self.cache_dir / key
+
+    def graph_path(self, key):
+        return self.entry_dir(key) / self.GRAPH_FILE
+
+    def __contains__(self, key):
+        return (self.entry_dir(key) / self.META_FILE).exists()
+
+    def get_or_build(self, key, build, meta=None):
+        """returns the graph file for key, calling build(graph_path) to create it first if it isn't cached
+
+        meta is stored alongside the graph (e.g. the graph type and parameters) to make the cache browsable"""
+        if key in self:
+            self._touch(key)
+            return self.graph_path(key)
+
+        build_dir = Path(tempfile.mkdtemp(prefix=f".{key}-", dir=self.cache_dir))
+        try:
+            start = time.time()
+            build(build_dir / self.GRAPH_FILE)
+            with open(build_dir / self.META_FILE, "w") as f:
+                json.dump({"key": key, "build_seconds": time.time() - start, **(meta or {})}, f, indent=2)
+            try:
+                os.rename(build_dir, self.entry_dir(key))
+            except OSError:
+                # another process finished the same build first; theirs is just as good
+                if key not in self:
+                    raise
+        finally:
+            shutil.rmtree(build_dir, ignore_errors=True)
+
+        self.evict(keep=key)
+        return self.graph_path(key)
+
+    def load_results(self, key, name):
+        """evaluation results saved under name for the graph at key, or None"""
+        path = self.entry_dir(key) / f"{name}.json"
+        if not path.exists():
+            return None
+        self._touch(key)
+        with open(path) as f:
+            return json.load(f)
+
+    def save_results(self, key, name, results):
+        if key not in self:
+            return
+        path = self.entry_dir(key) / f"{name}.json"
+        temporary = path.with_name(f".{path.name}.{os.getpid()}")
+        with open(temporary, "w") as f:
+            json.dump(results, f)
+        os.replace(temporary, path)
+
+    def _touch(self, key):
+        os.utime(self.entry_dir(key) / self.META_FILE)
+
+    def entries(self):
+        """(key, size in bytes, last used time) of every complete entry"""
+        entries = []
+        for entry in self.cache_dir.iterdir():
+            meta = entry / self.META_FILE
+            if entry.name.startswith(".") or not meta.exists():
+                continue
+            size = sum(file.stat().st_size for file in entry.iterdir())
+            entries.append((entry.name, size, meta.stat().st_mtime))
+        return entries
+
+    def evict(self, keep=None):
+        """removes least recently used entries until the cache fits in max_bytes, never removing keep"""
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        for key, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+            total -= size
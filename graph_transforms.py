@@ -0,0 +1,108 @@
+"""post-processing of built graphs, vectorized over the flat edge arrays of a csr graph
+
+every transform takes a CSRGraph and returns a new one without a python loop over points: edges are handled as
+parallel (source, target) arrays, reordered with one sort and regrouped by source with CSRGraph.from_edges, so the
+cost is a few passes over the edges even on multi-million point graphs. transforms keep the order of neighbors within
+a point, so sorting by length before capping the degree keeps the shortest edges.
+
+Usage: python graph_transforms.py <embedding name> <graph type> <output name> [--symmetrize] [--sort]
+    [--max-degree R] [--long-range K] [--connect] [--entry 0]
+"""
+
+import argparse
+import json
+import time
+import numpy as np
+from pathlib import Path
+from utils import CSRGraph, mmap_fbin, sort_neighbors_by_distance
+from hop_distances import bfs, connectivity
+
+
+def add_edges(graph, sources, targets):
+    """the graph with extra edges appended to their sources' neighborhoods, skipping self loops and edges that
+    already exist"""
+    n = len(graph)
+    sources = np.concatenate([graph.sources(), np.asarray(sources, dtype=np.int32)]).astype(np.int64)
+    targets = np.concatenate([graph.neighbors, np.asarray(targets, dtype=np.int32)]).astype(np.int64)
+    # first occurrence of every (source, target) pair, in the original order
+    _, first = np.unique(sources * n + targets, return_index=True)
+    keep = np.sort(first)
+    keep = keep[sources[keep] != targets[keep]]
+    return CSRGraph.from_edges(sources[keep], targets[keep], n)
+
+
+def symmetrize(graph):
+    """adds the reverse of every edge, so that every point links back to the points that link to it"""
+    return add_edges(graph, graph.neighbors, graph.sources())
+
+
+def cap_degree(graph, max_degree):
+    """keeps the first max_degree neighbors of every point"""
+    positions = np.arange(graph.num_edges) - np.repeat(graph.offsets[:-1], graph.degrees)
+    keep = positions < max_degree
+    return CSRGraph.from_edges(graph.sources()[keep], graph.neighbors[keep], len(graph))
+
+
+def add_long_range_edges(graph, per_point, seed=0):
+    """adds per_point edges from every point to uniformly random points, the shortcuts of a small world graph"""
+    rng = np.random.default_rng(seed)
+    sources = np.repeat(np.arange(len(graph), dtype=np.int32), per_point)
+    return add_edges(graph, sources, rng.integers(0, len(graph), len(sources), dtype=np.int32))
+
+
+def connect_from_entry(graph, entry=0):
+    """adds edges from entry until every point is reachable from it, one per unreachable component that no
+    reachable point links into"""
+    reachable = bfs(graph, [entry]) >= 0
+    sources = graph.sources()
+    added = []
+    while not reachable.all():
+        # roots: unreachable points that no other unreachable point links to; a cycle without one gets its first point
+        linked = np.zeros(len(graph), dtype=bool)
+        linked[graph.neighbors[~reachable[sources]]] = True
+        roots = np.flatnonzero(~reachable & ~linked)
+        if not len(roots):
+            roots = np.flatnonzero(~reachable)[:1]
+        added.append(roots)
+        reachable |= bfs(graph, roots) >= 0
+    if not added:
+        return graph
+    roots = np.concatenate(added)
+    return add_edges(graph, np.full(len(roots), entry, dtype=np.int32), roots)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="write a post-processed variant of a built graph")
+    parser.add_argument("embeddings")
+    parser.add_argument("graph_type")
+    parser.add_argument("output", help="name of the variant, written to outputs/<output>")
+    parser.add_argument("--symmetrize", action="store_true", help="add the reverse of every edge")
+    parser.add_argument("--sort", action="store_true", help="sort neighbors by edge length (implied by --max-degree)")
+    parser.add_argument("--max-degree", type=int, help="keep only the shortest edges of every point")
+    parser.add_argument("--long-range", type=int, default=0, metavar="K", help="random edges to add per point")
+    parser.add_argument("--connect", action="store_true", help="add edges from the entry point to unreachable points")
+    parser.add_argument("--entry", type=int, default=0, help="entry point of beam search")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    data_dir = Path("data") / args.embeddings
+    graph = CSRGraph.from_file(data_dir / "outputs" / args.graph_type)
+
+    start = time.time()
+    if args.symmetrize:
+        graph = symmetrize(graph)
+    if args.sort or args.max_degree is not None:
+        graph = sort_neighbors_by_distance(graph, mmap_fbin(data_dir / "base.fbin"))
+    if args.max_degree is not None:
+        graph = cap_degree(graph, args.max_degree)
+    if args.long_range:
+        graph = add_long_range_edges(graph, args.long_range, args.seed)
+    if args.connect:
+        graph = connect_from_entry(graph, args.entry)
+    print(f"transformed in {time.time() - start:.2f} seconds")
+
+    graph.to_file(data_dir / "outputs" / args.output)
+    stats = graph.degree_stats()
+    print(f"{stats['points']} points, {stats['edges']} edges, {stats['average_degree']:.2f} average degree")
+    report = connectivity(bfs(graph, [args.entry]))
+    print(json.dumps({key: report[key] for key in ["reachable", "unreachable", "max_hops", "mean_hops"]}))
@@ -0,0 +1,83 @@
+"""exact maximum inner product ground truth, written in the parlay GT format
+
+queries are split into blocks. each query block walks the base vectors a block at a time, scoring them with one
+matmul and keeping a running top k with argpartition, so memory is bounded by the block sizes rather than the number
+of base vectors. the matmuls are already spread over the cores by blas, so blocks run one at a time by default;
+threads > 1 runs blocks on a thread pool (numpy releases the gil inside matmul), which only pays off with blas limited
+to one thread (e.g. OPENBLAS_NUM_THREADS=1), since otherwise every pool thread starts a full set of blas threads.
+distances are negated inner products, as parlay's compute_groundtruth writes them for mips.
+
+Usage: python groundtruth.py <embedding name> [k] [threads]
+"""
+
+import sys
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from utils import mmap_fbin, fbin_to_numpy, write_groundtruth
+
+# a query block's score matrix is query_block x base_block float32s; 256 x 16384 is 16 MiB, which keeps the working
+# set of every thread in the last level cache's neighborhood without making the matmuls too small to be efficient
+QUERY_BLOCK = 256
+BASE_BLOCK = 16384
+
+
+def _top_k_block(base, queries, k, base_block):
+    """exact top k (by inner product, best first) of every query against all of base"""
+    best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+    best_ids = np.zeros((len(queries), 0), dtype=np.int64)
+    rows = np.arange(len(queries))[:, None]
+    for start in range(0, len(base), base_block):
+        scores = np.dot(queries, base[start:start + base_block].T)
+        ids = np.broadcast_to(np.arange(start, start + scores.shape[1]), scores.shape)
+        scores = np.concatenate([best_scores, scores], axis=1)
+        ids = np.concatenate([best_ids, ids], axis=1)
+        if scores.shape[1] > k:
+            keep = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            scores, ids = scores[rows, keep], ids[rows, keep]
+        best_scores, best_ids = scores, ids
+    # best first, ties broken by the smaller id
+    order = np.lexsort((best_ids, -best_scores), axis=1)
+    return best_ids[rows, order], best_scores[rows, order]
+
+
+def compute_groundtruth(base, queries, k=100, query_block=QUERY_BLOCK, base_block=BASE_BLOCK, threads=1):
+    """returns (ids, distances) of the k base vectors with the largest inner product with each query, best first,
+    with distances as negated inner products; threads is the number of query blocks run at once"""
+    k = min(k, len(base))
+    ids = np.empty((len(queries), k), dtype=np.int32)
+    distances = np.empty((len(queries), k), dtype=np.float32)
+
+    def run(start):
+        block_ids, block_scores = _top_k_block(base, np.asarray(queries[start:start + query_block], dtype=np.float32), k, base_block)
+        ids[start:start + len(block_ids)] = block_ids
+        distances[start:start + len(block_ids)] = -block_scores
+
+    starts = range(0, len(queries), query_block)
+    if threads == 1:
+        for start in starts:
+            run(start)
+    else:
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(run, starts))
+
+    return ids, distances
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python groundtruth.py <embedding name> [k] [threads]")
+        sys.exit(1)
+
+    data_dir = Path("data") / sys.argv[1]
+    k = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    threads = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+
+    base = mmap_fbin(data_dir / "base.fbin")
+    queries = fbin_to_numpy(data_dir / "query.fbin")
+
+    start = time.time()
+    ids, distances = compute_groundtruth(base, queries, k, threads=threads)
+    write_groundtruth(ids, distances, data_dir / "GT")
+    print(f"computed top {k} of {len(queries)} queries over {len(base)} points in {time.time() - start:.2f} seconds")
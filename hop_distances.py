@@ -0,0 +1,148 @@
+"""hop distances over csr graphs, computed a bfs frontier at a time
+
+bfs expands the whole frontier with one gather over the csr arrays per level, so the python work is per level rather
+than per node; neighborhood does the same for k-hop queries over any mix of a graph and its reverse. distances are -1
+for unreachable points. hop distance files hold one row per start node: int32 header [rows, n, bytes per distance],
+int32 start nodes, then int16 (when every distance fits) or int32 distances.
+
+Usage: python hop_distances.py <embedding name> <graph type> [start ...] [--multi-source]
+writes outputs/<graph type>_distances_<starts>.bin (or _distances_multi_<starts>.bin), never the served _distances.bin
+"""
+
+import json
+import sys
+import numpy as np
+from pathlib import Path
+from utils import CSRGraph
+
+
+def frontier_neighbors(graph, frontier):
+    """the out neighbors of every node in frontier, concatenated"""
+    starts = graph.offsets[frontier]
+    degrees = graph.offsets[frontier + 1] - starts
+    positions = np.arange(degrees.sum()) + np.repeat(starts - (np.cumsum(degrees) - degrees), degrees)
+    return graph.neighbors[positions]
+
+
+def bfs(graph, sources, max_hops=None):
+    """hop distance from the nearest of sources to every point, -1 where unreachable (or beyond max_hops)"""
+    distances = np.full(len(graph), -1, dtype=np.int32)
+    frontier = np.unique(np.asarray(sources, dtype=np.int64))
+    distances[frontier] = 0
+    hops = 0
+    while len(frontier) and (max_hops is None or hops < max_hops):
+        hops += 1
+        neighbors = frontier_neighbors(graph, frontier)
+        frontier = np.unique(neighbors[distances[neighbors] < 0]).astype(np.int64)
+        distances[frontier] = hops
+    return distances
+
+
+def first_occurrences(values):
+    """values without repeats, in the order they first appear"""
+    _, first = np.unique(values, return_index=True)
+    return values[np.sort(first)]
+
+
+def neighborhood(graphs, sources, max_hops, max_points=None):
+    """points within max_hops of sources along the edges of any of graphs (e.g. a graph and its reverse, to ignore
+    edge direction), as (points, hops) arrays cut off after max_points points. points are ordered by hop and then in
+    the order they were reached: by the previous hop's points, then by graph, then in edge order, so the first hop
+    from one source lists its neighbors as the graph stores them"""
+    visited = np.zeros(len(graphs[0]), dtype=bool)
+    frontier = first_occurrences(np.asarray(sources, dtype=np.int64))
+    visited[frontier] = True
+    levels = [frontier]
+    found = len(frontier)
+    while len(frontier) and len(levels) <= max_hops and (max_points is None or found < max_points):
+        neighbors = np.concatenate([frontier_neighbors(graph, frontier) for graph in graphs])
+        frontier = first_occurrences(neighbors[~visited[neighbors]]).astype(np.int64)
+        visited[frontier] = True
+        levels.append(frontier)
+        found += len(frontier)
+    points = np.concatenate(levels)[:max_points]
+    hops = np.repeat(np.arange(len(levels), dtype=np.int32), [len(level) for level in levels])[:max_points]
+    return points, hops
+
+
+def hop_distances(graph, starts, max_hops=None):
+    """one bfs per start node, as a (len(starts), n) array"""
+    return np.stack([bfs(graph, [start], max_hops) for start in starts]) if len(starts) else np.zeros((0, len(graph)), dtype=np.int32)
+
+
+def connectivity(distances, sample=20):
+    """reachability summary of one row of hop distances"""
+    reachable = distances >= 0
+    unreachable = np.flatnonzero(~reachable)
+    return {
+        "points": len(distances),
+        "reachable": int(reachable.sum()),
+        "unreachable": len(unreachable),
+        "unreachable_sample": unreachable[:sample].tolist(),
+        "max_hops": int(distances.max()) if reachable.any() else -1,
+        "mean_hops": float(distances[reachable].mean()) if reachable.any() else 0.0,
+        "points_per_hop": np.bincount(distances[reachable]).tolist(),
+    }
+
+
+def write_hop_distances(distances_path, starts, distances):
+    """writes hop distances, one row per start, as int16 if they fit and int32 otherwise"""
+    distances = np.atleast_2d(distances)
+    dtype = np.int16 if distances.max(initial=0) < np.iinfo(np.int16).max else np.int32
+    with open(distances_path, "wb") as f:
+        np.array([distances.shape[0], distances.shape[1], np.dtype(dtype).itemsize], dtype=np.int32).tofile(f)
+        np.asarray(starts, dtype=np.int32).tofile(f)
+        distances.astype(dtype).tofile(f)
+
+
+def read_hop_distances(distances_path, mmap=False):
+    """reads a file written by write_hop_distances, returning (starts, distances)"""
+    with open(distances_path, "rb") as f:
+        rows, n, itemsize = np.fromfile(f, dtype=np.int32, count=3)
+        starts = np.fromfile(f, dtype=np.int32, count=rows)
+        dtype = {2: np.int16, 4: np.int32}[int(itemsize)]
+        if not mmap:
+            return starts, np.fromfile(f, dtype=dtype, count=rows * n).reshape(rows, n)
+    offset = 4 * (3 + int(rows))
+    return starts, np.asarray(np.memmap(distances_path, dtype=dtype, mode="r", offset=offset, shape=(rows, n)))
+
+
+def load_bfs_distances(data_dir, graph_type):
+    """hop distances from the first start node in outputs/<graph_type>_distances.bin, as int32
+
+    falls back to the text file older builds wrote, with one distance per line"""
+    outputs = Path(data_dir) / "outputs"
+    if (outputs / f"{graph_type}_distances.bin").exists():
+        _, distances = read_hop_distances(outputs / f"{graph_type}_distances.bin")
+        return distances[0].astype(np.int32)
+    return np.loadtxt(outputs / f"{graph_type}_distances.txt", dtype=np.int32, ndmin=1)
+
+
+if __name__ == "__main__":
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    if len(args) < 2:
+        print("Usage: python hop_distances.py <embedding name> <graph type> [start ...] [--multi-source]")
+        sys.exit(1)
+
+    data_dir = Path("data") / args[0]
+    graph_type = args[1]
+    starts = [int(start) for start in args[2:]] or [0]
+
+    graph = CSRGraph.from_file(data_dir / "outputs" / graph_type, mmap=True)
+
+    # outputs/<graph type>_distances.bin is what the api serves (from start 0, written by build_graph.py), so runs here
+    # go to their own files named after their starts
+    starts_name = "-".join(str(start) for start in starts)
+    if "--multi-source" in sys.argv:
+        distances = bfs(graph, starts)
+        print(json.dumps({"sources": starts, **connectivity(distances)}, indent=2))
+        # one row from all the sources, which the start column marks with -1
+        distances_path = data_dir / "outputs" / f"{graph_type}_distances_multi_{starts_name}.bin"
+        write_hop_distances(distances_path, [-1], distances)
+    else:
+        distances = hop_distances(graph, starts)
+        for start, row in zip(starts, distances):
+            print(json.dumps({"start": start, **connectivity(row)}))
+        distances_path = data_dir / "outputs" / f"{graph_type}_distances_{starts_name}.bin"
+        write_hop_distances(distances_path, starts, distances)
+    print(f"distances written to {distances_path}")
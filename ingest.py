@@ -0,0 +1,206 @@
+"""streaming ingestion of word embeddings into base.fbin and vocab.txt
+
+readers yield (words, vectors) chunks of at most chunk_size rows from word2vec binary, word2vec text or GloVe files
+(optionally gzipped) or from an already loaded gensim model, and write_embeddings filters, normalizes and writes them
+chunk by chunk, so memory is bounded by the chunk size rather than the size of the embeddings.
+"""
+
+import gzip
+import itertools
+import re
+import numpy as np
+from pathlib import Path
+from utils import FbinWriter
+
+FORMATS = ["word2vec-bin", "word2vec-text", "glove"]
+
+# bytes read from binary files at a time
+READ_SIZE = 2**22
+
+# lines of a headerless text file its dimension is inferred from
+DIM_SAMPLE_LINES = 100
+
+
+def _open(path):
+    path = Path(path)
+    return gzip.open(path, "rb") if path.suffix == ".gz" else open(path, "rb")
+
+
+def detect_format(path):
+    """guesses the format of an embeddings file from its name and first line"""
+    name = Path(path).name.removesuffix(".gz")
+    if name.endswith(".bin"):
+        return "word2vec-bin"
+    with _open(path) as f:
+        first_line = f.readline().split()
+    if len(first_line) == 2 and all(field.isdigit() for field in first_line):
+        return "word2vec-text"
+    return "glove"
+
+
+def read_word2vec_binary(path, chunk_size=100_000):
+    """yields chunks of the word2vec binary format: a "count dim" header line, then per word the word, a space and dim
+    little-endian float32s, optionally followed by a newline"""
+    with _open(path) as f:
+        count, d = (int(field) for field in f.readline().split())
+        record_size = 4 * d
+        buffer = b""
+        position = 0
+        words = []
+        vectors = np.empty((min(chunk_size, count), d), dtype=np.float32)
+        for _ in range(count):
+            # refill until the buffer holds the whole record
+            while True:
+                end = buffer.find(b" ", position)
+                if end != -1 and len(buffer) >= end + 1 + record_size:
+                    break
+                more = f.read(READ_SIZE)
+                if not more:
+                    raise ValueError(f"{path} ends in the middle of a record")
+                buffer = buffer[position:] + more
+                position = 0
+            # records may be separated by newlines
+            words.append(buffer[position:end].lstrip(b"\n").decode("utf-8", errors="replace"))
+            vectors[len(words) - 1] = np.frombuffer(buffer, dtype="<f4", count=d, offset=end + 1)
+            position = end + 1 + record_size
+            if len(words) == len(vectors):
+                yield words, vectors.copy()
+                words = []
+        if words:
+            yield words, vectors[:len(words)].copy()
+
+
+def read_text_embeddings(path, chunk_size=100_000, header=None, dim=None):
+    """yields chunks of a text format with one "word v1 v2 ..." line per word; word2vec text files start with a
+    "count dim" header line, GloVe files don't (header=None detects it). without a header or dim, the dimension is
+    inferred from the first lines (see infer_dimension)"""
+    with _open(path) as f:
+        lines = iter(f)
+        first_line = next(lines, b"")
+        fields = first_line.split()
+        is_header = len(fields) == 2 and all(field.isdigit() for field in fields) if header is None else header
+        if is_header:
+            dim = dim or int(fields[1])
+        else:
+            lines = itertools.chain([first_line], lines)
+        if dim is None:
+            sample = list(itertools.islice(lines, DIM_SAMPLE_LINES))
+            dim = infer_dimension(sample)
+            lines = itertools.chain(sample, lines)
+
+        words = []
+        values = []
+        for line in lines:
+            line = line.rstrip()
+            if not line:
+                continue
+            # split from the right, since some GloVe vocabularies have words containing spaces
+            fields = line.rsplit(b" ", dim)
+            if len(fields) <= dim:
+                raise ValueError(f"{path}: expected a word and {dim} values, got {line[:80]!r}")
+            words.append(fields[0].decode("utf-8", errors="replace"))
+            values.append(b" ".join(fields[1:]))
+            if len(words) == chunk_size:
+                yield words, _parse_values(values, dim)
+                words = []
+                values = []
+        if words:
+            yield words, _parse_values(values, dim)
+
+
+def _trailing_floats(fields):
+    count = 0
+    for field in reversed(fields):
+        try:
+            float(field)
+        except ValueError:
+            break
+        count += 1
+    return count
+
+
+def infer_dimension(lines):
+    """the dimension of "word v1 v2 ..." lines: the most common number of trailing fields that parse as floats, so
+    that words containing spaces (GloVe 840B has some) or looking like numbers, and malformed lines, don't decide it"""
+    counts = [_trailing_floats(line.split()) for line in lines if line.strip()]
+    if counts:
+        values, occurrences = np.unique(counts, return_counts=True)
+        # the smaller count on ties
+        dim = int(values[np.argmax(occurrences)])
+        if dim > 0:
+            return dim
+    raise ValueError("could not infer the dimension of the embeddings, pass it explicitly")
+
+
+def _parse_values(lines, d):
+    return np.array(b" ".join(lines).split(), dtype=np.float32).reshape(len(lines), d)
+
+
+def read_embeddings(path, format=None, chunk_size=100_000, dim=None):
+    """yields (words, vectors) chunks from an embeddings file in any of FORMATS; dim overrides the dimension of text
+    files"""
+    format = format or detect_format(path)
+    if format == "word2vec-bin":
+        return read_word2vec_binary(path, chunk_size)
+    return read_text_embeddings(path, chunk_size, header=format == "word2vec-text", dim=dim)
+
+
+def keyed_vectors_chunks(model, chunk_size=100_000):
+    """yields (words, vectors) chunks of a loaded gensim KeyedVectors model"""
+    for start in range(0, len(model.index_to_key), chunk_size):
+        yield model.index_to_key[start:start + chunk_size], model.vectors[start:start + chunk_size]
+
+
+def is_lowercase_word(word: str) -> bool:
+    """returns true if a word consists only of lowercase letters and underscores"""
+    return re.match("^[a-z_]+$", word) is not None
+
+
+def write_embeddings(chunks, out_dir, crop_length=None, lowercase=False, exclusion_list=()):
+    """crops to the first crop_length words, keeps lowercase words if lowercase is set, moves words in exclusion_list
+    to the end, normalizes, and writes out_dir/base.fbin and out_dir/vocab.txt; returns the number of words written
+
+    only the excluded words are held until the end, everything else is written chunk by chunk"""
+    out_dir = Path(out_dir)
+    exclusion_list = set(exclusion_list)
+    excluded_words = []
+    excluded_vectors = []
+    seen = 0
+    writer = None
+
+    with open(out_dir / "vocab.txt", "w") as vocab_file:
+        for words, vectors in chunks:
+            # crop then lowercase; not necessarily the best order
+            if crop_length is not None:
+                if seen >= crop_length:
+                    break
+                words, vectors = words[:crop_length - seen], vectors[:crop_length - seen]
+            seen += len(words)
+
+            keep = np.array([not lowercase or is_lowercase_word(word) for word in words], dtype=bool)
+            exclude = np.array([word in exclusion_list for word in words], dtype=bool) & keep
+            keep &= ~exclude
+
+            vectors = np.asarray(vectors, dtype=np.float32)
+            if writer is None:
+                writer = FbinWriter(out_dir / "base.fbin", vectors.shape[1])
+            writer.append(_normalize(vectors[keep]))
+            vocab_file.writelines(word + "\n" for word, kept in zip(words, keep) if kept)
+
+            excluded_words.extend(word for word, excluded in zip(words, exclude) if excluded)
+            excluded_vectors.append(_normalize(vectors[exclude]))
+
+        if writer is None:
+            raise ValueError("no embeddings to write")
+
+        # the exclusion list words go at the end of the vocab
+        for vectors in excluded_vectors:
+            writer.append(vectors)
+        vocab_file.writelines(word + "\n" for word in excluded_words)
+        writer.close()
+
+    return writer.n
+
+
+def _normalize(vectors):
+    return vectors / np.linalg.norm(vectors, axis=1)[:, None]
@@ -0,0 +1,283 @@
+"""replayable load test for the similarity api
+
+plays game sessions the way semantle_frontend.html does (startGame, then guesses, then neighbor prefetches) from a
+pool of concurrent players, against the flask app in-process or a running server, and reports throughput, latency
+percentiles per endpoint and server memory as json. both clients ask for gzip like a browser does, and the bytes
+reported per endpoint are the response bodies as sent, before decompression.
+
+sessions are generated from --seed; --save-sessions writes every request that was sent so that exactly the same
+traffic can be replayed later with --replay.
+
+Usage: python load_test.py [--url http://127.0.0.1:8000 | --in-process] [--sessions 200] [--concurrency 16]
+                           [--guesses 20] [--legacy] [--server-pid PID] [--output report.json]
+"""
+
+import argparse
+import contextlib
+import gzip
+import http.client
+import json
+import os
+import random
+import sys
+import threading
+import time
+import numpy as np
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+
+# what a browser sends, so that responses are compressed as they would be for the frontend
+REQUEST_HEADERS = {"Accept-Encoding": "gzip"}
+
+
+def decode_body(data, content_type, content_encoding):
+    """the parsed json of a response body as sent, or None if it isn't json"""
+    if content_encoding == "gzip":
+        data = gzip.decompress(data)
+    return json.loads(data) if (content_type or "").startswith("application/json") else None
+
+
+class HTTPClient:
+    """one keep-alive connection per thread to a running server"""
+
+    def __init__(self, url):
+        parsed = urlparse(url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self._local = threading.local()
+
+    def _connection(self):
+        if not hasattr(self._local, "connection"):
+            self._local.connection = http.client.HTTPConnection(self.host, self.port, timeout=30)
+        return self._local.connection
+
+    def request(self, method, path, body=None):
+        """returns (status, parsed json or None, response body size in bytes as sent)"""
+        headers = dict(REQUEST_HEADERS)
+        payload = None
+        if body is not None:
+            payload = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+        connection = self._connection()
+        try:
+            connection.request(method, path, payload, headers)
+            response = connection.getresponse()
+            data = response.read()
+        except (http.client.HTTPException, OSError):
+            connection.close()
+            del self._local.connection
+            raise
+        return response.status, decode_body(data, response.getheader("Content-Type"), response.getheader("Content-Encoding")), len(data)
+
+
+class InProcessClient:
+    """drives the flask app through its test client, with no network in between"""
+
+    def __init__(self):
+        # keep the api's startup prints out of the json report
+        with contextlib.redirect_stdout(sys.stderr):
+            import similarity_api
+        self.app = similarity_api.app
+        self._local = threading.local()
+
+    def request(self, method, path, body=None):
+        if not hasattr(self._local, "client"):
+            self._local.client = self.app.test_client()
+        response = self._local.client.open(path, method=method, json=body, headers=REQUEST_HEADERS)
+        data = response.get_data()
+        try:
+            parsed = decode_body(data, response.content_type, response.content_encoding)
+        except ValueError:
+            parsed = None
+        return response.status_code, parsed, len(data)
+
+
+class Recorder:
+    """collects per-endpoint latencies and errors from every player thread"""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.bytes = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def timed(self, client, method, path, body=None):
+        start = time.perf_counter()
+        try:
+            status, data, size = client.request(method, path, body)
+        except Exception:
+            status, data, size = None, None, 0
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.latencies[path].append(elapsed)
+            self.bytes[path] += size
+            if status != 200:
+                self.errors[path] += 1
+        return data if status == 200 else None
+
+
+def play_session(client, recorder, vocab, rng, num_guesses, legacy, log):
+    """one player: start a game, then guess, mostly following the neighbors of their best guess so far"""
+
+    def send(method, path, body=None):
+        log.append([method, path, body])
+        return recorder.timed(client, method, path, body)
+
+    send("GET", "/get_vocab_and_distances")
+    target = rng.choice(vocab)
+    top_k = send("POST", "/top_k", {"word": target, "k": 1001})
+    top_words = top_k["top_words"] if top_k else []
+    send("POST", "/similarity", {"word1": [target], "word2": [top_words[i] for i in (1, 100, 1000) if i < len(top_words)]})
+
+    best, best_similarity = None, -np.inf
+    neighbors = {}
+    for _ in range(num_guesses):
+        if best is not None and neighbors.get(best) and rng.random() < 0.7:
+            guess = rng.choice(neighbors[best])
+        else:
+            guess = rng.choice(vocab)
+
+        if legacy:
+            # the request fan-out of the frontend before /guess existed
+            result = send("POST", "/similarity", {"word1": [target], "word2": [guess]})
+            similarity = result["similarities"][0][0] if result else -np.inf
+            send("POST", "/top_k", {"word": guess, "k": 1000})
+            result = send("POST", "/neighbors", {"word": guess})
+            neighbors[guess] = result["neighbors"] if result else []
+            if neighbors[guess]:
+                send("POST", "/similarity", {"word1": [target], "word2": neighbors[guess]})
+        else:
+            result = send("POST", "/guess", {"target": target, "guess": guess})
+            similarity = result["similarity"] if result else -np.inf
+            neighbors[guess] = result["neighbors"] if result else []
+
+        if similarity > best_similarity:
+            best, best_similarity = guess, similarity
+        if guess == target:
+            break
+
+
+def replay_session(client, recorder, requests):
+    for method, path, body in requests:
+        recorder.timed(client, method, path, body)
+
+
+def process_memory(pid):
+    """resident and proportional set size of a process in bytes; pss splits shared pages between the processes mapping them"""
+    memory = {"pid": pid}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in ("Rss", "Pss", "Shared_Clean", "Private_Dirty"):
+                    memory[key.lower() + "_bytes"] = int(value.split()[0]) * 1024
+    except OSError:
+        pass
+    return memory
+
+
+def server_memory(pid):
+    """memory of a server process and its direct children, e.g. a gunicorn master and its workers"""
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            pids += [int(child) for child in f.read().split()]
+    except OSError:
+        pass
+    return [process_memory(p) for p in pids]
+
+
+def summarize(recorder, wall_time):
+    endpoints = {}
+    for path, latencies in sorted(recorder.latencies.items()):
+        latencies = np.array(latencies) * 1000
+        endpoints[path] = {
+            "requests": len(latencies),
+            "errors": recorder.errors[path],
+            "throughput_rps": len(latencies) / wall_time,
+            "mean_ms": float(latencies.mean()),
+            "p50_ms": float(np.percentile(latencies, 50)),
+            "p95_ms": float(np.percentile(latencies, 95)),
+            "p99_ms": float(np.percentile(latencies, 99)),
+            "max_ms": float(latencies.max()),
+            "bytes": recorder.bytes[path],
+        }
+    total = sum(endpoint["requests"] for endpoint in endpoints.values())
+    return {
+        "wall_time_s": wall_time,
+        "requests": total,
+        "errors": sum(recorder.errors.values()),
+        "throughput_rps": total / wall_time,
+        "endpoints": endpoints,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="replay frontend-like game sessions against the similarity api")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--url", default="http://127.0.0.1:8000", help="base url of a running server")
+    target.add_argument("--in-process", action="store_true", help="drive the flask app directly instead of over http")
+    parser.add_argument("--sessions", type=int, default=200, help="number of games to play")
+    parser.add_argument("--concurrency", type=int, default=16, help="number of simultaneous players")
+    parser.add_argument("--guesses", type=int, default=20, help="guesses per game")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--legacy", action="store_true", help="use the per-guess request fan-out from before /guess")
+    parser.add_argument("--save-sessions", help="write the requests of every session to this jsonl file")
+    parser.add_argument("--replay", help="replay the sessions in a jsonl file written by --save-sessions")
+    parser.add_argument("--server-pid", type=int, help="pid of the server (or gunicorn master) to report memory for")
+    parser.add_argument("--output", help="write the report here instead of stdout")
+    args = parser.parse_args()
+
+    client = InProcessClient() if args.in_process else HTTPClient(args.url)
+    recorder = Recorder()
+
+    if args.replay:
+        with open(args.replay) as f:
+            sessions = [json.loads(line) for line in f]
+        jobs = [lambda requests=requests: replay_session(client, recorder, requests) for requests in sessions]
+        logs = None
+    else:
+        status, data, _ = client.request("GET", "/get_vocab")
+        if status != 200:
+            print(f"could not fetch the vocabulary (status {status})")
+            sys.exit(1)
+        vocab = data["vocab"]
+        logs = [[] for _ in range(args.sessions)]
+        jobs = [
+            lambda i=i: play_session(client, recorder, vocab, random.Random(args.seed * 1_000_003 + i), args.guesses, args.legacy, logs[i])
+            for i in range(args.sessions)
+        ]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for future in [pool.submit(job) for job in jobs]:
+            future.result()
+    wall_time = time.perf_counter() - start
+
+    report = summarize(recorder, wall_time)
+    report["config"] = {
+        "mode": "in-process" if args.in_process else args.url,
+        "sessions": len(jobs),
+        "concurrency": args.concurrency,
+        "guesses": args.guesses,
+        "seed": args.seed,
+        "legacy": args.legacy,
+        "replay": args.replay,
+    }
+    if args.in_process:
+        report["memory"] = [process_memory(os.getpid())]
+    elif args.server_pid is not None:
+        report["memory"] = server_memory(args.server_pid)
+
+    if args.save_sessions and logs is not None:
+        with open(args.save_sessions, "w") as f:
+            for log in logs:
+                f.write(json.dumps(log) + "\n")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
@@ -0,0 +1,239 @@
+"""in-process metrics for the similarity api, exposed in the prometheus text format
+
+a Metrics registry holds labelled counters and histograms. servers record per-route latency, request/error counts and
+response sizes around every request, and handlers time their lookup / matmul / serialization phases with
+metrics.phase(...). the current route is tracked in a context variable so this works for both flask threads and
+asyncio tasks. SamplingProfiler is an optional stack sampler that can be switched on and off while serving.
+
+everything is per process: under gunicorn, /metrics and /profiler only cover the worker that answered the request, so
+scrape each worker (or run a single one) to see everything.
+"""
+
+import contextvars
+import ipaddress
+import math
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+SIZE_BUCKETS = (100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000)
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+current_route = contextvars.ContextVar("current_route", default="none")
+
+# shortest sampling interval, since sampling holds the gil while it walks every thread's stack
+MIN_PROFILER_INTERVAL = 0.001
+# the profiler endpoint exposes source paths, so it only exists when this environment variable is set
+PROFILER_ENV = "SEMANTLE_PROFILER"
+
+
+class Histogram:
+    """cumulative-bucket histogram of one labelled series"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+class Metrics:
+    """thread-safe registry of labelled counters and histograms"""
+
+    def __init__(self, prefix="semantle"):
+        self.prefix = prefix
+        self._counters = defaultdict(Counter)
+        self._histograms = defaultdict(dict)
+        self._buckets = {}
+        self._help = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def describe(self, name, help_text, buckets=None):
+        """sets the help text of a metric, and its buckets if it is a histogram"""
+        self._help[name] = help_text
+        if buckets is not None:
+            self._buckets[name] = buckets
+
+    def inc(self, name, amount=1, **labels):
+        with self._lock:
+            self._counters[name][tuple(sorted(labels.items()))] += amount
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms[name]
+            if key not in series:
+                series[key] = Histogram(self._buckets.get(name, LATENCY_BUCKETS))
+            series[key].observe(value)
+
+    def add_collector(self, collector):
+        """registers a callable returning [(name, type, labels dict, value)] read at scrape time, e.g. cache stats"""
+        self._collectors.append(collector)
+
+    @contextmanager
+    def phase(self, phase):
+        """times a block as one phase (lookup, matmul, serialization, ...) of the current route"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("phase_seconds", time.perf_counter() - start, route=current_route.get(), phase=phase)
+
+    def observe_request(self, route, method, status, seconds, response_bytes):
+        """records the latency, status and response size of one finished request"""
+        self.observe("request_seconds", seconds, route=route)
+        self.inc("requests_total", route=route, method=method, status=str(status))
+        if status >= 400:
+            self.inc("errors_total", route=route, status=str(status))
+        if response_bytes is not None:
+            self.observe("response_bytes", response_bytes, route=route)
+
+    def render(self):
+        """returns every metric in the prometheus text exposition format"""
+        lines = []
+
+        def header(name, kind):
+            full_name = f"{self.prefix}_{name}"
+            if name in self._help:
+                lines.append(f"# HELP {full_name} {self._help[name]}")
+            lines.append(f"# TYPE {full_name} {kind}")
+            return full_name
+
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                full_name = header(name, "counter")
+                for labels, value in sorted(series.items()):
+                    lines.append(f"{full_name}{_format_labels(labels)} {value}")
+
+            for name, series in sorted(self._histograms.items()):
+                full_name = header(name, "histogram")
+                for labels, histogram in sorted(series.items()):
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                        cumulative += count
+                        lines.append(f"{full_name}_bucket{_format_labels(labels + (('le', bound),))} {cumulative}")
+                    lines.append(f"{full_name}_sum{_format_labels(labels)} {histogram.sum}")
+                    lines.append(f"{full_name}_count{_format_labels(labels)} {histogram.count}")
+
+        for collector in self._collectors:
+            for name, kind, labels, value in collector():
+                full_name = header(name, kind)
+                lines.append(f"{full_name}{_format_labels(tuple(sorted(labels.items())))} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+def top_k_cache_collector(cache):
+    """exposes a TopKCache's hit/miss counts, size and derived hit rate"""
+    def collect():
+        lookups = cache.hits + cache.misses
+        return [
+            ("top_k_cache_hits_total", "counter", {}, cache.hits),
+            ("top_k_cache_misses_total", "counter", {}, cache.misses),
+            ("top_k_cache_hit_ratio", "gauge", {}, cache.hits / lookups if lookups else 0.0),
+            ("top_k_cache_entries", "gauge", {}, len(cache)),
+            ("top_k_cache_bytes", "gauge", {}, cache.nbytes),
+        ]
+    return collect
+
+
+def describe_server_metrics(metrics):
+    """help text and buckets for the metrics both servers record"""
+    metrics.describe("request_seconds", "request latency by route", LATENCY_BUCKETS)
+    metrics.describe("requests_total", "requests by route, method and status")
+    metrics.describe("errors_total", "responses with status >= 400 by route")
+    metrics.describe("response_bytes", "response body size by route", SIZE_BUCKETS)
+    metrics.describe("phase_seconds", "time spent in lookup, matmul and serialization by route", LATENCY_BUCKETS)
+    metrics.describe("batch_size", "requests answered per batched matmul", BATCH_BUCKETS)
+
+
+def profiler_refusal(remote_address, headers):
+    """None if a request may use the profiler endpoint, otherwise (status, reason): the endpoint is off unless
+    SEMANTLE_PROFILER is set, and then only answers clients on this machine that didn't come through a proxy"""
+    if not os.environ.get(PROFILER_ENV):
+        return 404, "not found"
+    try:
+        local = ipaddress.ip_address(remote_address or "").is_loopback
+    except ValueError:
+        local = False
+    if not local or "X-Forwarded-For" in headers or "Forwarded" in headers:
+        return 403, "the profiler only answers local requests"
+    return None
+
+
+class SamplingProfiler:
+    """samples the stacks of all other threads at a fixed interval and counts them in collapsed (flamegraph) form"""
+
+    def __init__(self, interval=0.005, max_depth=64):
+        self.interval = self._clamp(interval)
+        self.max_depth = max_depth
+        self.samples = Counter()
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval=None):
+        """starts sampling every interval seconds (at least MIN_PROFILER_INTERVAL); raises ValueError if interval
+        isn't a finite number"""
+        if interval is not None:
+            self.interval = self._clamp(interval)
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _clamp(interval):
+        # nan would get through max, and an infinite interval overflows Event.wait
+        interval = float(interval)
+        if not math.isfinite(interval):
+            raise ValueError(f"profiler interval must be finite, got {interval}")
+        return max(interval, MIN_PROFILER_INTERVAL)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._thread = None
+
+    def reset(self):
+        self.samples = Counter()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = traceback.extract_stack(frame)[-self.max_depth:]
+                self.samples[";".join(f"{entry.name} ({entry.filename}:{entry.lineno})" for entry in stack)] += 1
+
+    def collapsed(self):
+        """returns the samples as 'frame;frame;frame count' lines, the input format of flamegraph tools"""
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
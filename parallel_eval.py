@@ -0,0 +1,202 @@
+"""multi-process beam search evaluation
+
+the vectors and the csr graph are copied into shared memory once per Evaluator, whose worker processes map them instead
+of getting their own copy and serve every evaluate call until it is closed. the queries are split into shards that run
+through batch_search, at most shard_size queries each but small enough that every process gets one. shard results
+come back in shard order, so the merged per-query counts are the same whatever the number of processes. traces are
+written per shard and appended in shard order, so they don't depend on it either.
+
+with codes (a quantization store), searches are steered by distances on the codes and the nearest point found is
+picked by re-ranking the rerank best compared points exactly, so the float vectors are only read for the queries and
+those finalists. memory-mapped vectors are then left mapped in the forked workers instead of copied to shared memory.
+"""
+
+import multiprocessing
+import os
+import tempfile
+import numpy as np
+from multiprocessing import shared_memory
+from beam_search import batch_search, neighbor_distances
+from search_trace import TraceWriter
+from utils import CSRGraph
+
+# compared points re-scored exactly per query when searching on codes
+RERANK = 10
+
+
+class SharedArrays:
+    """named numpy arrays backed by shared memory blocks, which worker processes attach to by name"""
+
+    def __init__(self, arrays):
+        self.blocks = {}
+        self.specs = {}
+        for key, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+            self.blocks[key] = block
+            self.specs[key] = (block.name, array.shape, array.dtype.str)
+
+    def close(self):
+        for block in self.blocks.values():
+            block.close()
+            block.unlink()
+        self.blocks = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def attach(specs):
+    """maps the arrays described by SharedArrays.specs, returning (arrays, blocks); keep the blocks alive while the arrays are used"""
+    arrays = {}
+    blocks = []
+    for key, (name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=name)
+        blocks.append(block)
+        arrays[key] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+    return arrays, blocks
+
+
+# per-worker state, set up once by _init_worker
+_worker = {}
+
+
+def _init_worker(specs, vectors=None, codes=None, rerank=RERANK):
+    # vectors and codes that aren't in shared memory are inherited through the fork, not pickled
+    arrays, blocks = attach(specs)
+    _worker["blocks"] = blocks
+    _worker["graph"] = CSRGraph(arrays["offsets"], arrays["neighbors"])
+    _worker["vectors"] = arrays["vectors"] if vectors is None else vectors
+    _worker["codes"] = codes
+    _worker["rerank"] = rerank
+
+
+def _run_shard(job):
+    index, first_search, shard, search_kwargs, trace_dir, nearest = job
+    vectors, codes = _worker["vectors"], _worker["codes"]
+    if trace_dir is None:
+        results = batch_search(_worker["graph"], vectors, queries=shard, codes=codes, **search_kwargs)
+    else:
+        with TraceWriter(_shard_trace_path(trace_dir, index), first_search=first_search) as trace:
+            results = batch_search(_worker["graph"], vectors, queries=shard, trace=trace, codes=codes, **search_kwargs)
+    return _counts(vectors, codes, _worker["rerank"], search_kwargs["start"], shard, results, nearest)
+
+
+def _counts(vectors, codes, rerank, start, queries, results, nearest):
+    counts = [len(result.visited) for result in results], [len(result.compared) for result in results]
+    if not nearest:
+        return counts
+    return counts + ([_nearest_found(vectors, codes, rerank, start, query, result) for query, result in zip(queries, results)],)
+
+
+def _nearest_found(vectors, codes, rerank, start, query, result):
+    """the point closest to the query among the start and everything the search compared; with codes, only the rerank
+    points closest by their codes are compared exactly"""
+    points = np.array([start] + result.compared)
+    query_vector = vectors[query]
+    if codes is not None and len(points) > rerank:
+        approximate = codes.distances(points, codes.prepare([query_vector]), 0)
+        points = points[np.argpartition(approximate, rerank - 1)[:rerank]]
+    return int(points[np.argmin(neighbor_distances(vectors, points, query_vector))])
+
+
+def _shard_trace_path(trace_dir, index):
+    return os.path.join(trace_dir, f"shard{index:06d}.trace")
+
+
+class Evaluator:
+    """a graph and its vectors in shared memory and a pool of worker processes mapping them, set up once and reused by
+    every evaluate call until close
+
+    with a single process there is no pool and no shared memory, and the search runs in this process. with codes (a
+    quantization store), searches run on the codes and re-rank rerank finalists exactly"""
+
+    def __init__(self, graph, vectors, processes=None, shard_size=256, codes=None, rerank=RERANK):
+        self.graph = graph
+        self.vectors = vectors
+        self.processes = processes or os.cpu_count() or 1
+        self.shard_size = shard_size
+        self.codes = codes
+        self.rerank = rerank
+        self._shared = None
+        self._pool = None
+        if self.processes > 1:
+            arrays = {"offsets": graph.offsets, "neighbors": graph.neighbors}
+            # searches on codes read few float vectors, so mapped ones stay mapped rather than being copied
+            mapped_vectors = vectors if codes is not None and isinstance(vectors, np.memmap) else None
+            if mapped_vectors is None:
+                arrays["vectors"] = vectors
+            self._shared = SharedArrays(arrays)
+            # fork, so that scripts without a __main__ guard (build_graph.py, tune_graph_params.py) aren't re-run in workers
+            self._pool = multiprocessing.get_context("fork").Pool(self.processes, _init_worker, (self._shared.specs, mapped_vectors, codes, rerank))
+
+    def evaluate(self, queries, start=0, limit=1000, beam_width=None, eager=True, trace=None, nearest=False):
+        """runs beam search from start to every query, see evaluate"""
+        queries = [int(query) for query in queries]
+        # spread small calls (a tuner step) over the whole pool rather than over len(queries) / shard_size processes
+        shard_size = max(1, min(self.shard_size, -(-len(queries) // self.processes)))
+        shards = [queries[i:i + shard_size] for i in range(0, len(queries), shard_size)]
+        search_kwargs = {"start": start, "limit": limit, "beam_width": beam_width, "eager": eager, "batch_size": shard_size}
+
+        if self._pool is None or len(shards) <= 1:
+            results = batch_search(self.graph, self.vectors, queries=queries, trace=trace, codes=self.codes, **search_kwargs)
+            counts = [_counts(self.vectors, self.codes, self.rerank, start, queries, results, nearest)]
+        else:
+            first_search = trace.next_search if trace is not None else 0
+            with tempfile.TemporaryDirectory() as trace_dir:
+                jobs = [(index, first_search + index * shard_size, shard, search_kwargs, None if trace is None else trace_dir, nearest) for index, shard in enumerate(shards)]
+                counts = self._pool.map(_run_shard, jobs, chunksize=1)
+                if trace is not None:
+                    for index in range(len(shards)):
+                        trace.append_file(_shard_trace_path(trace_dir, index))
+                    trace.next_search += len(queries)
+
+        results = {
+            "visited": np.array([count for shard in counts for count in shard[0]], dtype=np.int64),
+            "compared": np.array([count for shard in counts for count in shard[1]], dtype=np.int64),
+        }
+        if nearest:
+            results["nearest"] = np.array([point for shard in counts for point in shard[2]], dtype=np.int64)
+        return results
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+        if self._shared is not None:
+            self._shared.close()
+            self._shared = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def evaluate(graph, vectors, queries, start=0, limit=1000, beam_width=None, eager=True, processes=None, shard_size=256, trace=None, nearest=False, codes=None, rerank=RERANK):
+    """runs beam search from start to every query across a process pool
+
+    returns {"visited": counts, "compared": counts} as int arrays in query order, plus "nearest", the closest point each
+    search found, if nearest is set. processes defaults to the number of cores; with a single process the search runs
+    in this process without shared memory. if trace is a TraceWriter, the hops of every search are recorded to it, with
+    search ids in query order. with codes, searches run on a quantization store as in Evaluator. callers evaluating the
+    same graph many times should hold an Evaluator instead, which only sets up the shared memory and the pool once"""
+    processes = min(processes or os.cpu_count() or 1, max(len(queries), 1))
+    with Evaluator(graph, vectors, processes, shard_size, codes, rerank) as evaluator:
+        return evaluator.evaluate(queries, start, limit, beam_width, eager, trace, nearest)
+
+
+def summarize(counts, limit=1000):
+    """average visited and compared counts, and the fraction of queries that converged within limit"""
+    return {
+        "queries": len(counts["visited"]),
+        "average_visited": float(np.mean(counts["visited"])),
+        "average_compared": float(np.mean(counts["compared"])),
+        "recall": float(np.mean(counts["visited"] < limit)),
+    }
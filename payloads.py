@@ -0,0 +1,118 @@
+"""response bodies that never change between deploys, rendered and compressed once at startup
+
+a StaticPayload holds the identity, gzip and (if the brotli package is installed) brotli encodings of a body, each with
+a strong etag, and answers conditional gets with 304s. it only deals in (status, headers, body), so both the flask and
+the asyncio servers can use it.
+"""
+
+import gzip
+import hashlib
+import json
+import numpy as np
+
+from utils import encode_string_table
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+BINARY_VOCAB_MAGIC = b"SVOC"
+BINARY_VOCAB_VERSION = 1
+
+# most preferred first
+ENCODINGS = ["br", "gzip", "identity"]
+
+
+def accepted_encodings(accept_encoding):
+    """returns the content codings allowed by an Accept-Encoding header"""
+    accepted = {"identity"}
+    for item in (accept_encoding or "").split(","):
+        coding, _, params = item.strip().partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                weight = float(q[2:])
+            except ValueError:
+                weight = 1.0
+            if weight == 0:
+                accepted.discard(coding)
+                continue
+        if coding == "*":
+            accepted.update(ENCODINGS)
+        else:
+            accepted.add(coding)
+    return accepted
+
+
+class StaticPayload:
+    """a precompressed response body with strong etags and conditional get support"""
+
+    def __init__(self, body, content_type):
+        self.content_type = content_type
+        self.size = len(body)
+        digest = hashlib.sha256(body).hexdigest()[:32]
+
+        self.bodies = {"identity": body, "gzip": gzip.compress(body, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            self.bodies["br"] = brotli.compress(body, quality=11)
+
+        # strong etags have to differ between content codings of the same resource
+        self.etags = {encoding: f'"{digest}"' if encoding == "identity" else f'"{digest}-{encoding}"' for encoding in self.bodies}
+
+    @classmethod
+    def from_json(cls, obj):
+        return cls(json.dumps(obj, separators=(",", ":")).encode(), "application/json")
+
+    def respond(self, request_headers):
+        """returns (status, headers, body) for a request with the given headers"""
+        accepted = accepted_encodings(request_headers.get("Accept-Encoding"))
+        # a client that accepts none of our codings (e.g. "identity;q=0") still gets the unencoded body, which http allows
+        # instead of a 406
+        encoding = next((encoding for encoding in ENCODINGS if encoding in self.bodies and encoding in accepted), "identity")
+
+        headers = {
+            "ETag": self.etags[encoding],
+            "Vary": "Accept-Encoding",
+            "Cache-Control": "no-cache",
+        }
+
+        if_none_match = request_headers.get("If-None-Match")
+        if if_none_match is not None:
+            tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+            if "*" in tags or self.etags[encoding] in tags:
+                return 304, headers, b""
+
+        headers["Content-Type"] = self.content_type
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return 200, headers, self.bodies[encoding]
+
+
+def encode_vocab_binary(vocab, bfs_distances=None):
+    """compact little-endian encoding of the vocab and optionally the bfs distances
+
+    layout: magic b"SVOC", uint32 version, uint32 number of words, uint32 number of distances (0 or the number of
+    words), int32 distances, uint32 string offsets (one more than the number of words), utf-8 word blob"""
+    offsets, blob = encode_string_table(vocab)
+    distances = np.asarray(bfs_distances if bfs_distances is not None else [], dtype="<i4")
+    header = np.array([BINARY_VOCAB_VERSION, len(vocab), len(distances)], dtype="<u4")
+    return BINARY_VOCAB_MAGIC + header.tobytes() + distances.tobytes() + offsets.astype("<u4").tobytes() + blob.tobytes()
+
+
+def vocab_payloads(vocab, bfs_distances):
+    """renders the /get_vocab and /get_vocab_and_distances bodies, keyed by route name and then format"""
+    vocab = vocab.to_list()
+    return {
+        "vocab": {
+            "json": StaticPayload.from_json({"vocab": vocab}),
+            "binary": StaticPayload(encode_vocab_binary(vocab), "application/octet-stream"),
+        },
+        "vocab_and_distances": {
+            "json": StaticPayload.from_json({"vocab": vocab, "bfs_distances": bfs_distances}),
+            "binary": StaticPayload(encode_vocab_binary(vocab, bfs_distances), "application/octet-stream"),
+        },
+    }
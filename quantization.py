@@ -0,0 +1,254 @@
+"""compressed vector stores for approximate distance work
+
+ScalarQuantizer keeps one int8 per dimension (4x smaller than float32) with a per-dimension scale and offset, and
+ProductQuantizer keeps one uint8 centroid id per subspace (24x smaller for 300-d vectors with 50 subspaces). both
+index like the float vectors they replace (store[ids] decodes rows) and score a query against every row for candidate
+selection, which top_k_reranked in utils follows with an exact re-rank of the finalists.
+
+beam search traverses on the codes too: prepare turns query vectors into per-query state once, and distances scores
+any rows against it from their codes alone, which is what search and batch_search use when given codes=. parallel_eval
+then re-ranks the best compared points of every search exactly, so the float vectors (left memory-mapped) are only
+read for queries and finalists, and the distance work of a search touches 4x (sq8) or 24x (pq) fewer bytes.
+
+numpy has no fast int8 matmul, so a full scan of the codes converts them to float32 a block at a time and is slower
+than an exact matmul over float32 vectors, which is why the servers only select rank tables on a store when asked to.
+the cli reports the recall against GT of both uses, and their speed, next to the exact versions.
+
+Usage: python quantization.py <embedding name> [sq8|pq] [subspaces] [--graph vamana] [--processes N]
+"""
+
+import argparse
+import time
+import numpy as np
+from pathlib import Path
+from parallel_eval import evaluate
+from utils import CSRGraph, Vocabulary, fbin_to_numpy, mmap_fbin, read_groundtruth, read_pq, read_sq8, top_k_indices, top_k_reranked, write_pq, write_sq8
+
+# rows scored at a time, which bounds the temporary float32 copies of the codes
+BLOCK_SIZE = 65536
+
+
+class ScalarQuantizer:
+    """int8 codes where row i decodes to codes[i] * scale + offset"""
+
+    suffix = ".sq8"
+
+    def __init__(self, codes, scale, offset):
+        self.codes = codes
+        self.scale = scale
+        self.offset = offset
+
+    @classmethod
+    def from_vectors(cls, vectors):
+        """maps the range of each dimension onto the 256 int8 values"""
+        low = vectors.min(axis=0)
+        high = vectors.max(axis=0)
+        scale = np.maximum((high - low) / 255, np.finfo(np.float32).tiny).astype(np.float32)
+        offset = (low + 128 * scale).astype(np.float32)
+        codes = np.empty(vectors.shape, dtype=np.int8)
+        for start in range(0, len(vectors), BLOCK_SIZE):
+            block = (vectors[start:start + BLOCK_SIZE] - offset) / scale
+            codes[start:start + BLOCK_SIZE] = np.clip(np.rint(block), -128, 127)
+        return cls(codes, scale, offset)
+
+    @classmethod
+    def from_file(cls, path, mmap=True):
+        return cls(*read_sq8(path, mmap))
+
+    def to_file(self, path):
+        write_sq8(self.codes, self.scale, self.offset, path)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, ids):
+        return self.codes[ids] * self.scale + self.offset
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.scale.nbytes + self.offset.nbytes
+
+    def prepare(self, query_vectors):
+        """per-query state for distances: each query scaled per dimension, and its inner product with the offset"""
+        query_vectors = np.asarray(query_vectors, dtype=np.float32)
+        return query_vectors * self.scale, (query_vectors * self.offset).sum(axis=1)
+
+    def distances(self, ids, prepared, rows):
+        """approximate negative inner product of the prepared queries rows with the rows ids, read from their codes"""
+        scaled_queries, biases = prepared
+        return -((self.codes[ids] * scaled_queries[rows]).sum(axis=1) + biases[rows])
+
+    def scores(self, query):
+        """approximate inner product of query with every row, without decoding the rows"""
+        scaled_query = (query * self.scale).astype(np.float32)
+        bias = np.float32(np.dot(query, self.offset))
+        scores = np.empty(len(self), dtype=np.float32)
+        for start in range(0, len(self), BLOCK_SIZE):
+            scores[start:start + BLOCK_SIZE] = np.dot(self.codes[start:start + BLOCK_SIZE].astype(np.float32), scaled_query) + bias
+        return scores
+
+
+class ProductQuantizer:
+    """uint8 codes where row i decodes to the concatenation of centroids[j, codes[i, j]] over subspaces j"""
+
+    suffix = ".pq"
+
+    def __init__(self, codes, centroids):
+        self.codes = codes
+        self.centroids = centroids
+        self._subspaces = np.arange(centroids.shape[0])
+
+    @classmethod
+    def from_vectors(cls, vectors, subspaces=50, centroids=256, iterations=20, sample_size=50000, seed=0):
+        """trains one k-means codebook per subspace on a sample of the vectors, then encodes every vector"""
+        n, d = vectors.shape
+        assert d % subspaces == 0, f"{subspaces} subspaces don't divide dimension {d}"
+        rng = np.random.default_rng(seed)
+        sample = vectors[np.sort(rng.choice(n, min(n, sample_size), replace=False))].reshape(-1, subspaces, d // subspaces)
+        codebooks = np.stack([_kmeans(sample[:, j], centroids, iterations, rng) for j in range(subspaces)])
+        codes = np.empty((n, subspaces), dtype=np.uint8)
+        for start in range(0, n, BLOCK_SIZE):
+            block = vectors[start:start + BLOCK_SIZE].reshape(-1, subspaces, d // subspaces)
+            for j in range(subspaces):
+                codes[start:start + BLOCK_SIZE, j] = _nearest_centroid(block[:, j], codebooks[j])
+        return cls(codes, codebooks)
+
+    @classmethod
+    def from_file(cls, path, mmap=True):
+        return cls(*read_pq(path, mmap))
+
+    def to_file(self, path):
+        write_pq(self.codes, self.centroids, path)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, ids):
+        codes = self.codes[ids]
+        subspaces, _, subspace_dim = self.centroids.shape
+        return self.centroids[self._subspaces, codes].reshape(codes.shape[:-1] + (subspaces * subspace_dim,))
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.centroids.nbytes
+
+    def prepare(self, query_vectors):
+        """per-query state for distances: the inner product of each query with every centroid, per subspace"""
+        subspaces, _, subspace_dim = self.centroids.shape
+        query_vectors = np.asarray(query_vectors, dtype=np.float32)
+        return np.stack([(self.centroids * query.reshape(subspaces, 1, subspace_dim)).sum(axis=2) for query in query_vectors])
+
+    def distances(self, ids, prepared, rows):
+        """approximate negative inner product of the prepared queries rows with the rows ids, summed from the tables"""
+        return -prepared[np.asarray(rows)[..., None], self._subspaces, self.codes[ids]].sum(axis=1)
+
+    def scores(self, query):
+        """approximate inner product of query with every row, summed from a per-subspace lookup table"""
+        subspaces, _, subspace_dim = self.centroids.shape
+        table = np.einsum("jkd,jd->jk", self.centroids, query.reshape(subspaces, subspace_dim).astype(np.float32))
+        scores = np.empty(len(self), dtype=np.float32)
+        for start in range(0, len(self), BLOCK_SIZE):
+            scores[start:start + BLOCK_SIZE] = table[self._subspaces, self.codes[start:start + BLOCK_SIZE]].sum(axis=1)
+        return scores
+
+
+def _nearest_centroid(points, centroids):
+    """index of the nearest centroid (in l2) to each point"""
+    return np.argmin((centroids * centroids).sum(axis=1) - 2 * np.dot(points, centroids.T), axis=1)
+
+
+def _kmeans(points, k, iterations, rng):
+    centroids = points[rng.choice(len(points), k, replace=len(points) < k)].copy()
+    for _ in range(iterations):
+        assignment = _nearest_centroid(points, centroids)
+        counts = np.bincount(assignment, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, points)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        # reseed empty clusters on random points
+        centroids[empty] = points[rng.choice(len(points), empty.sum())]
+    return centroids
+
+
+QUANTIZERS = {"sq8": ScalarQuantizer, "pq": ProductQuantizer}
+
+
+def quantized_path(data_dir, kind):
+    return Path(data_dir) / f"base{QUANTIZERS[kind].suffix}"
+
+
+def load_quantized(data_dir, mmap=True):
+    """loads the compressed store built for data_dir (preferring sq8 over pq), or None if there isn't one"""
+    for kind, quantizer in QUANTIZERS.items():
+        path = quantized_path(data_dir, kind)
+        if path.exists():
+            return quantizer.from_file(path, mmap)
+    return None
+
+
+def recall_at_k(found, gt_ids, k):
+    """fraction of the true k nearest neighbors found, averaged over queries"""
+    return float(np.mean([len(np.intersect1d(row[:k], truth[:k])) / k for row, truth in zip(found, gt_ids)]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="build a quantized store and report its recall against GT")
+    parser.add_argument("embeddings")
+    parser.add_argument("kind", nargs="?", choices=list(QUANTIZERS), default="sq8")
+    parser.add_argument("subspaces", nargs="?", type=int, default=50, help="pq subspaces")
+    parser.add_argument("--graph", default="vamana", help="graph in outputs/ to beam search on the codes, if built")
+    parser.add_argument("--processes", type=int, help="default: the number of cores")
+    args = parser.parse_args()
+
+    data_dir = Path("data") / args.embeddings
+    kind = args.kind
+
+    vectors = fbin_to_numpy(data_dir / "base.fbin")
+
+    start = time.time()
+    if kind == "pq":
+        store = ProductQuantizer.from_vectors(vectors, args.subspaces)
+    else:
+        store = ScalarQuantizer.from_vectors(vectors)
+    store.to_file(quantized_path(data_dir, kind))
+    print(f"built {kind} in {time.time() - start:.2f} seconds")
+    print(f"{vectors.nbytes / 2**20:.1f} MiB -> {store.nbytes / 2**20:.1f} MiB ({vectors.nbytes / store.nbytes:.1f}x smaller)")
+
+    queries = fbin_to_numpy(data_dir / "query.fbin")
+    gt_ids, _ = read_groundtruth(data_dir / "GT")
+    k = min(10, gt_ids.shape[1])
+
+    def timed(name, top_k):
+        start = time.time()
+        found = [top_k(query) for query in queries]
+        elapsed = time.time() - start
+        print(f"{name}: recall@{k} {recall_at_k(found, gt_ids, k):.4f}, {1000 * elapsed / len(queries):.3f} ms/query")
+
+    timed("exact", lambda query: top_k_indices(vectors, query, k))
+    timed(f"{kind} only", lambda query: top_k_reranked(store, vectors, query, k, rerank=1))
+    for rerank in (2, 4, 10):
+        timed(f"{kind} + {rerank}x re-rank", lambda query: top_k_reranked(store, vectors, query, k, rerank))
+
+    graph_path = data_dir / "outputs" / args.graph
+    if not graph_path.exists():
+        print(f"no {args.graph} graph in outputs/, skipping beam search")
+    else:
+        # beam search to every query word, scored like benchmark_graphs: recall@1 is the nearest point found being
+        # the true nearest neighbor
+        graph = CSRGraph.from_file(graph_path, mmap=True)
+        vocab = Vocabulary.from_file(data_dir / "vocab.txt")
+        query_indices = vocab.require_ids(Vocabulary.from_file(data_dir / "query.txt"))
+        nearest_ids = gt_ids[:, 0]
+        mapped = mmap_fbin(data_dir / "base.fbin")
+        quantized = QUANTIZERS[kind].from_file(quantized_path(data_dir, kind))
+
+        def searched(name, **kwargs):
+            start = time.time()
+            counts = evaluate(graph, mapped, query_indices, processes=args.processes, nearest=True, **kwargs)
+            elapsed = time.time() - start
+            print(f"{name}: recall@1 {np.mean(counts['nearest'] == nearest_ids):.4f}, {np.mean(counts['compared']):.1f} compared, {1000 * elapsed / len(query_indices):.3f} ms/query")
+
+        searched(f"{args.graph} beam search exact")
+        for rerank in (1, 10, 100):
+            searched(f"{args.graph} beam search on {kind} + {rerank} re-ranked", codes=quantized, rerank=rerank)
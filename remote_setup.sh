@@ -1,3 +1,4 @@
 #!/bin/bash
 
-tar -xzf word2vec-google-news-300_50000_lowercase.tar.gz
\ No newline at end of file
+tar -xzf word2vec-google-news-300_50000_lowercase.tar.gz
+python snapshot.py word2vec-google-news-300_50000_lowercase
\ No newline at end of file
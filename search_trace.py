@@ -0,0 +1,161 @@
+"""per-hop traces of beam searches, streamed to a compact columnar file
+
+pass a TraceWriter as trace= to search / batch_search / parallel_eval.evaluate and every hop of every search is
+recorded: the node expanded, how many new neighbors it compared, its distance to the query, and the best distance
+left in the beam afterwards. rows are buffered and written in fixed-size chunks, each chunk storing its columns one
+after another, so recording costs a few list appends per hop and the reader can aggregate any number of searches one
+chunk at a time.
+
+file layout: magic b"SEMTRACE", uint32 version, then chunks of int64 row count followed by each column in COLUMNS
+order.
+
+Usage: python search_trace.py <trace file>
+"""
+
+import json
+import shutil
+import sys
+import numpy as np
+
+MAGIC = b"SEMTRACE"
+VERSION = 1
+HEADER_SIZE = len(MAGIC) + 4
+
+COLUMNS = (
+    ("search", np.int32),  # id of the search, assigned by TraceWriter.begin
+    ("query", np.int32),  # index of the point being searched for
+    ("hop", np.int32),  # position of this expansion within the search
+    ("node", np.int32),  # the point expanded
+    ("compared", np.int32),  # new comparisons made while expanding it
+    ("distance", np.float32),  # dist from the expanded point to the query
+    ("beam_best", np.float32),  # best dist remaining in the beam after the expansion
+)
+
+
+class TraceWriter:
+    """buffers hop rows and appends them to path chunk_rows at a time"""
+
+    def __init__(self, path, chunk_rows=65536, first_search=0):
+        self.path = path
+        self.chunk_rows = chunk_rows
+        self.next_search = first_search
+        self.rows = 0
+        self._columns = tuple([] for _ in COLUMNS)
+        self._file = open(path, "wb")
+        self._file.write(MAGIC + np.uint32(VERSION).tobytes())
+
+    def begin(self, query):
+        """returns the id to record the hops of a new search for query under"""
+        search = self.next_search
+        self.next_search += 1
+        return search
+
+    def record(self, search, query, hop, node, compared, distance, beam_best):
+        for column, value in zip(self._columns, (search, query, hop, node, compared, distance, beam_best)):
+            column.append(value)
+        if len(self._columns[0]) >= self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+        rows = len(self._columns[0])
+        if not rows:
+            return
+        self._file.write(np.int64(rows).tobytes())
+        for (_, dtype), column in zip(COLUMNS, self._columns):
+            self._file.write(np.array(column, dtype=dtype).tobytes())
+            column.clear()
+        self.rows += rows
+
+    def append_file(self, trace_path):
+        """copies the chunks of another trace file onto the end of this one, e.g. to merge per-process shards"""
+        self.flush()
+        with open(trace_path, "rb") as other:
+            _read_header(other)
+            shutil.copyfileobj(other, self._file)
+
+    def close(self):
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _read_header(f):
+    header = f.read(HEADER_SIZE)
+    if header[:len(MAGIC)] != MAGIC:
+        raise ValueError(f"{f.name} is not a search trace")
+    version = int(np.frombuffer(header[len(MAGIC):], dtype=np.uint32)[0])
+    if version != VERSION:
+        raise ValueError(f"{f.name} has trace version {version}, expected {VERSION}")
+
+
+def iter_chunks(trace_path):
+    """yields the trace one chunk at a time, as a dict of column name -> array"""
+    with open(trace_path, "rb") as f:
+        _read_header(f)
+        while True:
+            count = f.read(8)
+            if len(count) < 8:
+                return
+            rows = int(np.frombuffer(count, dtype=np.int64)[0])
+            yield {name: np.fromfile(f, dtype=dtype, count=rows) for name, dtype in COLUMNS}
+
+
+def search_totals(trace_path):
+    """per search id: the query, number of hops and number of comparisons, accumulated chunk by chunk
+
+    searches that expanded nothing (the start point was the query) have no rows, so they don't appear"""
+    queries = np.zeros(0, dtype=np.int32)
+    hops = np.zeros(0, dtype=np.int64)
+    comparisons = np.zeros(0, dtype=np.int64)
+    for chunk in iter_chunks(trace_path):
+        size = int(chunk["search"].max()) + 1
+        if size > len(hops):
+            queries = np.concatenate([queries, np.full(size - len(queries), -1, dtype=np.int32)])
+            hops = np.concatenate([hops, np.zeros(size - len(hops), dtype=np.int64)])
+            comparisons = np.concatenate([comparisons, np.zeros(size - len(comparisons), dtype=np.int64)])
+        queries[chunk["search"]] = chunk["query"]
+        hops += np.bincount(chunk["search"], minlength=len(hops))
+        comparisons += np.bincount(chunk["search"], weights=chunk["compared"], minlength=len(comparisons)).astype(np.int64)
+    recorded = hops > 0
+    return {"search": np.flatnonzero(recorded), "query": queries[recorded], "hops": hops[recorded], "comparisons": comparisons[recorded]}
+
+
+def summarize(trace_path, max_hop=50, percentiles=(50, 90, 99)):
+    """streaming summary of a trace: per-search hop and comparison distributions, and new comparisons by hop"""
+    totals = search_totals(trace_path)
+    hop_rows = np.zeros(max_hop, dtype=np.int64)
+    hop_comparisons = np.zeros(max_hop, dtype=np.int64)
+    events = 0
+    for chunk in iter_chunks(trace_path):
+        events += len(chunk["hop"])
+        early = chunk["hop"] < max_hop
+        hop_rows += np.bincount(chunk["hop"][early], minlength=max_hop)
+        hop_comparisons += np.bincount(chunk["hop"][early], weights=chunk["compared"][early], minlength=max_hop).astype(np.int64)
+
+    def distribution(values):
+        if not len(values):
+            return {}
+        return {"mean": float(np.mean(values)), **{f"p{p}": float(np.percentile(values, p)) for p in percentiles}}
+
+    seen = hop_rows > 0
+    return {
+        "searches": len(totals["search"]),
+        "events": events,
+        "hops": distribution(totals["hops"]),
+        "comparisons": distribution(totals["comparisons"]),
+        "mean_comparisons_by_hop": (hop_comparisons[seen] / hop_rows[seen]).tolist(),
+    }
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python search_trace.py <trace file>")
+        sys.exit(1)
+
+    print(json.dumps(summarize(sys.argv[1]), indent=2))
@@ -1,72 +1,158 @@
-import gensim.downloader as api
 import random
 import os
+import sys
+import threading
+import numpy as np
+from collections import OrderedDict
+from pathlib import Path
+from utils import Vocabulary, fbin_to_numpy, mmap_fbin
+
+DEFAULT_EMBEDDINGS = "word2vec-google-news-300_50000_lowercase"
+
+class EmbeddingStore:
+    """
+    Normalized word vectors and their vocabulary, loaded once and shared by any number of games.
+    Keeps the rank tables of recent targets, so games with the same target share one.
+    """
+    def __init__(self, vectors, vocab, max_rank_tables=64):
+        self.vectors = vectors
+        self.vocab = vocab
+        self.max_rank_tables = max_rank_tables
+        self._rank_tables = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_data_dir(cls, data_dir, mmap=True):
+        """
+        Loads data/<embeddings>/base.fbin and vocab.txt, memory-mapping the vectors unless mmap is False.
+        """
+        data_dir = Path(data_dir)
+        vectors = mmap_fbin(data_dir / "base.fbin") if mmap else fbin_to_numpy(data_dir / "base.fbin")
+        return cls(vectors, Vocabulary.from_file(data_dir / "vocab.txt"))
+
+    @classmethod
+    def from_keyed_vectors(cls, model):
+        """
+        Builds a store from a loaded gensim KeyedVectors model.
+        """
+        vectors = model.vectors / np.linalg.norm(model.vectors, axis=1)[:, None]
+        return cls(vectors.astype(np.float32), Vocabulary.from_words(model.index_to_key))
+
+    def similarities(self, target):
+        """
+        Cosine similarity of every word to the target index, in one matrix-vector product.
+        """
+        return np.dot(self.vectors, self.vectors[target])
+
+    def rank_table(self, target, similarities=None):
+        """
+        Rank of every word for the target index as an int32 array: 1 for the most similar word other than the target, and
+        0 for the target itself. Ties keep vocabulary order.
+        """
+        with self._lock:
+            if target in self._rank_tables:
+                self._rank_tables.move_to_end(target)
+                return self._rank_tables[target]
+        if similarities is None:
+            similarities = self.similarities(target)
+        scores = -similarities
+        scores[target] = -np.inf
+        ranks = np.empty(len(scores), dtype=np.int32)
+        ranks[np.argsort(scores, kind="stable")] = np.arange(len(scores), dtype=np.int32)
+        with self._lock:
+            self._rank_tables[target] = ranks
+            while len(self._rank_tables) > self.max_rank_tables:
+                self._rank_tables.popitem(last=False)
+        return ranks
+
+_default_store = None
+
+def default_store():
+    """
+    The store for data/<DEFAULT_EMBEDDINGS>, loaded on first use.
+    """
+    global _default_store
+    if _default_store is None:
+        _default_store = EmbeddingStore.from_data_dir(Path("data") / DEFAULT_EMBEDDINGS)
+    return _default_store
 
 class SemantleGame:
-    def __init__(self, model=None):
+    def __init__(self, model=None, *, store=None, target_word=None, verbose=True):
         """
         Initializes the Semantle game.
-        Loads a word embedding model and selects a random target word.
-        """
-        if model is None:
-            print("Loading word embedding model...")
-            self.model = api.load('glove-wiki-gigaword-50')  # You can choose a different model if you like
+        Uses a shared embedding store (loading the project's default embeddings if none is given) and selects a
+        random target word. A gensim model can still be passed as the first argument. With verbose=False the game
+        prints nothing, for simulated players.
+        """
+        self.verbose = verbose
+        if store is None and model is not None:
+            store = EmbeddingStore.from_keyed_vectors(model)
+        elif store is None:
+            self._print("Loading word embeddings...")
+            store = default_store()
+        self.store = store
+        self.vocab = store.vocab
+        if target_word is None:
+            self.target_index = random.randrange(len(self.vocab))
         else:
-            self.model = model
-        self.vocab = list(self.model.key_to_index.keys())
-        self.target_word = random.choice(self.vocab)
+            self.target_index = self.vocab.index(target_word)
+        self.target_word = self.vocab[self.target_index]
         self.guesses = []
         self.solved = False
         self._compute_target_similarities()
-        print("Target word selected. Let's start the game!")
+        self._print("Target word selected. Let's start the game!")
+
+    def _print(self, *args):
+        if self.verbose:
+            print(*args)
 
     def _compute_target_similarities(self):
         """
         Computes the similarities between the target word and all other words in the vocabulary.
+        Ranks are only computed once a guess needs one.
         """
-        print("Computing similarities for all vocabulary words...")
-        self.target_similarities = {}
-        for word in self.vocab:
-            if word == self.target_word:
-                continue
-            sim = self.model.similarity(self.target_word, word)
-            self.target_similarities[word] = sim
-        # Sort words by similarity
-        self.sorted_words = sorted(self.target_similarities.items(), key=lambda x: x[1], reverse=True)
-        # Map from word to rank
-        self.word_ranks = {word: rank+1 for rank, (word, sim) in enumerate(self.sorted_words)}
-        print("Similarities computed.")
+        self.target_similarities = self.store.similarities(self.target_index)
+        self._ranks = None
 
     def make_guess(self, guess_word):
         """
         Processes a player's guess, updating the game state and providing feedback.
+        Returns the recorded guess, or None if the game is already solved or the word is not in the vocabulary.
         """
         guess_word = guess_word.lower()
         if self.solved:
-            print("You've already guessed the word!")
-            return
-        if guess_word not in self.model.key_to_index:
-            print(f"'{guess_word}' is not in the vocabulary.")
-            return
-        sim = self.model.similarity(self.target_word, guess_word)
+            self._print("You've already guessed the word!")
+            return None
+        guess_index = self.vocab.get(guess_word)
+        if guess_index is None:
+            self._print(f"'{guess_word}' is not in the vocabulary.")
+            return None
+        sim = float(self.target_similarities[guess_index])
         rank = self.get_rank(guess_word)
-        self.guesses.append({'word': guess_word, 'similarity': sim, 'rank': rank})
+        guess = {'word': guess_word, 'similarity': sim, 'rank': rank}
+        self.guesses.append(guess)
         if guess_word == self.target_word:
             self.solved = True
-            print(f"Congratulations! You've guessed the word '{self.target_word}'!")
-        else:
+            self._print(f"Congratulations! You've guessed the word '{self.target_word}'!")
+        elif self.verbose:
             print(f"Guess: {guess_word}")
             print(f"Similarity: {sim:.4f}")
             if rank:
                 print(f"Rank: {rank}")
             else:
                 print("Rank: > 1000")
+        return guess
 
     def get_rank(self, word):
         """
         Retrieves the rank of a word based on its similarity to the target word.
         """
-        return self.word_ranks.get(word, None)
+        idx = self.vocab.get(word)
+        if idx is None or idx == self.target_index:
+            return None
+        if self._ranks is None:
+            self._ranks = self.store.rank_table(self.target_index, self.target_similarities)
+        return int(self._ranks[idx])
 
     def display_best_guesses(self, n=10):
         """
@@ -105,5 +191,6 @@ class SemantleGame:
 
 # Command-line interface to play the game
 if __name__ == "__main__":
-    game = SemantleGame()
+    embeddings = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_EMBEDDINGS
+    game = SemantleGame(store=EmbeddingStore.from_data_dir(Path("data") / embeddings))
     game.play()
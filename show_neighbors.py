@@ -1,50 +1,74 @@
-"""interactive script to show neighbors of a given word in a graph"""
+"""interactive script to show the neighborhood of a given word in a graph
+
+shows the words within hops of the entered word along out edges, in edges (--in) or both (--both). entering a second
+word as a target also shows each neighbor's similarity to it."""
 
 import sys
+import numpy as np
 from pathlib import Path
-from utils import graph_file_to_list_of_lists, read_vocab
+from utils import CSRGraph, Vocabulary, mmap_fbin
+from hop_distances import neighborhood
 
 
-if len(sys.argv) < 3:
-    print("Usage: python show_neighbors.py <embedding name> <graph type>")
+args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+if len(args) < 2:
+    print("Usage: python show_neighbors.py <embedding name> <graph type> [hops] [--in | --both]")
     sys.exit(1)
     
-embeddings = sys.argv[1]
-graph_type = sys.argv[2]
+embeddings = args[0]
+graph_type = args[1]
+hops = int(args[2]) if len(args) > 2 else 1
 
 data_dir = Path(f"data/{embeddings}")
 
-word_to_idx, idx_to_word = read_vocab(data_dir / "vocab.txt")
+vocab = Vocabulary.from_file(data_dir / "vocab.txt")
         
-graph = graph_file_to_list_of_lists(data_dir / "outputs" / graph_type)
+graph = CSRGraph.from_file(data_dir / "outputs" / graph_type, mmap=True)
+
+if "--in" in sys.argv:
+    graphs = [graph.reverse()]
+elif "--both" in sys.argv:
+    graphs = [graph, graph.reverse()]
+else:
+    graphs = [graph]
+
+vectors = mmap_fbin(data_dir / "base.fbin")
         
 print("graph loaded")
 
+def lookup(word):
+    """index of a word or of a word given by its index, or None"""
+    if word.isdigit():
+        idx = int(word)
+        if idx >= len(vocab):
+            print("Index out of range")
+            return None
+        print(f"Word {idx}: {vocab[idx]}")
+        return idx
+    if word not in vocab:
+        print(f"Word not found: {word}")
+        return None
+    return vocab.index(word)
+
 while True:
-    word = input("Enter a word: ")
-    if word == "":
+    words = input("Enter a word (and optionally a target word): ").split()
+    if not words:
         break
     
-    if word not in word_to_idx and not word.isdigit():
-        print("Word not found")
+    idx = lookup(words[0])
+    target_idx = lookup(words[1]) if len(words) > 1 else None
+    if idx is None or (len(words) > 1 and target_idx is None):
         continue
-    
-    if word.isdigit():
-        idx = int(word)
-        if idx >= len(idx_to_word):
-            print("Index out of range")
-            continue
-        word = idx_to_word[idx]
-        print(f"Word {idx}: {word}")
-    else:
-        idx = word_to_idx[word]
         
-    neighbors = graph[idx]
+    points, point_hops = neighborhood(graphs, [idx], hops)
+    similarities = np.dot(vectors[points], vectors[target_idx]) if target_idx is not None else None
         
-    print(f"Neighbors of {word}:")
-    for neighbor in neighbors:
-        print(idx_to_word[neighbor])
+    for hop in range(1, int(point_hops.max()) + 1):
+        print(f"{hop} hop{'s' if hop > 1 else ''} from {vocab[idx]}:")
+        for i in np.flatnonzero(point_hops == hop):
+            if similarities is None:
+                print(vocab[points[i]])
+            else:
+                print(f"{vocab[points[i]]} ({similarities[i]:.4f})")
         
     print()
-        
-    
\ No newline at end of file
@@ -1,8 +1,14 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify
 from flask_cors import CORS
 from pathlib import Path
-from utils import fbin_to_numpy, graph_file_to_list_of_lists, read_vocab
+from utils import TopKCache, ranks_in
+from snapshot import load_serving_data
+from payloads import vocab_payloads
+from quantization import load_quantized
+from hop_distances import neighborhood
+from metrics import Metrics, SamplingProfiler, current_route, describe_server_metrics, profiler_refusal, top_k_cache_collector
 import numpy as np
+import os
 import subprocess
 import time
 
@@ -18,28 +24,85 @@ data_dir = Path("data") / MODEL
 if not data_dir.exists():
     subprocess.run(["bash", "remote_setup.sh"], check=True)
 
-print("loading vectors...")
-vectors = fbin_to_numpy(data_dir / "base.fbin")
-word_to_idx, vocab = read_vocab(data_dir / "vocab.txt")
+vectors, vocab, graph, bfs_distances, reverse_graph = load_serving_data(data_dir)
+bfs_distances = bfs_distances.tolist()
 
-print("loading graph...")
-graph = graph_file_to_list_of_lists(data_dir / "outputs" / "vamana")
-bfs_distances = []
-with open(data_dir / "outputs" / "vamana_distances.txt") as f:
-    for line in f:
-        bfs_distances.append(int(line))
+# the vocab payloads are multi-megabyte and only change between deploys, so they are rendered and compressed once
+payloads = vocab_payloads(vocab, bfs_distances)
         
+# rank tables shared by every game with the same target. selecting candidates on compressed vectors is slower than the
+# exact matmul and saves no memory while the float vectors stay mapped, so it is only for experiments
+# (SEMANTLE_QUANTIZED=1)
+top_k_cache = TopKCache(vectors, store=load_quantized(data_dir) if os.environ.get("SEMANTLE_QUANTIZED") else None)
+
+metrics = Metrics()
+describe_server_metrics(metrics)
+metrics.add_collector(top_k_cache_collector(top_k_cache))
+profiler = SamplingProfiler()
+
+# ranks are positions in the target's top RANK_DEPTH list (the target itself is rank 0), -1 beyond it
+RANK_DEPTH = 1001
+
+# edges followed by /neighborhood for each direction, and the most points it returns
+DIRECTIONS = {"out": [graph], "in": [reverse_graph], "both": [graph, reverse_graph]}
+MAX_NEIGHBORHOOD = 10000
+
+def guess_results(target_idx, guess_indices):
+    """similarity, rank and graph neighbors (with their similarities and ranks) of each guess to the target"""
+    neighbor_lists = [graph[idx] for idx in guess_indices]
+    indices = np.concatenate([np.asarray(guess_indices, dtype=np.int64)] + neighbor_lists)
+    
+    with metrics.phase("matmul"):
+        rank_table = top_k_cache.get(target_idx, RANK_DEPTH)
+        similarities = np.dot(vectors[indices], vectors[target_idx]).tolist()
+    ranks = {idx: rank for rank, idx in enumerate(rank_table.tolist())}
+    
+    results = []
+    position = len(guess_indices)
+    for guess_idx, neighbors in zip(guess_indices, neighbor_lists):
+        neighbors = neighbors.tolist()
+        results.append({
+            "word": vocab[guess_idx],
+            "similarity": similarities[len(results)],
+            "rank": ranks.get(guess_idx, -1),
+            "neighbors": vocab.words(neighbors),
+            "neighbor_similarities": similarities[position:position + len(neighbors)],
+            "neighbor_ranks": [ranks.get(i, -1) for i in neighbors],
+        })
+        position += len(neighbors)
+    return results
+
 print(f"Loaded in {time.time() - start:.2f} seconds")
 
+def static_response(name):
+    """serves a precompressed payload in the requested ?format= (json by default), honoring If-None-Match"""
+    payload = payloads[name].get(request.args.get("format", "json"))
+    if payload is None:
+        return jsonify({"error": f"format must be one of {list(payloads[name])}"}), 400
+    status, headers, body = payload.respond(request.headers)
+    return Response(body, status=status, headers=headers)
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    current_route.set(request.url_rule.rule if request.url_rule else "unmatched")
+
+@app.after_request
+def record_request(response):
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    elapsed = time.perf_counter() - g.get("request_start", time.perf_counter())
+    metrics.observe_request(route, request.method, response.status_code, elapsed, response.calculate_content_length())
+    return response
+
 @app.route("/get_vocab", methods=["GET"])
 def get_vocab():
     """returns the vocabulary list to the client so it can select a target word"""
-    return jsonify({"vocab": vocab})
+    return static_response("vocab")
 
 @app.route("/get_vocab_and_distances", methods=["GET"])
 def get_vocab_with_distances():
     """returns the vocabulary list with bfs distances to the start node"""
-    return jsonify({"vocab": vocab, "bfs_distances": bfs_distances})
+    return static_response("vocab_and_distances")
 
 @app.route("/similarity", methods=["POST"])
 def get_similarity():
@@ -48,14 +111,18 @@ def get_similarity():
     word1 = data.get("word1", [])
     word2 = data.get("word2", [])
 
-    if any(word not in vocab for word in word1 + word2):
+    with metrics.phase("lookup"):
+        word1_indices = vocab.ids(word1)
+        word2_indices = vocab.ids(word2)
+
+    if (word1_indices < 0).any() or (word2_indices < 0).any():
         return jsonify({"error": "at least one word not in vocabulary"}), 400
 
-    word1_indices = [word_to_idx[word] for word in word1]
-    word2_indices = [word_to_idx[word] for word in word2]
-    similarity = np.dot(vectors[word1_indices], vectors[word2_indices].T)
-    similarity = [[float(x) for x in row] for row in similarity]
-    return jsonify({"similarities": similarity})
+    with metrics.phase("matmul"):
+        similarity = np.dot(vectors[word1_indices], vectors[word2_indices].T)
+    with metrics.phase("serialization"):
+        similarity = [[float(x) for x in row] for row in similarity]
+        return jsonify({"similarities": similarity})
     
 
 @app.route("/top_k", methods=["POST"])
@@ -64,14 +131,18 @@ def get_top_k():
     data = request.json
     word = data.get("word", "").lower()
     k = data.get("k", 1000)
+    if not isinstance(k, int) or isinstance(k, bool) or k < 1:
+        return jsonify({"error": "k must be a positive integer"}), 400
 
-    if word not in vocab:
+    with metrics.phase("lookup"):
+        idx = vocab.get(word)
+    if idx is None:
         return jsonify({"error": "word not in vocabulary"}), 400
 
-    similarities = np.dot(vectors, vectors[word_to_idx[word]])
-    top_k = np.argsort(similarities)[::-1][:k]
-    top_words = [vocab[i] for i in top_k]
-    return jsonify({"top_words": top_words})
+    with metrics.phase("matmul"):
+        top_k = top_k_cache.get(idx, k)
+    with metrics.phase("serialization"):
+        return jsonify({"top_words": vocab.words(top_k)})
 
 @app.route("/neighbors", methods=["POST"])
 def get_neighbors():
@@ -79,12 +150,109 @@ def get_neighbors():
     data = request.json
     word = data.get("word", "").lower()
 
-    if word not in vocab:
+    idx = vocab.get(word)
+    if idx is None:
         return jsonify({"error": "word not in vocabulary"}), 400
 
-    neighbors = [vocab[i] for i in graph[word_to_idx[word]]]
+    neighbors = vocab.words(graph[idx])
     return jsonify({"neighbors": neighbors})
 
+@app.route("/neighborhood", methods=["POST"])
+def get_neighborhood():
+    """returns every word within hops of a word along out, in or both edges, with its hop count and, if a target is
+    given, its similarity and rank to the target"""
+    data = request.json
+    word = data.get("word", "").lower()
+    target = data.get("target", "").lower()
+    hops = data.get("hops", 2)
+    direction = data.get("direction", "out")
+    max_points = data.get("max_points", MAX_NEIGHBORHOOD)
+    if not isinstance(hops, int) or isinstance(hops, bool) or hops < 0:
+        return jsonify({"error": "hops must be a non-negative integer"}), 400
+    if not isinstance(max_points, int) or isinstance(max_points, bool) or max_points < 1:
+        return jsonify({"error": "max_points must be a positive integer"}), 400
+    max_points = min(max_points, MAX_NEIGHBORHOOD)
+
+    with metrics.phase("lookup"):
+        idx = vocab.get(word)
+        target_idx = vocab.get(target) if target else None
+    if idx is None or (target and target_idx is None):
+        return jsonify({"error": "word not in vocabulary"}), 400
+    if direction not in DIRECTIONS:
+        return jsonify({"error": f"direction must be one of {list(DIRECTIONS)}"}), 400
+
+    points, point_hops = neighborhood(DIRECTIONS[direction], [idx], hops, max_points)
+    result = {"words": vocab.words(points), "hops": point_hops.tolist()}
+    if target_idx is not None:
+        with metrics.phase("matmul"):
+            result["similarities"] = np.dot(vectors[points], vectors[target_idx]).tolist()
+            result["ranks"] = ranks_in(top_k_cache.get(target_idx, RANK_DEPTH), points).tolist()
+    with metrics.phase("serialization"):
+        return jsonify(result)
+
+@app.route("/guess", methods=["POST"])
+def guess():
+    """scores one guess against the target in a single round trip: similarity, rank and annotated neighbors"""
+    data = request.json
+    target = data.get("target", "").lower()
+    guess_word = data.get("guess", "").lower()
+
+    with metrics.phase("lookup"):
+        target_idx = vocab.get(target)
+        guess_idx = vocab.get(guess_word)
+    if target_idx is None or guess_idx is None:
+        return jsonify({"error": "word not in vocabulary"}), 400
+
+    results = guess_results(target_idx, [guess_idx])
+    with metrics.phase("serialization"):
+        return jsonify(results[0])
+
+@app.route("/guess_batch", methods=["POST"])
+def guess_batch():
+    """scores many guesses against one target; unknown guesses get an error entry instead of failing the batch"""
+    data = request.json
+    target = data.get("target", "").lower()
+    guess_words = [word.lower() for word in data.get("guesses", [])]
+
+    with metrics.phase("lookup"):
+        target_idx = vocab.get(target)
+        guess_indices = vocab.ids(guess_words)
+    if target_idx is None:
+        return jsonify({"error": "target not in vocabulary"}), 400
+
+    results = iter(guess_results(target_idx, guess_indices[guess_indices >= 0].tolist()))
+    guesses = [next(results) if idx >= 0 else {"word": word, "error": "word not in vocabulary"} for word, idx in zip(guess_words, guess_indices)]
+    with metrics.phase("serialization"):
+        return jsonify({"guesses": guesses})
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """prometheus text exposition of request latency, counts, payload sizes, phase timings and cache stats, for the
+    gunicorn worker that answers the request only"""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/profiler", methods=["GET", "POST"])
+def sampling_profiler():
+    """GET returns the collapsed stack samples; POST {"enabled", "interval_ms", "reset"} switches the profiler. only
+    served with SEMANTLE_PROFILER set, to local clients, and only for the worker that answers the request"""
+    refusal = profiler_refusal(request.remote_addr, request.headers)
+    if refusal is not None:
+        return jsonify({"error": refusal[1]}), refusal[0]
+    if request.method == "POST":
+        data = request.json or {}
+        if data.get("reset"):
+            profiler.reset()
+        if "enabled" in data:
+            if data["enabled"]:
+                try:
+                    profiler.start(float(data.get("interval_ms", profiler.interval * 1000)) / 1000)
+                except (TypeError, ValueError):
+                    return jsonify({"error": "interval_ms must be a finite number"}), 400
+            else:
+                profiler.stop()
+        return jsonify({"enabled": profiler.running, "interval_ms": profiler.interval * 1000, "samples": sum(profiler.samples.values())})
+    return Response(profiler.collapsed(), mimetype="text/plain")
+
 @app.route("/healthcheck", methods=["GET"])
 def healthcheck():
     return "healthy"
@@ -0,0 +1,212 @@
+"""plays semantle games with simulated players and compares their guess counts to beam search
+
+every game is a quiet SemantleGame on a shared embedding store, and players only see what a human would: the
+similarity (and rank) returned by make_guess, plus public knowledge of the vocabulary, the graph and the vectors.
+players are functions in PLAYERS taking (game, world, rng, max_guesses) that guess until the game is solved or they
+run out of guesses. games are split over a fork process pool; each game's random generator is seeded from the run seed
+and the game's index, so the json report is the same whatever the number of processes.
+
+a beam search comparison is the same thing as a guess (one word scored against the target), so beam search on the same
+targets is scored like a player that guesses the start word and then every word it compares: it has solved a game if
+it found the target within max_guesses of those guesses.
+
+Usage: python simulate_players.py <embedding name> [graph type] [--games 1000] [--players random greedy gradient] ...
+"""
+
+import argparse
+import heapq
+import json
+import multiprocessing
+import os
+import sys
+import time
+import numpy as np
+from pathlib import Path
+from semantle import EmbeddingStore, SemantleGame
+from parallel_eval import evaluate
+from utils import CSRGraph, Vocabulary
+
+PERCENTILES = (10, 25, 50, 75, 90, 99)
+
+# guesses the gradient player fits the target direction to
+GRADIENT_WINDOW = 32
+GRADIENT_RIDGE = 0.1
+
+
+def random_player(game, world, rng, max_guesses):
+    """guesses words in a random order"""
+    for idx in rng.permutation(len(game.vocab))[:max_guesses]:
+        game.make_guess(game.vocab[idx])
+        if game.solved:
+            return
+
+
+def greedy_player(game, world, rng, max_guesses):
+    """follows graph edges from the start word, always guessing the unguessed neighbors of the most similar word
+    guessed so far"""
+    graph = world["graph"]
+    guessed = np.zeros(len(game.vocab), dtype=bool)
+    guessed[world["start"]] = True
+    guess = game.make_guess(game.vocab[world["start"]])
+    frontier = [] if guess is None else [(-guess["similarity"], world["start"])]
+    while frontier and not game.solved:
+        _, node = heapq.heappop(frontier)
+        for neighbor in graph[node]:
+            if guessed[neighbor]:
+                continue
+            guessed[neighbor] = True
+            guess = game.make_guess(game.vocab[neighbor])
+            if game.solved or len(game.guesses) >= max_guesses:
+                return
+            if guess is not None:
+                heapq.heappush(frontier, (-guess["similarity"], int(neighbor)))
+
+
+def gradient_player(game, world, rng, max_guesses):
+    """estimates the direction of the target (the gradient of the similarity) by a least squares fit to the best
+    guesses so far, then guesses the unguessed word furthest along it"""
+    vectors = world["vectors"]
+    guessed = np.zeros(len(game.vocab), dtype=bool)
+    ids = []
+    similarities = []
+    candidate = world["start"]
+    while len(game.guesses) < max_guesses:
+        guessed[candidate] = True
+        guess = game.make_guess(game.vocab[candidate])
+        if game.solved:
+            return
+        if guess is not None:
+            ids.append(candidate)
+            similarities.append(guess["similarity"])
+        if not ids or guessed.all():
+            return
+
+        best = np.argsort(similarities)[::-1][:GRADIENT_WINDOW]
+        known = vectors[np.array(ids)[best]]
+        # ridge regression for the target t in known @ t = similarities, solved in the small gram space
+        weights = np.linalg.solve(known @ known.T + GRADIENT_RIDGE * np.eye(len(best)), np.array(similarities)[best])
+        scores = np.dot(vectors, weights @ known)
+        scores[guessed] = -np.inf
+        candidate = int(np.argmax(scores))
+
+
+PLAYERS = {
+    "random": random_player,
+    "greedy": greedy_player,
+    "gradient": gradient_player,
+}
+
+# set before the pool forks, so workers share the store and graph instead of loading them
+_world = {}
+
+
+def _play(job):
+    player, game_index, target = job
+    rng = np.random.default_rng([_world["seed"], game_index])
+    game = SemantleGame(store=_world["store"], target_word=_world["store"].vocab[target], verbose=False)
+    PLAYERS[player](game, _world, rng, _world["max_guesses"])
+    return len(game.guesses), game.solved
+
+
+def play_games(store, graph, targets, players, start=0, max_guesses=1000, seed=0, processes=None):
+    """plays one game per target with each player, returning {player: {"guesses": counts, "solved": flags}} in target
+    order"""
+    _world.update(store=store, vectors=store.vectors, graph=graph, start=start, max_guesses=max_guesses, seed=seed)
+    jobs = [(player, game_index, int(target)) for player in players for game_index, target in enumerate(targets)]
+    processes = processes or os.cpu_count() or 1
+    if processes == 1:
+        outcomes = [_play(job) for job in jobs]
+    else:
+        with multiprocessing.get_context("fork").Pool(processes) as pool:
+            outcomes = pool.map(_play, jobs, chunksize=max(1, len(jobs) // (processes * 8)))
+
+    results = {}
+    for i, player in enumerate(players):
+        player_outcomes = outcomes[i * len(targets):(i + 1) * len(targets)]
+        results[player] = {
+            "guesses": np.array([guesses for guesses, _ in player_outcomes], dtype=np.int64),
+            "solved": np.array([solved for _, solved in player_outcomes], dtype=bool),
+        }
+    return results
+
+
+def distribution(counts, solved):
+    """solve rate and the mean and percentiles of counts over the solved games"""
+    counts = np.asarray(counts)[solved]
+    summary = {"games": len(solved), "solve_rate": float(np.mean(solved)) if len(solved) else 0.0}
+    if len(counts):
+        summary["mean"] = float(np.mean(counts))
+        summary["percentiles"] = {str(p): float(np.percentile(counts, p)) for p in PERCENTILES}
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="simulate semantle players and compare them to beam search")
+    parser.add_argument("embeddings")
+    parser.add_argument("graph_type", nargs="?", default="vamana")
+    parser.add_argument("--games", type=int, default=1000, help="games per player")
+    parser.add_argument("--players", nargs="+", choices=list(PLAYERS), default=list(PLAYERS))
+    parser.add_argument("--max-guesses", type=int, default=1000, help="guesses after which a player (or beam search) gives up")
+    parser.add_argument("--start", type=int, default=0, help="first guess of the graph players and start node of beam search")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--processes", type=int, help="default: the number of cores")
+    parser.add_argument("--output", help="report file (default: outputs/<graph type>_players.json)")
+    args = parser.parse_args()
+
+    data_dir = Path("data") / args.embeddings
+    if not (data_dir / "outputs" / args.graph_type).exists():
+        print(f"No {args.graph_type} graph found. Run build_graph.py first.")
+        sys.exit(1)
+
+    store = EmbeddingStore.from_data_dir(data_dir)
+    graph = CSRGraph.from_file(data_dir / "outputs" / args.graph_type, mmap=True)
+
+    # targets are drawn from the query words, and must survive make_guess lowercasing the guess
+    query_path = data_dir / "query.txt"
+    candidates = store.vocab.require_ids(Vocabulary.from_file(query_path)) if query_path.exists() else np.arange(len(store.vocab))
+    candidates = np.array([idx for idx in candidates if store.vocab[idx] == store.vocab[idx].lower()])
+    targets = np.random.default_rng(args.seed).choice(candidates, args.games, replace=args.games > len(candidates))
+
+    start = time.time()
+    results = play_games(store, graph, targets, args.players, args.start, args.max_guesses, args.seed, args.processes)
+    print(f"played {args.games * len(args.players)} games in {time.time() - start:.2f} seconds")
+
+    start = time.time()
+    # every visited point was guessed, so a search within the guess budget never reaches this visited limit
+    counts = evaluate(graph, store.vectors, targets, start=args.start, limit=args.max_guesses + 1, processes=args.processes, nearest=True)
+    beam_guesses = counts["compared"] + 1
+    beam_solved = (counts["nearest"] == targets) & (beam_guesses <= args.max_guesses)
+    print(f"ran {args.games} beam searches in {time.time() - start:.2f} seconds")
+
+    report = {
+        "embeddings": args.embeddings,
+        "graph_type": args.graph_type,
+        "seed": args.seed,
+        "start": args.start,
+        "max_guesses": args.max_guesses,
+        "targets": [store.vocab[idx] for idx in targets],
+        "players": {
+            player: {"summary": distribution(result["guesses"], result["solved"]), "guesses": result["guesses"].tolist(), "solved": result["solved"].tolist()}
+            for player, result in results.items()
+        },
+        "beam_search": {
+            "summary": distribution(beam_guesses, beam_solved),
+            "guesses": beam_guesses.tolist(),
+            "solved": beam_solved.tolist(),
+            "compared": counts["compared"].tolist(),
+            "visited": counts["visited"].tolist(),
+        },
+    }
+
+    output = Path(args.output) if args.output else data_dir / "outputs" / f"{args.graph_type}_players.json"
+    with open(output, "w") as f:
+        json.dump(report, f)
+
+    print(f"{'':<12}{'solved':>8}{'mean':>10}{'median':>10}{'p90':>10}")
+    rows = [(player, entry["summary"]) for player, entry in report["players"].items()] + [("beam search", report["beam_search"]["summary"])]
+    for name, summary in rows:
+        if "mean" in summary:
+            print(f"{name:<12}{summary['solve_rate']:>8.3f}{summary['mean']:>10.1f}{summary['percentiles']['50']:>10.1f}{summary['percentiles']['90']:>10.1f}")
+        else:
+            print(f"{name:<12}{summary['solve_rate']:>8.3f}")
+    print(f"report written to {output}")
@@ -0,0 +1,194 @@
+"""single-file binary snapshot of everything the similarity api serves: vectors, vocab (with its hash index), graph,
+its reverse (the in-neighbors of every point) and bfs distances
+
+layout: an 8 byte magic, a little-endian uint32 version and uint32 header length, a json header describing each
+section (dtype, shape, offset, size, crc32) followed by its own crc32, then the sections, each aligned to 64 bytes.
+loading maps the whole file once and hands out zero-copy views, so it takes milliseconds regardless of data size.
+"""
+
+import json
+import sys
+import zlib
+import numpy as np
+from pathlib import Path
+from typing import NamedTuple
+
+from utils import fbin_to_numpy, mmap_fbin, Vocabulary, CSRGraph
+from hop_distances import load_bfs_distances
+
+MAGIC = b"SEMSNAP\0"
+VERSION = 1
+ALIGNMENT = 64
+
+
+class Snapshot(NamedTuple):
+    vectors: np.ndarray
+    vocab: Vocabulary
+    graph: CSRGraph
+    bfs_distances: np.ndarray
+    reverse_graph: CSRGraph
+
+
+def write_snapshot(snapshot_path, vectors, vocab, graph, bfs_distances, reverse_graph=None):
+    """writes the serving data to a single checksummed snapshot file; vocab is a Vocabulary or a list of words"""
+    if reverse_graph is None:
+        reverse_graph = graph.reverse()
+    if not isinstance(vocab, Vocabulary):
+        vocab = Vocabulary.from_words(vocab)
+    vocab_hashes, vocab_order = vocab.hash_index
+    sections = {
+        "vectors": np.ascontiguousarray(vectors, dtype=np.float32),
+        "vocab_offsets": np.ascontiguousarray(vocab.offsets, dtype=np.int64),
+        "vocab_blob": np.ascontiguousarray(vocab.blob, dtype=np.uint8),
+        "vocab_hashes": np.ascontiguousarray(vocab_hashes, dtype="<u8"),
+        "vocab_order": np.ascontiguousarray(vocab_order, dtype=np.int32),
+        "graph_offsets": np.ascontiguousarray(graph.offsets, dtype=np.int64),
+        "graph_neighbors": np.ascontiguousarray(graph.neighbors, dtype=np.int32),
+        "bfs_distances": np.ascontiguousarray(bfs_distances, dtype=np.int32),
+        "reverse_offsets": np.ascontiguousarray(reverse_graph.offsets, dtype=np.int64),
+        "reverse_neighbors": np.ascontiguousarray(reverse_graph.neighbors, dtype=np.int32),
+    }
+
+    # section offsets are relative to the end of the header so the header can be sized after the fact
+    descriptions = {}
+    position = 0
+    for name, array in sections.items():
+        descriptions[name] = {
+            "dtype": array.dtype.str,
+            "shape": list(array.shape),
+            "offset": position,
+            "nbytes": array.nbytes,
+            "crc32": zlib.crc32(array),
+        }
+        position += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+
+    header = json.dumps({"sections": descriptions}).encode()
+    header += b" " * (-(len(MAGIC) + 8 + len(header) + 4) % ALIGNMENT)
+
+    with open(snapshot_path, "wb") as f:
+        f.write(MAGIC)
+        np.array([VERSION, len(header)], dtype="<u4").tofile(f)
+        f.write(header)
+        np.array([zlib.crc32(header)], dtype="<u4").tofile(f)
+        data_start = f.tell()
+        for name, array in sections.items():
+            f.seek(data_start + descriptions[name]["offset"])
+            f.write(array.tobytes())
+        f.truncate(data_start + position)
+
+
+def load_snapshot(snapshot_path, verify=False):
+    """maps a snapshot file and returns its contents as read-only views
+
+    the header is always validated; pass verify=True to also check the crc32 of every section"""
+    data = np.memmap(snapshot_path, dtype=np.uint8, mode="r")
+
+    if data[:len(MAGIC)].tobytes() != MAGIC:
+        raise ValueError(f"{snapshot_path} is not a snapshot file")
+    version, header_length = np.frombuffer(data[len(MAGIC):len(MAGIC) + 8].tobytes(), dtype="<u4")
+    if version != VERSION:
+        raise ValueError(f"{snapshot_path} has snapshot version {version}, expected {VERSION}")
+
+    header_start = len(MAGIC) + 8
+    header = data[header_start:header_start + header_length].tobytes()
+    header_crc, = np.frombuffer(data[header_start + header_length:header_start + header_length + 4].tobytes(), dtype="<u4")
+    if zlib.crc32(header) != header_crc:
+        raise ValueError(f"{snapshot_path} has a corrupt header")
+    data_start = header_start + header_length + 4
+
+    arrays = {}
+    for name, description in json.loads(header)["sections"].items():
+        start = data_start + description["offset"]
+        raw = np.asarray(data[start:start + description["nbytes"]])
+        if verify and zlib.crc32(raw) != description["crc32"]:
+            raise ValueError(f"{snapshot_path} has a corrupt {name} section")
+        arrays[name] = raw.view(np.dtype(description["dtype"])).reshape(description["shape"])
+
+    # snapshots written before the vocab hash index was added get it computed on load
+    hash_index = (arrays["vocab_hashes"], arrays["vocab_order"]) if "vocab_hashes" in arrays else None
+    vocab = Vocabulary(arrays["vocab_offsets"], arrays["vocab_blob"], hash_index)
+
+    graph = CSRGraph(arrays["graph_offsets"], arrays["graph_neighbors"])
+
+    # snapshots written before the reverse graph was added get it computed on load
+    if "reverse_offsets" in arrays:
+        reverse_graph = CSRGraph(arrays["reverse_offsets"], arrays["reverse_neighbors"])
+    else:
+        reverse_graph = graph.reverse()
+
+    return Snapshot(arrays["vectors"], vocab, graph, arrays["bfs_distances"], reverse_graph)
+
+
+def snapshot_inputs(data_dir, graph_type="vamana"):
+    """the files a snapshot is built from that exist"""
+    data_dir = Path(data_dir)
+    outputs = data_dir / "outputs"
+    paths = [data_dir / "base.fbin", data_dir / "vocab.txt", outputs / graph_type, outputs / f"{graph_type}_distances.bin", outputs / f"{graph_type}_distances.txt"]
+    return [path for path in paths if path.exists()]
+
+
+def is_stale(snapshot_path, data_dir, graph_type="vamana"):
+    """whether any of the snapshot's inputs changed after it was written"""
+    built = Path(snapshot_path).stat().st_mtime
+    return any(path.stat().st_mtime > built for path in snapshot_inputs(data_dir, graph_type))
+
+
+def load_serving_data(data_dir, graph_type="vamana"):
+    """loads what the api serves, from outputs/<graph_type>.snapshot if it exists and is newer than the files it was
+    built from, and from the separate files otherwise
+    
+    vectors and graph are memory-mapped read-only either way, so server processes share one page cache copy"""
+    data_dir = Path(data_dir)
+    snapshot_path = data_dir / "outputs" / f"{graph_type}.snapshot"
+    
+    if snapshot_path.exists():
+        if not is_stale(snapshot_path, data_dir, graph_type):
+            print("loading snapshot...")
+            return load_snapshot(snapshot_path)
+        print(f"warning: {snapshot_path} is older than its inputs, loading the separate files instead (rebuild it with snapshot.py)")
+    
+    print("loading vectors...")
+    vectors = mmap_fbin(data_dir / "base.fbin")
+    vocab = Vocabulary.from_file(data_dir / "vocab.txt")
+
+    print("loading graph...")
+    graph = CSRGraph.from_file(data_dir / "outputs" / graph_type, mmap=True)
+    bfs_distances = load_bfs_distances(data_dir, graph_type)
+        
+    return Snapshot(vectors, vocab, graph, bfs_distances, graph.reverse())
+
+
+def build_snapshot(data_dir, graph_type="vamana"):
+    """packs data/<embeddings>/ and its built graph into outputs/<graph_type>.snapshot"""
+    data_dir = Path(data_dir)
+
+    vectors = fbin_to_numpy(data_dir / "base.fbin")
+    vocab = Vocabulary.from_file(data_dir / "vocab.txt")
+
+    graph = CSRGraph.from_file(data_dir / "outputs" / graph_type)
+
+    bfs_distances = load_bfs_distances(data_dir, graph_type)
+
+    snapshot_path = data_dir / "outputs" / f"{graph_type}.snapshot"
+    write_snapshot(snapshot_path, vectors, vocab, graph, bfs_distances)
+    load_snapshot(snapshot_path, verify=True)
+
+    return snapshot_path
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python snapshot.py <embedding name> [graph type]")
+        sys.exit(1)
+
+    embeddings = sys.argv[1]
+    graph_type = sys.argv[2] if len(sys.argv) > 2 else "vamana"
+
+    data_dir = Path(f"data/{embeddings}")
+
+    if not (data_dir / "outputs" / graph_type).exists():
+        print("Graph not found. Run build_graph.py first.")
+        sys.exit(1)
+
+    snapshot_path = build_snapshot(data_dir, graph_type)
+    print(f"wrote {snapshot_path} ({snapshot_path.stat().st_size / 2**20:.1f} MiB)")
@@ -0,0 +1,33 @@
+"""small synthetic data sets shared by the tests"""
+
+import numpy as np
+import pytest
+from utils import CSRGraph
+
+
+def make_vectors(n, d, seed=0):
+    """unit vectors, so that the negative inner product is a proper dissimilarity"""
+    vectors = np.random.default_rng(seed).standard_normal((n, d)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def make_graph(vectors, nearest=6, random=2, seed=0):
+    """each point links to its nearest neighbors and a few random points, listed in a shuffled order"""
+    rng = np.random.default_rng(seed)
+    similarities = vectors @ vectors.T
+    np.fill_diagonal(similarities, -np.inf)
+    lists = []
+    for i, row in enumerate(similarities):
+        neighbors = np.concatenate([np.argsort(-row)[:nearest], rng.integers(0, len(vectors), random)])
+        lists.append(rng.permutation(neighbors[neighbors != i]).astype(np.int32))
+    return CSRGraph.from_lists(lists)
+
+
+@pytest.fixture(scope="session")
+def vectors():
+    return make_vectors(400, 16)
+
+
+@pytest.fixture(scope="session")
+def graph(vectors):
+    return make_graph(vectors)
@@ -0,0 +1,93 @@
+"""the heap and bitmap search against the original list based beam search, and batch_search against search"""
+
+import pytest
+from beam_search import batch_search, beam_search, dist, eager_beam_search, search
+from quantization import ProductQuantizer, ScalarQuantizer
+
+# none of them is point 1, which searches that must compare their query start from
+QUERIES = range(0, 400, 9)
+
+
+def reference_beam_search(graph, vectors, start, query, limit=1000):
+    """beam_search as it was before the heap rewrite: a list popped from the front and sorted every step"""
+    beam = [(dist(vectors[start], vectors[query]), start)]
+    compared = []
+    visited = []
+    while beam and len(visited) < limit:
+        _, best = beam.pop(0)
+        visited.append(best)
+        if best == query:
+            return visited, compared
+        for neighbor in graph[best]:
+            if neighbor not in compared:
+                beam.append((dist(vectors[neighbor], vectors[query]), neighbor))
+                compared.append(neighbor)
+        beam.sort()
+    return visited, compared
+
+
+def reference_eager_beam_search(graph, vectors, start, query, limit=1000):
+    """eager_beam_search as it was before the heap rewrite"""
+    beam = [(dist(vectors[start], vectors[query]), start)]
+    compared = []
+    visited = []
+    while beam and len(visited) < limit:
+        best_dist, best = beam.pop(0)
+        if best == query:
+            return visited, compared
+        for neighbor in graph[best]:
+            if neighbor not in compared:
+                beam.append((dist(vectors[neighbor], vectors[query]), neighbor))
+                compared.append(neighbor)
+                if dist(vectors[neighbor], vectors[query]) < best_dist:
+                    beam.append((best_dist, best))
+                    break
+        else:
+            visited.append(best)
+        beam.sort()
+    return visited, compared
+
+
+@pytest.mark.parametrize("limit", [1000, 5])
+@pytest.mark.parametrize("search_function, reference", [(beam_search, reference_beam_search), (eager_beam_search, reference_eager_beam_search)])
+def test_matches_reference(graph, vectors, search_function, reference, limit):
+    lists = graph.to_lists()
+    for query in QUERIES:
+        visited, compared = search_function(graph, vectors, 0, query, limit)
+        expected_visited, expected_compared = reference(lists, vectors, 0, query, limit)
+        assert [int(point) for point in visited] == [int(point) for point in expected_visited]
+        assert [int(point) for point in compared] == [int(point) for point in expected_compared]
+
+
+@pytest.mark.parametrize("eager", [True, False])
+def test_finds_every_query(graph, vectors, eager):
+    for query in QUERIES:
+        result = search(graph, vectors, 1, query, eager=eager)
+        assert query in result.compared
+        assert len(set(result.compared)) == len(result.compared)
+
+
+@pytest.mark.parametrize("eager", [True, False])
+def test_hop_counters(graph, vectors, eager):
+    for query in QUERIES:
+        result = search(graph, vectors, 0, query, beam_width=4, eager=eager)
+        assert result.hops == len(result.comparisons_per_hop)
+        assert sum(result.comparisons_per_hop) == len(result.compared)
+
+
+@pytest.mark.parametrize("beam_width", [None, 3])
+@pytest.mark.parametrize("eager", [True, False])
+def test_batch_search_matches_search(graph, vectors, eager, beam_width):
+    queries = list(QUERIES)
+    # a batch size that doesn't divide the queries, so the last chunk is partial
+    results = batch_search(graph, vectors, 5, queries, limit=50, beam_width=beam_width, eager=eager, batch_size=7)
+    assert results == [search(graph, vectors, 5, query, limit=50, beam_width=beam_width, eager=eager) for query in queries]
+
+
+@pytest.mark.parametrize("make_codes", [ScalarQuantizer.from_vectors, lambda vectors: ProductQuantizer.from_vectors(vectors, subspaces=4, centroids=16, iterations=5)])
+def test_batch_search_on_codes_matches_search(graph, vectors, make_codes):
+    codes = make_codes(vectors)
+    queries = list(QUERIES)
+    results = batch_search(graph, vectors, 1, queries, beam_width=8, batch_size=7, codes=codes)
+    assert results == [search(graph, vectors, 1, query, beam_width=8, codes=codes) for query in queries]
+    assert all(query in result.compared for query, result in zip(queries, results))
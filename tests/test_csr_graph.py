@@ -0,0 +1,80 @@
+"""CSRGraph against the per-node parlay graph file reader it replaced"""
+
+import numpy as np
+import pytest
+from utils import CSRGraph, graph_file_to_list_of_lists, list_of_lists_to_graph_file
+
+
+def reference_read(graph_file):
+    """graph_file_to_list_of_lists as it was before CSRGraph: one read per node"""
+    with open(graph_file, "rb") as f:
+        num_points, _ = np.fromfile(f, dtype=np.int32, count=2)
+        degrees = np.fromfile(f, dtype=np.int32, count=num_points)
+        neighborhoods = [np.fromfile(f, dtype=np.int32, count=degree) for degree in degrees]
+        assert len(np.fromfile(f, dtype=np.int32)) == 0
+    return neighborhoods
+
+
+def reference_write(graph, graph_file):
+    """list_of_lists_to_graph_file as it was before CSRGraph"""
+    with open(graph_file, "wb") as f:
+        np.array([len(graph), max(len(neighbors) for neighbors in graph)], dtype=np.int32).tofile(f)
+        np.array([len(neighbors) for neighbors in graph], dtype=np.int32).tofile(f)
+        for neighbors in graph:
+            np.array(neighbors, dtype=np.int32).tofile(f)
+
+
+# includes points without neighbors, at the start, in the middle and at the end
+LISTS = [[], [2, 0, 3], [1], [], [0, 1, 2, 3, 5], [4], []]
+
+
+def assert_same_lists(lists, expected):
+    assert [np.asarray(neighbors).tolist() for neighbors in lists] == [list(neighbors) for neighbors in expected]
+
+
+@pytest.mark.parametrize("mmap", [False, True])
+def test_from_file_matches_reference(tmp_path, mmap):
+    reference_write(LISTS, tmp_path / "graph")
+    graph = CSRGraph.from_file(tmp_path / "graph", mmap=mmap)
+    assert len(graph) == len(LISTS)
+    assert graph.num_edges == sum(len(neighbors) for neighbors in LISTS)
+    assert_same_lists(graph.to_lists(), LISTS)
+    assert_same_lists([graph[i] for i in range(len(graph))], LISTS)
+    assert_same_lists(graph_file_to_list_of_lists(tmp_path / "graph"), LISTS)
+
+
+def test_to_file_matches_reference(tmp_path):
+    reference_write(LISTS, tmp_path / "reference")
+    CSRGraph.from_lists(LISTS).to_file(tmp_path / "graph")
+    list_of_lists_to_graph_file(LISTS, tmp_path / "lists")
+    assert (tmp_path / "graph").read_bytes() == (tmp_path / "reference").read_bytes()
+    assert (tmp_path / "lists").read_bytes() == (tmp_path / "reference").read_bytes()
+
+
+def test_round_trip(tmp_path, graph):
+    graph.to_file(tmp_path / "graph")
+    assert_same_lists(CSRGraph.from_file(tmp_path / "graph").to_lists(), reference_read(tmp_path / "graph"))
+    assert_same_lists(CSRGraph.from_file(tmp_path / "graph", mmap=True).to_lists(), graph.to_lists())
+
+
+def test_mmap_is_read_only(tmp_path, graph):
+    graph.to_file(tmp_path / "graph")
+    with pytest.raises(ValueError):
+        CSRGraph.from_file(tmp_path / "graph", mmap=True).neighbors[0] = 0
+
+
+def test_truncated_file_is_rejected(tmp_path, graph):
+    graph.to_file(tmp_path / "graph")
+    (tmp_path / "graph").write_bytes((tmp_path / "graph").read_bytes()[:-4])
+    with pytest.raises(AssertionError):
+        CSRGraph.from_file(tmp_path / "graph")
+
+
+def test_edges_and_reverse():
+    graph = CSRGraph.from_lists(LISTS)
+    assert_same_lists(CSRGraph.from_edges(graph.sources(), graph.neighbors, len(graph)).to_lists(), LISTS)
+    expected = [[] for _ in LISTS]
+    for source, neighbors in enumerate(LISTS):
+        for neighbor in neighbors:
+            expected[neighbor].append(source)
+    assert_same_lists(graph.reverse().to_lists(), expected)
@@ -0,0 +1,23 @@
+"""blocked ground truth against a brute force sort"""
+
+import numpy as np
+import pytest
+from groundtruth import compute_groundtruth
+
+
+@pytest.mark.parametrize("threads", [1, 3])
+def test_matches_brute_force(vectors, threads):
+    queries = vectors[::7] + 0.1
+    # small blocks, so that the running top k is merged across many base blocks and query blocks
+    ids, distances = compute_groundtruth(vectors, queries, k=10, query_block=16, base_block=64, threads=threads)
+    scores = queries @ vectors.T
+    expected = np.lexsort((np.broadcast_to(np.arange(len(vectors)), scores.shape), -scores), axis=1)[:, :10]
+    np.testing.assert_array_equal(ids, expected)
+    np.testing.assert_allclose(distances, -np.take_along_axis(scores, expected, axis=1), rtol=1e-5, atol=1e-6)
+
+
+def test_ties_and_small_base():
+    base = np.array([[1, 0], [0, 1], [1, 0]], dtype=np.float32)
+    ids, distances = compute_groundtruth(base, np.array([[1, 0]], dtype=np.float32), k=100)
+    np.testing.assert_array_equal(ids, [[0, 2, 1]])
+    np.testing.assert_array_equal(distances, [[-1, -1, 0]])
@@ -0,0 +1,75 @@
+"""the embedding file readers on small files of every format"""
+
+import gzip
+import numpy as np
+import pytest
+from ingest import detect_format, infer_dimension, read_embeddings
+
+VECTORS = np.arange(5 * 3, dtype=np.float32).reshape(5, 3) / 4 - 1
+# GloVe 840B style: tokens containing spaces, and tokens that parse as numbers
+WORDS = ["at the", "1990", "nan", "word", ". . ."]
+
+
+def text_lines(words, vectors):
+    return b"".join(f"{word} {' '.join(repr(float(value)) for value in vector)}\n".encode() for word, vector in zip(words, vectors))
+
+
+def read_all(path, **kwargs):
+    chunks = list(read_embeddings(path, chunk_size=2, **kwargs))
+    assert all(len(words) <= 2 for words, _ in chunks)
+    return [word for words, _ in chunks for word in words], np.concatenate([vectors for _, vectors in chunks])
+
+
+def test_glove_with_spaces_in_words(tmp_path):
+    path = tmp_path / "glove.840B.300d.txt"
+    path.write_bytes(text_lines(WORDS, VECTORS))
+    assert detect_format(path) == "glove"
+    words, vectors = read_all(path)
+    assert words == WORDS
+    np.testing.assert_array_equal(vectors, VECTORS)
+
+
+def test_glove_with_explicit_dimension(tmp_path):
+    path = tmp_path / "glove.txt"
+    path.write_bytes(text_lines(WORDS, VECTORS))
+    words, vectors = read_all(path, dim=3)
+    assert words == WORDS
+    np.testing.assert_array_equal(vectors, VECTORS)
+
+
+def test_infer_dimension():
+    lines = text_lines(WORDS, VECTORS).splitlines()
+    assert infer_dimension(lines) == 3
+    # "1990" and "nan" look like a fourth value, and a malformed line doesn't decide it either
+    assert infer_dimension(lines[1:3] + lines[3:] + [b"broken 1.0"]) == 3
+    with pytest.raises(ValueError):
+        infer_dimension([b"only words here"])
+
+
+def test_word2vec_text_and_gzip(tmp_path):
+    path = tmp_path / "vectors.txt.gz"
+    with gzip.open(path, "wb") as f:
+        f.write(b"5 3\n" + text_lines(WORDS, VECTORS))
+    assert detect_format(path) == "word2vec-text"
+    words, vectors = read_all(path)
+    assert words == WORDS
+    np.testing.assert_array_equal(vectors, VECTORS)
+
+
+def test_short_line_is_rejected(tmp_path):
+    path = tmp_path / "glove.txt"
+    path.write_bytes(text_lines(WORDS, VECTORS) + b"broken 1.0\n")
+    with pytest.raises(ValueError, match="expected a word and 3 values"):
+        read_all(path)
+
+
+def test_word2vec_binary(tmp_path):
+    path = tmp_path / "vectors.bin"
+    with open(path, "wb") as f:
+        f.write(b"5 3\n")
+        for word, vector in zip(["a", "b", "c_d", "e", "f"], VECTORS):
+            f.write(word.encode() + b" " + vector.astype("<f4").tobytes() + b"\n")
+    assert detect_format(path) == "word2vec-bin"
+    words, vectors = read_all(path)
+    assert words == ["a", "b", "c_d", "e", "f"]
+    np.testing.assert_array_equal(vectors, VECTORS)
@@ -0,0 +1,24 @@
+"""the sampling profiler's interval handling"""
+
+import pytest
+from metrics import MIN_PROFILER_INTERVAL, SamplingProfiler
+
+
+@pytest.mark.parametrize("interval", [float("nan"), float("inf"), "-inf", "nan", "x", None])
+def test_bad_intervals_are_rejected(interval):
+    profiler = SamplingProfiler()
+    with pytest.raises((TypeError, ValueError)):
+        SamplingProfiler(interval)
+    with pytest.raises((TypeError, ValueError)):
+        profiler.start(interval if interval is not None else [])
+    assert not profiler.running
+
+
+def test_short_intervals_are_clamped():
+    profiler = SamplingProfiler(0)
+    assert profiler.interval == MIN_PROFILER_INTERVAL
+    profiler.start("-5")
+    try:
+        assert profiler.interval == MIN_PROFILER_INTERVAL
+    finally:
+        profiler.stop()
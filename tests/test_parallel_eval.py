@@ -0,0 +1,50 @@
+"""parallel evaluation against a serial run of the same searches"""
+
+import numpy as np
+import pytest
+from beam_search import batch_search
+from parallel_eval import Evaluator, evaluate
+from quantization import ScalarQuantizer
+
+QUERIES = list(range(1, 400, 3))
+
+
+def assert_same_counts(counts, expected):
+    assert counts.keys() == expected.keys()
+    for key in expected:
+        np.testing.assert_array_equal(counts[key], expected[key])
+
+
+def test_matches_batch_search(graph, vectors):
+    counts = evaluate(graph, vectors, QUERIES, beam_width=8, processes=1)
+    results = batch_search(graph, vectors, 0, QUERIES, beam_width=8)
+    np.testing.assert_array_equal(counts["visited"], [len(result.visited) for result in results])
+    np.testing.assert_array_equal(counts["compared"], [len(result.compared) for result in results])
+
+
+@pytest.mark.parametrize("eager", [True, False])
+@pytest.mark.parametrize("processes", [2, 3])
+def test_parallel_matches_serial(graph, vectors, processes, eager):
+    expected = evaluate(graph, vectors, QUERIES, limit=30, eager=eager, processes=1, nearest=True)
+    counts = evaluate(graph, vectors, QUERIES, limit=30, eager=eager, processes=processes, shard_size=16, nearest=True)
+    assert_same_counts(counts, expected)
+
+
+def test_evaluator_is_reusable(graph, vectors):
+    with Evaluator(graph, vectors, processes=3, shard_size=16) as evaluator:
+        for beam_width in [None, 4]:
+            for queries in [QUERIES, QUERIES[:5]]:
+                assert_same_counts(evaluator.evaluate(queries, beam_width=beam_width), evaluate(graph, vectors, queries, beam_width=beam_width, processes=1))
+
+
+def test_nearest_is_the_query(graph, vectors):
+    counts = evaluate(graph, vectors, QUERIES, processes=2, nearest=True)
+    np.testing.assert_array_equal(counts["nearest"], QUERIES)
+
+
+def test_codes_parallel_matches_serial(graph, vectors):
+    codes = ScalarQuantizer.from_vectors(vectors)
+    expected = evaluate(graph, vectors, QUERIES, processes=1, nearest=True, codes=codes, rerank=3)
+    counts = evaluate(graph, vectors, QUERIES, processes=3, shard_size=16, nearest=True, codes=codes, rerank=3)
+    assert_same_counts(counts, expected)
+    np.testing.assert_array_equal(counts["nearest"], QUERIES)
@@ -0,0 +1,111 @@
+"""snapshot files against the separate files they are built from"""
+
+import os
+import numpy as np
+import pytest
+from hop_distances import bfs, write_hop_distances
+from snapshot import build_snapshot, load_serving_data, load_snapshot, write_snapshot
+from utils import Vocabulary, hash_words, numpy_to_fbin
+
+# one per point of the shared test vectors, with some non-ascii ones
+WORDS = [f"word{i}" for i in range(398)] + ["héllo", "naïve"]
+
+
+@pytest.fixture
+def data_dir(tmp_path, vectors, graph):
+    """a data directory with everything load_serving_data reads"""
+    (tmp_path / "outputs").mkdir()
+    numpy_to_fbin(vectors, tmp_path / "base.fbin")
+    (tmp_path / "vocab.txt").write_text("".join(f"{word}\n" for word in WORDS))
+    graph.to_file(tmp_path / "outputs" / "vamana")
+    write_hop_distances(tmp_path / "outputs" / "vamana_distances.bin", [0], bfs(graph, [0]))
+    return tmp_path
+
+
+def assert_same_graph(graph, expected):
+    np.testing.assert_array_equal(graph.offsets, expected.offsets)
+    np.testing.assert_array_equal(graph.neighbors, expected.neighbors)
+
+
+def test_round_trip(tmp_path, vectors, graph):
+    distances = bfs(graph, [0])
+    write_snapshot(tmp_path / "test.snapshot", vectors, WORDS, graph, distances)
+    snapshot = load_snapshot(tmp_path / "test.snapshot", verify=True)
+
+    np.testing.assert_array_equal(snapshot.vectors, vectors)
+    assert snapshot.vocab.to_list() == WORDS
+    assert snapshot.vocab.get("naïve") == len(WORDS) - 1
+    np.testing.assert_array_equal(snapshot.vocab.ids(["word3", "missing", "héllo"]), [3, -1, len(WORDS) - 2])
+    assert_same_graph(snapshot.graph, graph)
+    assert_same_graph(snapshot.reverse_graph, graph.reverse())
+    np.testing.assert_array_equal(snapshot.bfs_distances, distances)
+
+
+def test_vocab_index_is_stored(tmp_path, vectors, graph):
+    write_snapshot(tmp_path / "test.snapshot", vectors, WORDS, graph, bfs(graph, [0]))
+    hashes, order = load_snapshot(tmp_path / "test.snapshot").vocab.hash_index
+    # mapped from the file rather than rebuilt on load
+    assert not hashes.flags.writeable and not order.flags.writeable
+    expected_hashes, expected_order = Vocabulary.from_words(WORDS).hash_index
+    np.testing.assert_array_equal(hashes, expected_hashes)
+    np.testing.assert_array_equal(order, expected_order)
+
+
+def test_word_hashes_are_stable():
+    # 64-bit fnv-1a of the utf-8 bytes, the same in every process
+    np.testing.assert_array_equal(hash_words(["", "a", "é"]), np.array([0xcbf29ce484222325, 0xaf63dc4c8601ec8c, 0x0ac21707b7181e01], dtype=np.uint64))
+
+
+def test_vocabulary_and_list_give_the_same_file(tmp_path, vectors, graph):
+    distances = bfs(graph, [0])
+    write_snapshot(tmp_path / "list.snapshot", vectors, WORDS, graph, distances)
+    write_snapshot(tmp_path / "vocab.snapshot", vectors, Vocabulary.from_words(WORDS), graph, distances)
+    assert (tmp_path / "list.snapshot").read_bytes() == (tmp_path / "vocab.snapshot").read_bytes()
+
+
+def test_corruption_is_detected(tmp_path, vectors, graph):
+    path = tmp_path / "test.snapshot"
+    write_snapshot(path, vectors, WORDS, graph, bfs(graph, [0]))
+    data = bytearray(path.read_bytes())
+
+    # the first byte after the header is in the vectors section, which only a verified load reads
+    header_length = int(np.frombuffer(bytes(data[12:16]), dtype="<u4")[0])
+    data[16 + header_length + 4] ^= 0xFF
+    path.write_bytes(data)
+    load_snapshot(path)
+    with pytest.raises(ValueError, match="corrupt"):
+        load_snapshot(path, verify=True)
+
+    # the header is checked on every load
+    data[20] ^= 0xFF
+    path.write_bytes(data)
+    with pytest.raises(ValueError, match="corrupt header"):
+        load_snapshot(path)
+
+    path.write_bytes(b"NOTASNAP" + bytes(data[8:]))
+    with pytest.raises(ValueError, match="not a snapshot"):
+        load_snapshot(path)
+
+
+def test_serving_data_matches_separate_files(data_dir):
+    separate = load_serving_data(data_dir)
+    build_snapshot(data_dir)
+    snapshot = load_serving_data(data_dir)
+    assert not snapshot.vectors.flags.writeable
+
+    np.testing.assert_array_equal(snapshot.vectors, separate.vectors)
+    assert snapshot.vocab.to_list() == separate.vocab.to_list()
+    assert_same_graph(snapshot.graph, separate.graph)
+    assert_same_graph(snapshot.reverse_graph, separate.reverse_graph)
+    np.testing.assert_array_equal(snapshot.bfs_distances, separate.bfs_distances)
+
+
+def test_stale_snapshot_is_not_served(data_dir, capsys):
+    snapshot_path = build_snapshot(data_dir)
+    # a vocab written after the snapshot, which the snapshot doesn't have
+    (data_dir / "vocab.txt").write_text("".join(f"new{i}\n" for i in range(len(load_snapshot(snapshot_path).vocab))))
+    built = snapshot_path.stat().st_mtime
+    os.utime(data_dir / "vocab.txt", (built + 10, built + 10))
+
+    assert load_serving_data(data_dir).vocab[0] == "new0"
+    assert "older than its inputs" in capsys.readouterr().out
@@ -0,0 +1,50 @@
+"""partial-sort rank tables and their cache against a full sort"""
+
+import numpy as np
+import pytest
+from utils import TopKCache, ranks_in, top_k_from_similarities, top_k_indices
+
+
+def full_sort(vectors, idx):
+    """the whole vocabulary ranked by similarity to vectors[idx], as /top_k did before the cache"""
+    return np.argsort(-np.dot(vectors, vectors[idx]), kind="stable")
+
+
+@pytest.mark.parametrize("k", [1, 10, 399, 400, 1000])
+def test_top_k_matches_full_sort(vectors, k):
+    for idx in range(0, 400, 37):
+        np.testing.assert_array_equal(top_k_indices(vectors, vectors[idx], k), full_sort(vectors, idx)[:k])
+
+
+def test_ties_are_broken_by_index():
+    np.testing.assert_array_equal(top_k_from_similarities(np.array([1.0, 3.0, 3.0, 2.0, 3.0]), 3), [1, 2, 4])
+
+
+def test_cache_answers_like_a_full_sort(vectors):
+    cache = TopKCache(vectors, min_k=64)
+    for idx in [3, 3, 8]:
+        for k in [10, 64, 100, 10]:
+            table = cache.get(idx, k)
+            assert table.dtype == np.int32
+            np.testing.assert_array_equal(table, full_sort(vectors, idx)[:k])
+    # a target misses on its first request and on k=100, past its 64 entry table; everything else is a hit
+    assert (cache.hits, cache.misses) == (8, 4)
+
+
+def test_cache_evicts_least_recently_used(vectors):
+    # room for two tables of 64 int32 entries
+    cache = TopKCache(vectors, max_bytes=2 * 64 * 4, min_k=64)
+    cache.get(1, 10)
+    cache.get(2, 10)
+    cache.get(1, 10)
+    cache.get(3, 10)
+    assert len(cache) == 2 and cache.nbytes <= cache.max_bytes
+    assert cache.lookup(1, 10) is not None
+    assert cache.lookup(2, 10) is None
+
+
+def test_ranks_in(vectors):
+    table = top_k_indices(vectors, vectors[5], 50)
+    ids = np.array([table[0], table[49], table[7], -3, 10**6])
+    np.testing.assert_array_equal(ranks_in(table, ids), [0, 49, 7, -1, -1])
+    np.testing.assert_array_equal(ranks_in(table[:0], ids), [-1] * len(ids))
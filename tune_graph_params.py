@@ -1,53 +1,158 @@
+"""searches vamana build parameters for the fewest beam search comparisons at a target convergence rate
+
+queries are evaluated a step at a time in a fixed random order, and each step is reported to optuna: a trial is
+pruned as soon as too many queries have failed to converge for it to reach the target, or when its running average
+comparison count is worse than the median of earlier trials at the same step. --jobs runs that many worker processes
+against one study in a sqlite database; builds go through the graph cache, so every trial writes to its own directory.
+
+Usage: python tune_graph_params.py [embedding name] [--trials 250] [--jobs 1] [--target 0.995] [--R 4 16] ...
+"""
+
 from ParlayANN.python import wrapper as wp
-from utils import graph_file_to_list_of_lists, read_vocab, fbin_to_numpy
-from beam_search import eager_beam_search, beam_search
+from utils import CSRGraph, fbin_to_numpy, Vocabulary
+from parallel_eval import Evaluator
+from graph_cache import GraphCache, file_digest
 
+import argparse
+import contextlib
+import math
+import multiprocessing
 import optuna
-import sys
+import os
 from pathlib import Path
 import numpy as np
 
-embeddings = "word2vec-google-news-300_50000_lowercase"
+# objective of trials that don't reach the target
+FAILED_TRIAL_VALUE = 1000
+
+parser = argparse.ArgumentParser(description="tune vamana build parameters with optuna")
+parser.add_argument("embeddings", nargs="?", default="word2vec-google-news-300_50000_lowercase")
+parser.add_argument("--trials", type=int, default=250, help="total number of trials")
+parser.add_argument("--timeout", type=float, help="stop starting trials after this many seconds")
+parser.add_argument("--jobs", type=int, default=1, help="trials to run concurrently, each in its own process")
+parser.add_argument("--queries", type=int, help="number of queries to evaluate each graph on (default: all)")
+parser.add_argument("--step", type=int, default=500, help="queries evaluated between intermediate reports")
+parser.add_argument("--target", type=float, default=0.995, help="fraction of queries that must converge")
+parser.add_argument("--limit", type=int, default=1000, help="visited count at which a search has failed to converge")
+parser.add_argument("--R", type=int, nargs=2, default=(4, 16), metavar=("MIN", "MAX"), help="graph degree range")
+parser.add_argument("--L", type=int, nargs=2, default=(25, 200), metavar=("MIN", "MAX"), help="search width range")
+parser.add_argument("--alpha", type=float, nargs=2, default=(0.75, 1.25), metavar=("MIN", "MAX"), help="expansion factor range")
+parser.add_argument("--alpha-step", type=float, default=0.005)
+parser.add_argument("--two-pass", choices=["search", "yes", "no"], default="search", help="whether to use two-pass construction")
+parser.add_argument("--no-prune", action="store_true", help="evaluate every trial on every query")
+parser.add_argument("--seed", type=int, default=0, help="seed for the query order and the samplers")
+parser.add_argument("--storage", help="optuna storage url (default: a sqlite file in outputs/ when --jobs > 1)")
+parser.add_argument("--study-name", help="name of the study, to resume or share one")
+args = parser.parse_args()
+
+embeddings = args.embeddings
 
 data_dir = Path(f"data/{embeddings}")
 
-_, vocab = read_vocab(data_dir / "vocab.txt")
-_, query_vocab = read_vocab(data_dir / "query.txt")
+vocab = Vocabulary.from_file(data_dir / "vocab.txt")
+query_vocab = Vocabulary.from_file(data_dir / "query.txt")
 
-query_indices = [vocab.index(word) for word in query_vocab]
+query_indices = vocab.require_ids(query_vocab).tolist()
 
 vectors = fbin_to_numpy(data_dir / "base.fbin")
 
+# a random order, so that every prefix evaluated before a report is a fair sample of the queries
+query_order = np.random.default_rng(args.seed).permutation(len(query_indices))[:args.queries]
+query_steps = [query_order[i:i + args.step] for i in range(0, len(query_order), args.step)]
+# recall must end above target, so a trial is hopeless once this many queries have failed
+max_failures = (1 - args.target) * len(query_order)
+
+# trials with parameters that were already built (or evaluated) reuse the cached graph (or counts)
+cache = GraphCache()
+results_name = f"beam_search_{file_digest(data_dir / 'query.txt')[:16]}" + (f"_limit{args.limit}" if args.limit != 1000 else "")
+
+processes_per_trial = max(1, (os.cpu_count() or 1) // args.jobs)
+
 
 def objective(trial):
     VAMANA_PARAMS = {
-        "R": trial.suggest_int("R", 4, 16),  # Graph degree
-        "L": trial.suggest_int("L", 25, 200),  # Search width
-        "alpha": trial.suggest_float("alpha", 0.75, 1.25, step=0.005),  # Expansion factor
-        "two_pass": trial.suggest_categorical("two_pass", [True, False])  # Whether to use two-pass construction
+        "R": trial.suggest_int("R", *args.R),  # Graph degree
+        "L": trial.suggest_int("L", *args.L),  # Search width
+        "alpha": trial.suggest_float("alpha", *args.alpha, step=args.alpha_step),  # Expansion factor
+        "two_pass": trial.suggest_categorical("two_pass", [True, False]) if args.two_pass == "search" else args.two_pass == "yes"  # Whether to use two-pass construction
     }
 
-    wp.build_vamana_index("mips", "float", data_dir / "base.fbin", data_dir / "outputs" / "vamana", **VAMANA_PARAMS)
-    
-    graph = graph_file_to_list_of_lists(data_dir / "outputs" / "vamana")
-
-    visited_counts = []
-    compared_counts = []
-    
-    for idx in query_indices[:1000]:
-        visited, compared = eager_beam_search(graph, vectors, 0, idx)
-        visited_counts.append(len(visited))
-        compared_counts.append(len(compared))
-
-    avg_compared = np.mean(compared_counts)
-    converged = np.array(visited_counts) < 1000
-    
+    params = {"metric": "mips", **VAMANA_PARAMS}
+    key = cache.key(data_dir / "base.fbin", "vamana", params)
+
+    def build(graph_path):
+        wp.build_vamana_index("mips", "float", data_dir / "base.fbin", graph_path, **VAMANA_PARAMS)
+
+    cached_counts = cache.load_results(key, results_name)
+    if cached_counts is not None:
+        counts = {name: np.array(values) for name, values in cached_counts.items()}
+        graph = None
+    else:
+        counts = {"visited": np.zeros(len(query_indices), dtype=np.int64), "compared": np.zeros(len(query_indices), dtype=np.int64)}
+        graph = CSRGraph.from_file(cache.get_or_build(key, build, {"graph_type": "vamana", "params": params}))
+
+    # one pool and one shared memory copy of the graph for all the steps of the trial
+    with Evaluator(graph, vectors, processes_per_trial) if graph is not None else contextlib.nullcontext() as evaluator:
+        done = 0
+        for step in query_steps:
+            if evaluator is not None:
+                step_counts = evaluator.evaluate([query_indices[i] for i in step], limit=args.limit)
+                counts["visited"][step] = step_counts["visited"]
+                counts["compared"][step] = step_counts["compared"]
+            done += len(step)
+
+            evaluated = query_order[:done]
+            avg_compared = np.mean(counts["compared"][evaluated])
+            failures = np.sum(counts["visited"][evaluated] >= args.limit)
+            trial.report(avg_compared, done)
+            if not args.no_prune and (failures >= max_failures or trial.should_prune()):
+                print(f"pruned after {done} queries: {failures} failed to converge, avg compared: {avg_compared}")
+                raise optuna.TrialPruned()
+
+    if graph is not None and len(query_order) == len(query_indices):
+        cache.save_results(key, results_name, {name: values.tolist() for name, values in counts.items()})
+
+    converged = counts["visited"][query_order] < args.limit
+
     recall = np.mean(converged)
     print(f"recall: {recall}, avg compared: {avg_compared}")
 
-    return avg_compared  if recall > 0.995 else 1000
+    return avg_compared if recall > args.target else FAILED_TRIAL_VALUE
+
+
+def create_study(storage, sampler_seed):
+    return optuna.create_study(
+        study_name=args.study_name or f"vamana-{embeddings}",
+        storage=storage,
+        direction="minimize",
+        sampler=optuna.samplers.TPESampler(seed=sampler_seed),
+        pruner=optuna.pruners.MedianPruner(n_startup_trials=5, n_warmup_steps=1),
+        load_if_exists=storage is not None,
+    )
+
+
+def run_worker(storage, worker, n_trials):
+    study = create_study(storage, args.seed + worker)
+    study.optimize(objective, n_trials=n_trials, timeout=args.timeout)
+
+
+storage = args.storage
+if args.jobs > 1 and storage is None:
+    (data_dir / "outputs").mkdir(exist_ok=True)
+    storage = f"sqlite:///{data_dir / 'outputs' / 'tune.db'}"
+
+study = create_study(storage, args.seed)
 
-study = optuna.create_study(direction="minimize")
-study.optimize(objective, n_trials=250)  # Adjust the number of trials as needed
+if args.jobs > 1:
+    # fork, so the workers share the loaded vectors instead of re-running this script
+    context = multiprocessing.get_context("fork")
+    workers = [context.Process(target=run_worker, args=(storage, worker, math.ceil(args.trials / args.jobs))) for worker in range(args.jobs)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    study = optuna.load_study(study_name=study.study_name, storage=storage)
+else:
+    study.optimize(objective, n_trials=args.trials, timeout=args.timeout)
 
-print("Best hyperparameters:", study.best_params)
\ No newline at end of file
+print("Best hyperparameters:", study.best_params)
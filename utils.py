@@ -1,7 +1,8 @@
 """misc utility functions"""
 
 import numpy as np
-from pathlib import Path
+import threading
+from collections import OrderedDict
 
 def numpy_to_fbin(vectors, fbin_path):
     """writes a 2d numpy array to a .fbin file"""
@@ -10,60 +11,477 @@ def numpy_to_fbin(vectors, fbin_path):
         np.array([n, d], dtype=np.int32).tofile(fbin_file)
         vectors.astype(np.float32).tofile(fbin_file)
 
+class FbinWriter:
+    """writes a .fbin file a block of rows at a time, filling in the row count on close"""
+
+    def __init__(self, fbin_path, d):
+        self.d = d
+        self.n = 0
+        self._file = open(fbin_path, "wb")
+        np.array([0, d], dtype=np.int32).tofile(self._file)
+
+    def append(self, vectors):
+        assert vectors.shape[1] == self.d, f"expected {self.d} dimensions, got {vectors.shape[1]}"
+        vectors.astype(np.float32, copy=False).tofile(self._file)
+        self.n += len(vectors)
+
+    def close(self):
+        if self._file.closed:
+            return
+        self._file.seek(0)
+        np.array([self.n, self.d], dtype=np.int32).tofile(self._file)
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
 def fbin_to_numpy(fbin_path):
     """reads a 2d numpy array from a .fbin file"""
     with open(fbin_path, "rb") as fbin_file:
         n, d = np.fromfile(fbin_file, dtype=np.int32, count=2)
         return np.fromfile(fbin_file, dtype=np.float32).reshape(n, d)
     
+def mmap_fbin(fbin_path):
+    """memory-maps a .fbin file as a read-only 2d numpy array
+    
+    the data lives in the page cache, so every process mapping the same file shares one copy"""
+    with open(fbin_path, "rb") as fbin_file:
+        n, d = np.fromfile(fbin_file, dtype=np.int32, count=2)
+    return np.asarray(np.memmap(fbin_path, dtype=np.float32, mode="r", offset=8, shape=(n, d)))
+
+def read_groundtruth(gt_path):
+    """reads a parlay ground truth file, returning (ids, distances) as (n, k) arrays, nearest first"""
+    with open(gt_path, "rb") as gt_file:
+        n, k = np.fromfile(gt_file, dtype=np.int32, count=2)
+        ids = np.fromfile(gt_file, dtype=np.int32, count=n * k).reshape(n, k)
+        distances = np.fromfile(gt_file, dtype=np.float32, count=n * k).reshape(n, k)
+    return ids, distances
+
+def write_groundtruth(ids, distances, gt_path):
+    """writes (n, k) neighbor ids and distances in the parlay ground truth format read by read_groundtruth"""
+    n, k = ids.shape
+    with open(gt_path, "wb") as gt_file:
+        np.array([n, k], dtype=np.int32).tofile(gt_file)
+        ids.astype(np.int32).tofile(gt_file)
+        distances.astype(np.float32).tofile(gt_file)
+
+def _read_array(path, dtype, offset, shape, mmap):
+    if mmap:
+        return np.asarray(np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=shape))
+    with open(path, "rb") as f:
+        f.seek(offset)
+        return np.fromfile(f, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+def write_sq8(codes, scale, offset, sq8_path):
+    """writes int8 scalar quantization codes: int32 [n, d], float32 scale[d], float32 offset[d], then int8 codes[n, d]"""
+    n, d = codes.shape
+    with open(sq8_path, "wb") as f:
+        np.array([n, d], dtype=np.int32).tofile(f)
+        scale.astype(np.float32).tofile(f)
+        offset.astype(np.float32).tofile(f)
+        codes.astype(np.int8, copy=False).tofile(f)
+
+def read_sq8(sq8_path, mmap=False):
+    """reads a file written by write_sq8, returning (codes, scale, offset); codes are memory-mapped if mmap is set"""
+    with open(sq8_path, "rb") as f:
+        n, d = np.fromfile(f, dtype=np.int32, count=2)
+        scale = np.fromfile(f, dtype=np.float32, count=d)
+        offset = np.fromfile(f, dtype=np.float32, count=d)
+    return _read_array(sq8_path, np.int8, 8 + 8 * int(d), (n, d), mmap), scale, offset
+
+def write_pq(codes, centroids, pq_path):
+    """writes product quantization codes: int32 [n, m, ksub, dsub], float32 centroids[m, ksub, dsub], then uint8 codes[n, m]"""
+    m, ksub, dsub = centroids.shape
+    with open(pq_path, "wb") as f:
+        np.array([len(codes), m, ksub, dsub], dtype=np.int32).tofile(f)
+        centroids.astype(np.float32).tofile(f)
+        codes.astype(np.uint8, copy=False).tofile(f)
+
+def read_pq(pq_path, mmap=False):
+    """reads a file written by write_pq, returning (codes, centroids); codes are memory-mapped if mmap is set"""
+    with open(pq_path, "rb") as f:
+        n, m, ksub, dsub = np.fromfile(f, dtype=np.int32, count=4)
+        centroids = np.fromfile(f, dtype=np.float32, count=m * ksub * dsub).reshape(m, ksub, dsub)
+    return _read_array(pq_path, np.uint8, 16 + centroids.nbytes, (n, m), mmap), centroids
+
 def graph_file_to_list_of_lists(graph_file):
-    """reads a parlay graph file and returns a list of lists representing out neighborhoods"""
-    with open(graph_file, "rb") as f:
-        num_points, max_degree = np.fromfile(f, dtype=np.int32, count=2)
-        print(f"reading {num_points} points with max degree {max_degree}")
-        
-        degrees = np.fromfile(f, dtype=np.int32, count=num_points)
-        out_neighborhoods = []
-        for degree in degrees:
-            out_neighborhoods.append(np.fromfile(f, dtype=np.int32, count=degree))
-        
-        remaining = np.fromfile(f, dtype=np.int32)
-        assert len(remaining) == 0, f"file has {len(remaining)} remaining values after reading, expected 0"
-        
-        return out_neighborhoods
+    """reads a parlay graph file and returns a list of arrays representing out neighborhoods"""
+    return CSRGraph.from_file(graph_file).to_lists()
+    
+def mmap_graph_file(graph_file):
+    """memory-maps a parlay graph file, returning (offsets, neighbors) in csr form
+    
+    the out neighborhood of i is neighbors[offsets[i]:offsets[i + 1]]; neighbors is a read-only view of the file"""
+    data = np.asarray(np.memmap(graph_file, dtype=np.int32, mode="r"))
+    return _graph_data_to_csr(data)
+
+def _graph_data_to_csr(data):
+    """splits the int32 contents of a parlay graph file into (offsets, neighbors)"""
+    num_points = int(data[0])
+    degrees = data[2:2 + num_points]
+    offsets = np.zeros(num_points + 1, dtype=np.int64)
+    np.cumsum(degrees, out=offsets[1:])
+    neighbors = data[2 + num_points:]
+    assert len(neighbors) == offsets[-1], f"file has {len(neighbors)} neighbor values, expected {offsets[-1]}"
+    
+    return offsets, neighbors
     
 def list_of_lists_to_graph_file(graph, graph_file):
     """writes a list of lists representing out neighborhoods to a parlay graph file"""
-    with open(graph_file, "wb") as f:
-        num_points = len(graph)
-        max_degree = max(len(neighbors) for neighbors in graph)
-        np.array([num_points, max_degree], dtype=np.int32).tofile(f)
-        
-        degrees = np.array([len(neighbors) for neighbors in graph], dtype=np.int32)
-        degrees.tofile(f)
+    CSRGraph.from_lists(graph).to_file(graph_file)
+    
+
+class CSRGraph:
+    """directed graph in compressed sparse row form
+    
+    the out neighborhood of i is neighbors[offsets[i]:offsets[i + 1]], so the whole graph is two flat arrays:
+    int64 offsets and int32 neighbors. indexing returns array views, so it can stand in for a list of lists"""
+    
+    def __init__(self, offsets, neighbors):
+        self.offsets = offsets
+        self.neighbors = neighbors
         
-        for neighbors in graph:
-            np.array(neighbors, dtype=np.int32).tofile(f)
+    @classmethod
+    def from_file(cls, graph_file, mmap=False):
+        """reads a parlay graph file with one bulk read, or maps it read-only if mmap is set"""
+        if mmap:
+            return cls(*mmap_graph_file(graph_file))
+        return cls(*_graph_data_to_csr(np.fromfile(graph_file, dtype=np.int32)))
+    
+    @classmethod
+    def from_lists(cls, graph):
+        """builds a csr graph from a list of neighbor lists"""
+        offsets = np.zeros(len(graph) + 1, dtype=np.int64)
+        np.cumsum([len(neighbors) for neighbors in graph], out=offsets[1:])
+        neighbors = np.fromiter((neighbor for neighborhood in graph for neighbor in neighborhood), dtype=np.int32, count=offsets[-1])
+        return cls(offsets, neighbors)
+    
+    @classmethod
+    def from_edges(cls, sources, targets, num_points):
+        """builds a csr graph from parallel edge arrays, keeping the order of edges within each source"""
+        order = np.argsort(sources, kind="stable")
+        offsets = np.zeros(num_points + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=num_points), out=offsets[1:])
+        return cls(offsets, np.asarray(targets, dtype=np.int32)[order])
+    
+    def __len__(self):
+        return len(self.offsets) - 1
+    
+    def __getitem__(self, idx):
+        return self.neighbors[self.offsets[idx]:self.offsets[idx + 1]]
+    
+    def __iter__(self):
+        for start, end in zip(self.offsets[:-1].tolist(), self.offsets[1:].tolist()):
+            yield self.neighbors[start:end]
+    
+    @property
+    def num_edges(self):
+        return int(self.offsets[-1])
+    
+    @property
+    def degrees(self):
+        return np.diff(self.offsets)
+    
+    @property
+    def max_degree(self):
+        return int(self.degrees.max()) if len(self) else 0
+    
+    @property
+    def nbytes(self):
+        return self.offsets.nbytes + self.neighbors.nbytes
+    
+    def sources(self):
+        """the source of every edge, parallel to neighbors"""
+        return np.repeat(np.arange(len(self), dtype=np.int32), self.degrees)
+    
+    def degree_stats(self, percentiles=(0, 25, 50, 75, 90, 95, 99, 100)):
+        """summary of the out-degree distribution"""
+        degrees = self.degrees
+        return {
+            "points": len(self),
+            "edges": self.num_edges,
+            "average_degree": self.num_edges / len(self) if len(self) else 0.0,
+            "percentiles": {p: float(np.percentile(degrees, p)) for p in percentiles},
+        }
+    
+    def reverse(self):
+        """the graph with every edge flipped, i.e. the in-neighborhood of each point"""
+        return CSRGraph.from_edges(self.neighbors, self.sources(), len(self))
+    
+    def to_lists(self):
+        return list(self)
+    
+    def to_file(self, graph_file):
+        """writes the graph in the parlay format with a single write"""
+        degrees = self.degrees.astype(np.int32)
+        header = np.array([len(self), degrees.max() if len(self) else 0], dtype=np.int32)
+        with open(graph_file, "wb") as f:
+            f.write(np.concatenate([header, degrees, self.neighbors.astype(np.int32, copy=False)]).tobytes())
+    
             
+def edge_lengths(graph, vectors, block_size=2**15):
+    """negative inner product of the endpoints of every edge of a csr graph, parallel to its neighbors
+
+    edges are gathered a block at a time, so memory is bounded by block_size vectors rather than the number of edges"""
+    sources = graph.sources()
+    lengths = np.empty(graph.num_edges, dtype=np.float32)
+    for start in range(0, len(lengths), block_size):
+        end = start + block_size
+        lengths[start:end] = -(vectors[sources[start:end]] * vectors[graph.neighbors[start:end]]).sum(axis=1)
+    return lengths
+
+
 def sort_neighbors_by_distance(graph, vectors):
-    """sorts the neighbors of each point by the length of the edge inplace"""
-    for idx, neighbors in enumerate(graph):
-        lengths = -np.dot(vectors[neighbors], vectors[idx])
-        graph[idx] = [neighbor for _, neighbor in sorted(zip(lengths, neighbors))]
+    """sorts the neighbors of each point by the length of the edge, ties by neighbor index, with one sort over all
+    edges. returns the sorted CSRGraph; a list of lists is also sorted inplace"""
+    csr = graph if isinstance(graph, CSRGraph) else CSRGraph.from_lists(graph)
+    order = np.lexsort((csr.neighbors, edge_lengths(csr, vectors), csr.sources()))
+    csr = CSRGraph(csr.offsets, csr.neighbors[order])
+    if not isinstance(graph, CSRGraph):
+        graph[:] = [neighbors.tolist() for neighbors in csr]
+    return csr
         
     
-def read_vocab(vocab_dir):
-    """returns a word_to_idx dict and idx_to_word list from a vocab directory"""
-    if type(vocab_dir) == str:
-        vocab_dir = Path(vocab_dir)
+def encode_string_table(words):
+    """packs strings into (offsets, blob) where word i is blob[offsets[i]:offsets[i + 1]] in utf-8"""
+    encoded = [word.encode() for word in words]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(word) for word in encoded], out=offsets[1:])
+    blob = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    return offsets, blob
+
+
+def decode_string_table(offsets, blob):
+    """inverse of encode_string_table"""
+    data = blob.tobytes()
+    bounds = offsets.tolist()
+    return [data[start:end].decode() for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+FNV_OFFSET = np.uint64(0xcbf29ce484222325)
+FNV_PRIME = np.uint64(0x100000001b3)
+
+
+def hash_string_table(offsets, blob):
+    """64-bit fnv-1a hash of the utf-8 bytes of every string in a string table, which unlike python's str hash is the
+    same in every process; computed one byte position at a time over all strings, not one string at a time"""
+    starts = np.asarray(offsets[:-1], dtype=np.int64)
+    lengths = np.diff(offsets)
+    blob = np.asarray(blob, dtype=np.uint8)
+    hashes = np.full(len(lengths), FNV_OFFSET, dtype=np.uint64)
+    live = np.arange(len(lengths))
+    for position in range(int(lengths.max(initial=0))):
+        live = live[lengths[live] > position]
+        hashes[live] = (hashes[live] ^ blob[starts[live] + position]) * FNV_PRIME
+    return hashes
+
+
+def hash_words(words):
+    """hash_string_table of words; lone surrogates, which no vocabulary word has, are hashed rather than rejected"""
+    encoded = [word.encode(errors="surrogatepass") for word in words]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(word) for word in encoded], out=offsets[1:])
+    return hash_string_table(offsets, np.frombuffer(b"".join(encoded), dtype=np.uint8))
+
+
+class Vocabulary:
+    """word <-> index mapping over a compact string table
     
-    word_to_idx = {}
-    idx_to_word = []
+    words live in one utf-8 blob with offsets (which can be a view into a memory-mapped file), and word -> index goes
+    through a sorted array of word hashes, so there is no python object per word and batch lookups are vectorized.
+    the hashes are stable across processes, so the index (hash_index) can be stored, as snapshots do, and passed back
+    in instead of being rebuilt"""
     
-    with open(vocab_dir) as file:
-        for idx, line in enumerate(file):
-            word = line.strip()
-            word_to_idx[word] = idx
-            idx_to_word.append(word)
-            
-    return word_to_idx, idx_to_word
+    def __init__(self, offsets, blob, hash_index=None):
+        self.offsets = offsets
+        self.blob = blob
+        self._data = memoryview(blob)
+        if hash_index is None:
+            hashes = hash_string_table(offsets, blob)
+            order = np.argsort(hashes, kind="stable").astype(np.int32)
+            hash_index = hashes[order], order
+        self._hashes, self._order = hash_index
+        
+    @classmethod
+    def from_words(cls, words):
+        return cls(*encode_string_table(words))
+    
+    @classmethod
+    def from_file(cls, vocab_path):
+        """reads a vocab file with one word per line"""
+        with open(vocab_path) as file:
+            return cls.from_words([line.strip() for line in file])
+    
+    @property
+    def hash_index(self):
+        """(sorted word hashes, the index of the word with each hash)"""
+        return self._hashes, self._order
+    
+    def __len__(self):
+        return len(self.offsets) - 1
+    
+    def __getitem__(self, idx):
+        return bytes(self._data[self.offsets[idx]:self.offsets[idx + 1]]).decode()
+    
+    def __iter__(self):
+        return iter(decode_string_table(self.offsets, self.blob))
+    
+    def __contains__(self, word):
+        return self.get(word) is not None
+    
+    def get(self, word, default=None):
+        """returns the index of word, or default if it is not in the vocabulary"""
+        word_hash = hash_words([word])[0]
+        position = np.searchsorted(self._hashes, word_hash)
+        while position < len(self._hashes) and self._hashes[position] == word_hash:
+            idx = int(self._order[position])
+            if self[idx] == word:
+                return idx
+            position += 1
+        return default
+    
+    def index(self, word):
+        """returns the index of word, raising KeyError if it is not in the vocabulary"""
+        idx = self.get(word)
+        if idx is None:
+            raise KeyError(word)
+        return idx
+    
+    def ids(self, words):
+        """returns the indices of words as an int64 array, with -1 for words not in the vocabulary"""
+        words = list(words)
+        if not words or not len(self):
+            return np.full(len(words), -1, dtype=np.int64)
+        hashes = hash_words(words)
+        positions = np.minimum(np.searchsorted(self._hashes, hashes), len(self._hashes) - 1)
+        ids = self._order[positions].astype(np.int64)
+        ids[self._hashes[positions] != hashes] = -1
+        # confirm hash matches, resolving the (rare) collisions one at a time
+        for i in np.flatnonzero(ids >= 0):
+            if self[ids[i]] != words[i]:
+                ids[i] = self.get(words[i], -1)
+        return ids
+    
+    def require_ids(self, words):
+        """returns the indices of words like ids, raising KeyError with the missing words if any is not in the
+        vocabulary"""
+        words = list(words)
+        ids = self.ids(words)
+        if (ids < 0).any():
+            missing = [words[i] for i in np.flatnonzero(ids < 0)]
+            raise KeyError(f"{len(missing)} words not in the vocabulary: {missing[:10]}{' ...' if len(missing) > 10 else ''}")
+        return ids
+    
+    def words(self, ids):
+        """returns the words at the given indices"""
+        data = self._data
+        offsets = self.offsets
+        return [bytes(data[offsets[idx]:offsets[idx + 1]]).decode() for idx in np.asarray(ids).tolist()]
+    
+    def to_list(self):
+        return decode_string_table(self.offsets, self.blob)
+
+
+def top_k_indices(vectors, query, k):
+    """returns the indices of the k vectors with the largest inner product with query, best first"""
+    return top_k_from_similarities(np.dot(vectors, query), k)
+
+
+def top_k_reranked(store, vectors, query, k, rerank=4):
+    """top_k_indices with candidate selection on a quantized store: the best k * rerank rows by store.scores are
+    re-scored exactly against vectors"""
+    candidates = top_k_from_similarities(store.scores(query), k * rerank)
+    return candidates[top_k_from_similarities(np.dot(vectors[candidates], query), k)]
+
+
+def top_k_from_similarities(similarities, k):
+    """returns the indices of the k largest similarities, best first, using partial selection"""
+    k = min(k, len(similarities))
+    if k < len(similarities):
+        candidates = np.argpartition(-similarities, k - 1)[:k]
+    else:
+        candidates = np.arange(len(similarities))
+    order = np.argsort(-similarities[candidates], kind="stable")
+    return candidates[order].astype(np.int32)
+
+
+def ranks_in(rank_table, ids):
+    """position of each of ids in rank_table (a best first list of distinct indices), -1 for ids not in it"""
+    ids = np.asarray(ids, dtype=np.int64)
+    if len(rank_table) == 0:
+        return np.full(len(ids), -1, dtype=np.int64)
+    order = np.argsort(rank_table)
+    positions = order[np.searchsorted(rank_table, ids, sorter=order).clip(max=len(order) - 1)]
+    return np.where(rank_table[positions] == ids, positions, -1)
+
+
+class TopKCache:
+    """thread-safe LRU cache of top-k rank tables keyed by target index, bounded by total bytes
+    
+    tables are computed for at least min_k entries so that requests for slightly different k share one table. with a
+    quantized store, candidates are selected on its codes and re-ranked exactly (see top_k_reranked)"""
+    
+    def __init__(self, vectors, max_bytes=32 * 2**20, min_k=1024, store=None, rerank=4):
+        self.vectors = vectors
+        self.store = store
+        self.rerank = rerank
+        self.max_bytes = max_bytes
+        self.min_k = min_k
+        self.hits = 0
+        self.misses = 0
+        self._tables = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        
+    def get(self, idx, k):
+        """returns the indices of the k most similar vectors to vectors[idx] as an int32 array"""
+        table = self.lookup(idx, k)
+        if table is None:
+            table = self.compute(idx, k)
+        return table[:k]
+    
+    def compute(self, idx, k):
+        """computes and caches a rank table for idx that can answer requests for k"""
+        if self.store is None:
+            table = top_k_indices(self.vectors, self.vectors[idx], self.table_size(k))
+        else:
+            table = top_k_reranked(self.store, self.vectors, self.vectors[idx], self.table_size(k), self.rerank)
+        self.put(idx, table)
+        return table
+    
+    def lookup(self, idx, k):
+        """returns the cached top k for idx, or None if no table with at least k entries is cached"""
+        with self._lock:
+            table = self._tables.get(idx)
+            if table is not None and (len(table) >= k or len(table) == len(self.vectors)):
+                self._tables.move_to_end(idx)
+                self.hits += 1
+                return table[:k]
+            self.misses += 1
+            return None
+        
+    def table_size(self, k):
+        """number of entries to compute for a table that has to answer requests for k"""
+        return max(k, self.min_k)
+    
+    def put(self, idx, table):
+        """caches a rank table for idx, evicting the least recently used tables to stay within max_bytes"""
+        with self._lock:
+            previous = self._tables.pop(idx, None)
+            if previous is not None:
+                self._nbytes -= previous.nbytes
+            self._tables[idx] = table
+            self._nbytes += table.nbytes
+            while self._nbytes > self.max_bytes and len(self._tables) > 1:
+                _, evicted = self._tables.popitem(last=False)
+                self._nbytes -= evicted.nbytes
+    
+    def __len__(self):
+        return len(self._tables)
+    
+    @property
+    def nbytes(self):
+        return self._nbytes